@@ -18,6 +18,7 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 from influxdb import client as influxdb
 from pandas import DataFrame
+from numpy import ndarray
 from requests.exceptions import ConnectionError
 import time
 
@@ -94,7 +95,7 @@ class DataStorage():
         if timestamp is not None:
             columns = ["time", "value"]
 
-            if isinstance(value, list):
+            if isinstance(value, (list, ndarray)):
                 points = [[timestamp[i], val] for i, val in enumerate(value)]
             else:
                 points = [[timestamp, value]]
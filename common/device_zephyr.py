@@ -17,12 +17,14 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
 import zephyr
-from zephyr.collector import MeasurementCollector
-from zephyr.bioharness import BioHarnessSignalAnalysis, BioHarnessPacketHandler
+import zephyr.message
+from zephyr.collector import MeasurementCollector, CollectorCleanupThread
+from zephyr.bioharness import AccelerometerActivityAnalysis, BioHarnessSignalAnalysis, BioHarnessPacketHandler
 from zephyr.delayed_stream import DelayedRealTimeStream
 from zephyr.message import MessagePayloadParser
 from zephyr.protocol import BioHarnessProtocol, MessageFrameParser, MessageDataLogger
 from zephyr.testing import TimedVirtualSerial
+from zephyr.tracing import LatencyTracer
 from PyQt4.QtCore import QThread, SIGNAL
 import platform
 import serial
@@ -34,6 +36,16 @@ import time
 CREATE_TEST_DATA = False
 test_data_dir = "./testdata"
 
+# Trace the latency of every 10th frame of each message type from the serial port to the GUI,
+# the percentiles are written to latency_statistics_path at the end of each session
+TRACE_LATENCY = False
+latency_statistics_path = "./latency-statistics.csv"
+
+# The waveforms are kept for the longest plot window, with min/max pyramids so that
+# the plots query an envelope of their width whatever the window length
+WAVEFORM_HISTORY_SECONDS = 600.0
+WAVEFORM_SIGNAL_TYPES = ("ecg", "breathing")
+
 # A function that tries to list serial ports on most common platforms
 def list_serial_ports():
     system_name = platform.system()
@@ -76,6 +88,7 @@ class ZephyrDevice( QThread ):
                             'SUMMARY':0xBD,}
         
         self.virtual_serial = False
+        self.latency_tracer = None
 
         zephyr.configure_root_logger()
         if CREATE_TEST_DATA is True and self.virtual_serial is False:
@@ -100,37 +113,71 @@ class ZephyrDevice( QThread ):
 
     def initialize_device(self):
 
-        collector = MeasurementCollector()
+        collector = self.collector = MeasurementCollector(
+            decimated_signal_types=WAVEFORM_SIGNAL_TYPES,
+            retention_seconds=dict((signal_type, WAVEFORM_HISTORY_SECONDS) for signal_type in WAVEFORM_SIGNAL_TYPES))
 
         rr_signal_analysis = BioHarnessSignalAnalysis([], [collector.handle_event])
+        activity_analysis = AccelerometerActivityAnalysis([collector.handle_signal])
+
+        signal_callbacks = [collector.handle_signal, rr_signal_analysis.handle_signal,
+                            activity_analysis.handle_signal]
+        event_callbacks = [collector.handle_event]
+        frame_callbacks = []
+        data_callbacks = []
 
-        signal_packet_handler_bh = BioHarnessPacketHandler([collector.handle_signal, rr_signal_analysis.handle_signal],
-                                                           [collector.handle_event])
+        if TRACE_LATENCY is True:
+            # the tracer stamps each stage right after the stage has handled the sampled frame
+            self.latency_tracer = LatencyTracer(trace_callbacks=[self._emit_latency_trace])
+            signal_callbacks.insert(1, self.latency_tracer.handle_signal)
+            event_callbacks.append(self.latency_tracer.handle_event)
+            frame_callbacks.append(self.latency_tracer.handle_frame)
+            data_callbacks.append(self.latency_tracer.handle_data)
+
+        signal_packet_handler_bh = BioHarnessPacketHandler(signal_callbacks, event_callbacks)
 
         # Handle the payload of the message.
         # We don't treat the message payload at this time. The MessagePayloadParser class, when its method
         # handle_message() is executed (after the MessageFrameParser has verified the frame), will callbacks
-        # the function specified in the list below with a correct message format.
-        payload_parser = MessagePayloadParser([signal_packet_handler_bh.handle_packet, self.anyotherpackets])
+        # the functions subscribed below to the message id with a correct message format. The payload of
+        # messages without subscribers is not parsed at all.
+        payload_parser = MessagePayloadParser()
+        if self.latency_tracer is not None:
+            # subscribed first, so that it stamps the payload stage before the other subscribers run
+            payload_parser.subscribe(zephyr.message.SIGNAL_MESSAGE_IDS.values() + [0x2B, 0x0B, 0xAC],
+                                     self.latency_tracer.handle_message, header_only=True)
+        signal_packet_handler_bh.subscribe(payload_parser)
+        payload_parser.subscribe([zephyr.message.SIGNAL_MESSAGE_IDS['ecg'],
+                                  zephyr.message.SIGNAL_MESSAGE_IDS['breathing']], self.waveformpackets)
+        payload_parser.subscribe([0x0B, 0xAC], self.anyotherpackets) # serial number and battery status
 
         # handle the frame: verify STX, DLC, CRC and execute callback with the message in parameter
-        message_parser = MessageFrameParser([payload_parser.handle_message])
+        message_parser = MessageFrameParser(frame_callbacks + [payload_parser.handle_message])
 
         # The delayed stream is useful to synchronize the data coming from the device
         # and provides an easy reading by sending tuples like (signal name, sample value)
-        self.delayed_stream_thread = DelayedRealTimeStream(collector, [self.callback], 1)
+        self.delayed_stream_thread = DelayedRealTimeStream(collector, [self.callback], 1,
+                                                           latency_tracer=self.latency_tracer)
+
+        # the old data is removed by a thread of its own, not by the protocol thread that stores the new data
+        self.cleanup_thread = CollectorCleanupThread([collector])
 
-        self.protocol = BioHarnessProtocol(self.ser, [message_parser.parse_data, self.create_test_data_function])
+        self.protocol = BioHarnessProtocol(self.ser, data_callbacks + [message_parser.parse_data,
+                                                                       self.create_test_data_function],
+                                           connection_callbacks=[signal_packet_handler_bh.handle_connection_event])
+
+        # match the ACK/NAK responses of the device to the commands sent
+        message_parser.callbacks.append(self.protocol.commands.handle_message)
 
         if self.virtual_serial is False :
-            self.protocol.add_initilization_message( 0x0B, []) # get Serial Number
             self.connect( self, SIGNAL( 'Message' ), self._callback_serial_test )
-            # by default disable every packet:
-            self.protocol.add_initilization_message(self.PacketType['SUMMARY'], [0]) # disable summary packet
-            self.protocol.add_initilization_message(self.PacketType['BREATHING'], [0]) # disable breathing waveform
-            self.protocol.add_initilization_message(self.PacketType['ECG'], [0]) # disable ecg waveform
-            self.protocol.add_initilization_message(self.PacketType['RRDATA'], [0]) # disable rr data
-            self.protocol.add_initilization_message(self.PacketType['ACC'], [0]) # disable accelerometer waveform
+            # get the serial number and by default disable every packet, all in one write
+            self.protocol.send_commands([(0x0B, []), # get Serial Number
+                                         (self.PacketType['SUMMARY'], [0]), # disable summary packet
+                                         (self.PacketType['BREATHING'], [0]), # disable breathing waveform
+                                         (self.PacketType['ECG'], [0]), # disable ecg waveform
+                                         (self.PacketType['RRDATA'], [0]), # disable rr data
+                                         (self.PacketType['ACC'], [0])]) # disable accelerometer waveform
 
     def _callback_serial_test( self, message ):
         if hasattr(message, 'Number'):
@@ -144,6 +191,7 @@ class ZephyrDevice( QThread ):
     def run(self):
         self.running = True
         self.delayed_stream_thread.start()
+        self.cleanup_thread.start()
         self.protocol.start()
         while self.running:
             try:
@@ -155,8 +203,12 @@ class ZephyrDevice( QThread ):
     def terminate(self):
         self.protocol.terminate()
         self.protocol.join()
+        if hasattr(self, 'testdata_writer'):
+            self.testdata_writer.close()
         self.delayed_stream_thread.terminate()
         self.delayed_stream_thread.join()
+        self.cleanup_thread.terminate()
+        self.cleanup_thread.join()
         self.ser.close()
         self.running = False
         self.connected = False
@@ -204,35 +256,94 @@ class ZephyrDevice( QThread ):
     def anyotherpackets( self, message ):
         self.emit( SIGNAL( 'Message' ), message )
 
-        if type(message) is zephyr.message.SignalPacket and message.type == 'ecg':
-            self.emit( SIGNAL( 'ecg' ), message.samples )
-
-        if type(message) is zephyr.message.SignalPacket and message.type == 'breathing':
-            self.emit( SIGNAL( 'breathing_wave' ), message.samples )
-
-    def sendmessage(self, message_id, payload):
-        self.protocol.add_initilization_message(message_id, payload)
-
-    def enablePacket( self, packet_type ):
+    def waveformpackets( self, signal_packet ):
+        if signal_packet.type == 'ecg':
+            self.emit( SIGNAL( 'ecg' ), signal_packet.samples )
+
+        if signal_packet.type == 'breathing':
+            self.emit( SIGNAL( 'breathing_wave' ), signal_packet.samples )
+
+        # the waveforms go to the GUI without the delayed stream
+        if self.latency_tracer is not None and self.latency_tracer.current_trace is not None:
+            self._emit_latency_trace(self.latency_tracer.current_trace)
+
+    def _emit_latency_trace( self, trace ):
+        # queued behind the values emitted before it, the GUI stamps it once it has handled them
+        self.emit( SIGNAL( 'latency_trace' ), trace )
+
+    def stampLatencyTrace( self, trace ):
+        """ Slot for the 'latency_trace' signal, called in the GUI thread
+        """
+        self.latency_tracer.stamp(trace, 'gui')
+
+    def getLatencyStatistics( self ):
+        """ Latency percentiles in seconds by message id and pipeline stage,
+            see zephyr.tracing.LatencyTracer.get_statistics(). None if
+            TRACE_LATENCY is disabled
+        """
+        if self.latency_tracer is None:
+            return None
+        return self.latency_tracer.get_statistics()
+
+    def dumpLatencyStatistics( self, output_path=latency_statistics_path ):
+        if self.latency_tracer is not None:
+            self.latency_tracer.dump_statistics(output_path)
+
+    def sendmessage(self, message_id, payload, callback=None):
+        """ Returns a zephyr.command.CommandFuture that is resolved with
+            the ACK/NAK response of the device
+        """
+        return self.protocol.send_command(message_id, payload, callback)
+
+    def _packet_command(self, packet_type, enable):
+        data = [int(enable)]
+        if packet_type == 'SUMMARY':
+            data = [int(enable), 0]
+        return self.PacketType[packet_type], data
+
+    def enablePacket( self, packet_type, callback=None ):
         try:
-            data = [1]
-            if packet_type == 'SUMMARY':
-                data = [1, 0]
-            self.sendmessage(self.PacketType[packet_type], data)
+            self.sendmessage(*self._packet_command(packet_type, True), callback=callback)
             return True
         except:
             return False
 
-    def disablePacket( self, packet_type ):
+    def disablePacket( self, packet_type, callback=None ):
         try:
-            data = [0]
-            if packet_type == 'SUMMARY':
-                data = [0, 0]
-            self.sendmessage(self.PacketType[packet_type], data)
+            self.sendmessage(*self._packet_command(packet_type, False), callback=callback)
             return True
         except:
             return False
 
+    def enablePackets( self, packet_types ):
+        """ Enable several packets with a single write. Returns the command
+            futures, see sendmessage()
+        """
+        return self.protocol.send_commands([self._packet_command(packet_type, True) for packet_type in packet_types])
+
+    def disablePackets( self, packet_types ):
+        return self.protocol.send_commands([self._packet_command(packet_type, False) for packet_type in packet_types])
+
+    def getCommandStatistics( self ):
+        """ Counts of sent, acknowledged, refused, retried and timed out
+            commands, and their round-trip times in seconds
+        """
+        statistics = dict(self.protocol.commands.outcome_counts)
+        statistics['round_trip'] = self.protocol.commands.get_round_trip_statistics()
+        return statistics
+
+    def queryEnvelope( self, signal_type, window_seconds, max_points ):
+        """ Timestamps, minimums, maximums and means of about max_points points
+            of the last window_seconds of a waveform
+        """
+        end_timestamp = zephyr.time()
+        return self.collector.query_envelope(signal_type, end_timestamp - window_seconds, end_timestamp, max_points)
+
+    def getMemoryUsage( self ):
+        """ Bytes held by the collector in total and by stream
+        """
+        return self.collector.get_memory_usage()
+
     def create_test_data_function(self, stream_data):
         if CREATE_TEST_DATA is True and self.virtual_serial is False:
             self.testdata_writer( stream_data )
@@ -47,6 +47,7 @@ from common.hrv import TimeSeriesContainer
 from common.device_zephyr import ZephyrDevice, list_serial_ports
 from common.data_storage import DataStorage
 import zephyr.message
+from zephyr.decimation import compute_envelope, get_envelope_curve
 
 APP_NAME = _("Zephyr Biofeedback")
 VERSION = '0.9.0'
@@ -286,6 +287,7 @@ class MainWindow( QMainWindow ):
         self.connect( self.zephyr_connect, SIGNAL( 'breathing_wave_amplitude' ), self.add_breathing_wave_amplitude )
         self.connect( self.zephyr_connect, SIGNAL( 'activity' ), self.add_activity )
         self.connect( self.zephyr_connect, SIGNAL( 'posture' ), self.add_posture )
+        self.connect( self.zephyr_connect, SIGNAL( 'latency_trace' ), self.zephyr_connect.stampLatencyTrace )
         self.zephyr_connect.virtual_serial = self.appsettings.dataset.use_virtual_serial
 
         # the button are disabled by default
@@ -416,8 +418,7 @@ class MainWindow( QMainWindow ):
         if self.appsettings.dataset.enable_database is True:
             self.datastorage.write_points('breathing_wave', values, self.timeseriescontainer.ts_bw.realtime[-len(values):]*1000, 'm')
         # Set the data to the curve with values from the data-set and update the plot
-        self.bwplot.startIdx = self.timeseriescontainer.ts_bw.getSampleIndex( self.bwplot.window_length )
-        self.bwplot.update( self.timeseriescontainer.ts_bw.realtime, self.timeseriescontainer.ts_bw.series )
+        self.bwplot.update_envelope( self.zephyr_connect.queryEnvelope, 'breathing' )
 
         if len(self.timeseriescontainer.ts_bw.series) > 50:
             # ---- Compute and display the Power Spectral Density of breathing signal
@@ -429,8 +430,7 @@ class MainWindow( QMainWindow ):
         if self.appsettings.dataset.enable_database is True:
             self.datastorage.write_points('ecg', values, self.timeseriescontainer.ts_ecg.realtime[-len(values):]*1000, 'm')
 
-        self.ecgplot.startIdx = self.timeseriescontainer.ts_ecg.getSampleIndex( self.ecgplot.window_length )
-        self.ecgplot.update( self.timeseriescontainer.ts_ecg.realtime, self.timeseriescontainer.ts_ecg.series )
+        self.ecgplot.update_envelope( self.zephyr_connect.queryEnvelope, 'ecg' )
 
     def add_heart_rate(self, value):
         self.timeseriescontainer.heart_rate = np.append(self.timeseriescontainer.heart_rate, value)
@@ -563,18 +563,21 @@ class MainWindow( QMainWindow ):
         if self.appsettings.dataset.use_virtual_serial is True:
             self.zephyr_connect.resume()
 
+        packet_types = []
         for a in self.appsettings.dataset.bh_packets:
             if a == 0:
-                self.zephyr_connect.enablePacket('RRDATA')
+                packet_types.append('RRDATA')
                 self.timeseriescontainer.ts_rri.setStartTime()
             elif a == 1:
-                self.zephyr_connect.enablePacket('BREATHING')
+                packet_types.append('BREATHING')
                 self.timeseriescontainer.ts_bw.setStartTime()
             elif a == 2:
-                self.zephyr_connect.enablePacket('ECG')
+                packet_types.append('ECG')
                 self.timeseriescontainer.ts_ecg.setStartTime()
             elif a == 3:
-                self.zephyr_connect.enablePacket('SUMMARY')
+                packet_types.append('SUMMARY')
+        # a single write for all packets
+        self.zephyr_connect.enablePackets(packet_types)
 
         self.timer.start()
 
@@ -593,13 +596,12 @@ class MainWindow( QMainWindow ):
         if self.appsettings.dataset.use_virtual_serial is True:
             self.zephyr_connect.pause()
 
-        for a in self.appsettings.dataset.bh_packets:
-            if a == 0: self.zephyr_connect.disablePacket('RRDATA')
-            elif a == 1: self.zephyr_connect.disablePacket('BREATHING')
-            elif a == 2: self.zephyr_connect.disablePacket('ECG')
-            elif a == 3: self.zephyr_connect.disablePacket('SUMMARY')
+        packet_names = {0: 'RRDATA', 1: 'BREATHING', 2: 'ECG', 3: 'SUMMARY'}
+        self.zephyr_connect.disablePackets([packet_names[a] for a in self.appsettings.dataset.bh_packets
+                                            if a in packet_names])
 
         self.timer.stop()
+        self.zephyr_connect.dumpLatencyStatistics()
         # handle graphical change:
         self.playAction.setEnabled( True )
         self.timedAction.setEnabled( True )
@@ -708,10 +710,28 @@ class RealTimePlot():
         self.curve.set_data( x, y )
 
     def update( self, x, y ):
-        self.curve.set_data( x[self.startIdx:-1], y[self.startIdx:-1] )
+        x, y = x[self.startIdx:-1], y[self.startIdx:-1]
+        # the curve cannot show more than about two points per pixel column, so
+        # long windows are reduced to their min/max envelope at that resolution
+        max_points = max(1, self.plot.width())
+        if len(y) > 2 * max_points:
+            sample_indices, minimums, maximums, means = compute_envelope( np.asarray(y), max_points )
+            x, y = get_envelope_curve( np.asarray(x)[sample_indices], minimums, maximums )
+        self.curve.set_data( x, y )
         self.plot.do_autoscale()
         #self.plot.replot()
 
+    def update_envelope( self, query_envelope, signal_type ):
+        """ Show the last window_length seconds of a waveform from the
+            envelope that query_envelope(signal_type, window_seconds, max_points)
+            returns, at most two points per pixel column
+        """
+        max_points = max(1, self.plot.width())
+        timestamps, minimums, maximums, means = query_envelope( signal_type, self.window_length, max_points )
+        x, y = get_envelope_curve( timestamps, minimums, maximums )
+        self.curve.set_data( x, y )
+        self.plot.do_autoscale()
+
 class RealTimePSD():
     """ Real time Qwt plot object.
     """
@@ -0,0 +1,363 @@
+"""Protocol implementation on an asyncore event loop, so that a single
+thread can serve many devices over serial ports or TCP sockets."""
+
+import os
+import sys
+import time
+import heapq
+import socket
+import asyncore
+import logging
+import threading
+import itertools
+
+import zephyr.command
+from zephyr.protocol import BioHarnessCommands, ReconnectBackoff, DEFAULT_MAX_READ_SIZE, IDLE_WAKEUP_INTERVAL
+
+if os.name == "posix":
+    import tty
+
+
+class Timer:
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+
+
+class WakeupDispatcher(asyncore.file_dispatcher):
+    """Interrupts the blocking poll of the event loop from other threads."""
+    def __init__(self, socket_map):
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+        os.close(read_fd)
+    
+    def wakeup(self):
+        try:
+            os.write(self.write_fd, "\0")
+        except OSError:
+            pass
+    
+    def writable(self):
+        return False
+    
+    def handle_read(self):
+        self.recv(4096)
+    
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+class EventLoop(threading.Thread):
+    def __init__(self):
+        super(EventLoop, self).__init__()
+        self.socket_map = {}
+        self.terminated = False
+        
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self._timers_lock = threading.Lock()
+        
+        if os.name == "posix":
+            self._wakeup_dispatcher = WakeupDispatcher(self.socket_map)
+        else:
+            self._wakeup_dispatcher = None
+    
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.time() + delay, callback, args)
+        
+        with self._timers_lock:
+            heapq.heappush(self._timers, (timer.deadline, next(self._timer_sequence), timer))
+        
+        if threading.current_thread() is not self:
+            self.wakeup()
+        
+        return timer
+    
+    def call_soon(self, callback, *args):
+        return self.call_later(0.0, callback, *args)
+    
+    def wakeup(self):
+        if self._wakeup_dispatcher is not None:
+            self._wakeup_dispatcher.wakeup()
+    
+    def terminate(self):
+        self.terminated = True
+        self.wakeup()
+    
+    def get_poll_timeout(self):
+        with self._timers_lock:
+            if not self._timers:
+                return IDLE_WAKEUP_INTERVAL
+            return max(0.0, min(self._timers[0][0] - time.time(), IDLE_WAKEUP_INTERVAL))
+    
+    def run_timers(self):
+        now = time.time()
+        
+        while True:
+            with self._timers_lock:
+                if not self._timers or self._timers[0][0] > now:
+                    break
+                timer = heapq.heappop(self._timers)[2]
+            
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+    
+    def run_once(self):
+        poll_timeout = self.get_poll_timeout()
+        
+        if self.socket_map:
+            asyncore.loop(poll_timeout, map=self.socket_map, count=1)
+        else:
+            time.sleep(poll_timeout)
+        
+        self.run_timers()
+    
+    def run(self):
+        while not self.terminated:
+            self.run_once()
+        
+        for dispatcher in self.socket_map.values():
+            dispatcher.close()
+        
+        logging.debug("Event loop thread is out of the while loop.")
+
+
+class ConnectionDispatcherMixin:
+    def init_connection(self, protocol):
+        self.protocol = protocol
+        self.out_buffer = ""
+    
+    def send_data(self, data):
+        self.out_buffer += data
+    
+    def writable(self):
+        return bool(self.out_buffer) or not self.connected
+    
+    def handle_write(self):
+        sent_byte_count = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent_byte_count:]
+    
+    def handle_read(self):
+        data_string = self.recv(self.protocol.max_read_size)
+        if data_string:
+            self.protocol.data_received(data_string)
+    
+    def handle_close(self):
+        self.close()
+        self.protocol.connection_lost(self)
+    
+    def handle_error(self):
+        logging.info("Connection error (%s)", sys.exc_info()[1], exc_info=True)
+        self.handle_close()
+
+
+class TcpDispatcher(ConnectionDispatcherMixin, asyncore.dispatcher):
+    def __init__(self, protocol, socket_map, address):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.init_connection(protocol)
+        self.address = address
+    
+    def open_connection(self):
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(self.address)
+    
+    def handle_connect(self):
+        self.protocol.connection_made(self)
+
+
+class SerialPortDispatcher(ConnectionDispatcherMixin, asyncore.file_dispatcher):
+    def __init__(self, protocol, socket_map, port_path):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.init_connection(protocol)
+        self.port_path = port_path
+    
+    def open_connection(self):
+        port_fd = os.open(self.port_path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        
+        try:
+            tty.setraw(port_fd)
+            self.set_file(port_fd)
+        finally:
+            # set_file() works on a duplicate of the descriptor
+            os.close(port_fd)
+        
+        self.connected = True
+        self.protocol.connection_made(self)
+
+
+class TcpConnector:
+    def __init__(self, host, port):
+        self.address = (host, port)
+    
+    def create_dispatcher(self, protocol, socket_map):
+        return TcpDispatcher(protocol, socket_map, self.address)
+
+
+class SerialPortConnector:
+    def __init__(self, port_path):
+        self.port_path = port_path
+    
+    def create_dispatcher(self, protocol, socket_map):
+        return SerialPortDispatcher(protocol, socket_map, self.port_path)
+
+
+class AsyncProtocol:
+    """Counterpart of zephyr.protocol.Protocol that runs on an EventLoop
+    instead of a thread of its own. Received data is passed to the
+    callbacks in chunks, and the connection is re-established with backoff,
+    starting at reconnect_delay, if it is lost or idle for longer than
+    idle_timeout."""
+    def __init__(self, event_loop, connector, callbacks, max_read_size=DEFAULT_MAX_READ_SIZE,
+                 reconnect_delay=1.0, idle_timeout=None, connection_callbacks=(), reconnect_backoff=None):
+        self.event_loop = event_loop
+        self.connector = connector
+        self.callbacks = callbacks
+        self.connection_callbacks = list(connection_callbacks)
+        self.max_read_size = max_read_size
+        self.reconnect_backoff = reconnect_backoff or ReconnectBackoff(initial_delay=reconnect_delay)
+        self.idle_timeout = idle_timeout
+        
+        self.commands = zephyr.command.CommandPipeline(self.write_commands)
+        self.terminated = False
+        
+        self.dispatcher = None
+        self.connected = False
+        self.last_receive_time = None
+        self._reconnect_timer = None
+        self._idle_timer = None
+        self._command_timer = None
+    
+    def start(self):
+        self.event_loop.call_soon(self.connect)
+    
+    def terminate(self):
+        self.terminated = True
+        self.event_loop.call_soon(self.close_connection)
+    
+    def send_command(self, message_id, payload, callback=None):
+        command = self.commands.submit(message_id, payload, callback)
+        self.event_loop.call_soon(self.flush_commands)
+        return command
+    
+    def send_commands(self, messages):
+        commands = self.commands.submit_many(messages)
+        self.event_loop.call_soon(self.flush_commands)
+        return commands
+    
+    def add_initilization_message(self, message_id, payload):
+        return self.send_command(message_id, payload)
+    
+    def write_commands(self, data_string):
+        if not self.connected:
+            return False
+        
+        self.dispatcher.send_data(data_string)
+        return True
+    
+    def flush_commands(self):
+        if self.commands.flush() and self._command_timer is None:
+            self.schedule_command_timeout()
+    
+    def schedule_command_timeout(self):
+        command_deadline = self.commands.get_next_deadline()
+        if command_deadline is not None:
+            self._command_timer = self.event_loop.call_later(command_deadline - time.time(),
+                                                             self.check_command_timeouts)
+    
+    def check_command_timeouts(self):
+        self._command_timer = None
+        
+        if self.commands.check_timeouts():
+            self.commands.flush()
+        self.schedule_command_timeout()
+    
+    def connect(self):
+        self._reconnect_timer = None
+        if self.terminated:
+            return
+        
+        self.dispatcher = self.connector.create_dispatcher(self, self.event_loop.socket_map)
+        
+        try:
+            self.dispatcher.open_connection()
+        except (IOError, OSError, socket.error) as e:
+            logging.info("Opening connection failed (%s)", e)
+            if self.dispatcher.socket is not None:
+                self.dispatcher.close()
+            self.connection_lost(self.dispatcher)
+    
+    def handle_connection_event(self, event):
+        for connection_callback in self.connection_callbacks:
+            connection_callback(event)
+    
+    def connection_made(self, dispatcher):
+        logging.info("Connection established")
+        self.connected = True
+        self.last_receive_time = time.time()
+        self.reconnect_backoff.connection_made(self.last_receive_time)
+        self.handle_connection_event("connected")
+        
+        self.flush_commands()
+        
+        if self.idle_timeout is not None:
+            self._idle_timer = self.event_loop.call_later(self.idle_timeout, self.check_idle_timeout)
+    
+    def connection_lost(self, dispatcher):
+        if dispatcher is not self.dispatcher:
+            return
+        
+        was_connected = self.connected
+        self.dispatcher = None
+        self.connected = False
+        
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        
+        now = time.time()
+        if self.reconnect_backoff.connected:
+            self.reconnect_backoff.connection_lost(now)
+        else:
+            self.reconnect_backoff.attempt_failed(now)
+        
+        if was_connected:
+            self.handle_connection_event("disconnected")
+        
+        if not self.terminated and self._reconnect_timer is None:
+            reconnect_delay = self.reconnect_backoff.get_time_to_next_attempt(now)
+            logging.info("Connection lost, reconnecting in %.2f s", reconnect_delay)
+            self._reconnect_timer = self.event_loop.call_later(reconnect_delay, self.connect)
+    
+    def close_connection(self):
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+            self._reconnect_timer = None
+        
+        if self.dispatcher is not None:
+            self.dispatcher.handle_close()
+    
+    def check_idle_timeout(self):
+        idle_deadline = self.last_receive_time + self.idle_timeout
+        
+        if time.time() >= idle_deadline:
+            logging.info("Timeout occurred, closing connection")
+            self._idle_timer = None
+            self.dispatcher.handle_close()
+        else:
+            self._idle_timer = self.event_loop.call_later(idle_deadline - time.time(), self.check_idle_timeout)
+    
+    def data_received(self, data_string):
+        self.last_receive_time = time.time()
+        
+        for callback in self.callbacks:
+            callback(data_string)
+
+
+class AsyncBioHarnessProtocol(AsyncProtocol, BioHarnessCommands):
+    pass
@@ -0,0 +1,1297 @@
+"""Benchmarks of the zephyr pipeline against the recordings in testdata/.
+
+Run all benchmarks with "python -m zephyr.benchmark" or pass the names of
+the benchmarks to run as arguments.
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+import shutil
+import logging
+import threading
+import tempfile
+import collections
+import contextlib
+
+import numpy
+
+import zephyr
+import zephyr.util
+import zephyr.message
+import zephyr.recording
+from zephyr.protocol import Protocol, BioHarnessProtocol, MessageFrameParser, BytewiseMessageFrameParser, \
+    MessageDataLogger
+from zephyr.async_protocol import EventLoop, AsyncProtocol, SerialPortConnector
+from zephyr.bioharness import AccelerometerActivityAnalysis, BioHarnessPacketHandler
+from zephyr.collector import MeasurementCollector, EventStream, SignalStream, SignalStreamHistory
+from zephyr.hub import DeviceHub
+from zephyr.recording import Recording, convert_legacy_recording, iterate_legacy_recording_chunks
+from zephyr.testing import TimedVirtualSerial, PtySerial, PtyRecordingReplayer, iterate_test_recordings
+from zephyr.tracing import LatencyTracer
+
+
+REPLAY_SPEED = 1e6
+
+
+class CpuTimer:
+    def __enter__(self):
+        self.start_wall_time = time.time()
+        self.start_cpu_time = sum(os.times()[:2])
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.wall_seconds = time.time() - self.start_wall_time
+        self.cpu_seconds = sum(os.times()[:2]) - self.start_cpu_time
+
+
+@contextlib.contextmanager
+def fast_time(speed=REPLAY_SPEED):
+    original_time, original_sleep = zephyr.time, zephyr.sleep
+    zephyr.util.set_time_speed(speed)
+    try:
+        yield
+    finally:
+        zephyr.time, zephyr.sleep = original_time, original_sleep
+
+
+@contextlib.contextmanager
+def silenced_stdout():
+    original_stdout = sys.stdout
+    with open(os.devnull, "w") as null_file:
+        sys.stdout = null_file
+        try:
+            yield
+        finally:
+            sys.stdout = original_stdout
+
+
+@contextlib.contextmanager
+def silenced_logging():
+    logging.disable(logging.WARNING)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    directory = tempfile.mkdtemp(prefix="zephyr-benchmark-")
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+def get_recording_duration(timing_path):
+    with open(timing_path) as timing_file:
+        timestamps = [float(line.split(",")[0]) for line in timing_file if line.strip()]
+    return timestamps[-1] - timestamps[0]
+
+
+def print_table(header, rows):
+    widths = [max(len(str(row[column_i])) for row in [header] + rows)
+              for column_i in range(len(header))]
+    for row in [header] + rows:
+        print " | ".join(str(value).rjust(width) for value, width in zip(row, widths))
+    print
+
+
+def replay_through_protocol(data_path, timing_path, max_read_size, log_file_basepath):
+    with fast_time():
+        connection = TimedVirtualSerial(data_path, timing_path)
+        connection.paused = False
+        
+        frame_parser = MessageFrameParser([])
+        data_logger = MessageDataLogger(log_file_basepath)
+        protocol = Protocol(connection, [frame_parser.parse_data, data_logger], max_read_size)
+        
+        with silenced_stdout(), CpuTimer() as timer:
+            try:
+                protocol.run()
+            except EOFError:
+                pass
+    
+    return timer
+
+
+def benchmark_protocol_read_modes(max_read_sizes=(1, 4096)):
+    print "Protocol.run byte-per-call vs. bulk reads (replay at %gx)" % REPLAY_SPEED
+    
+    rows = []
+    with temporary_directory() as output_directory:
+        for data_path, timing_path in iterate_test_recordings():
+            byte_count = os.path.getsize(data_path)
+            stream_seconds = get_recording_duration(timing_path)
+            
+            for max_read_size in max_read_sizes:
+                log_file_basepath = os.path.join(output_directory, "replay-%d" % max_read_size)
+                timer = replay_through_protocol(data_path, timing_path, max_read_size, log_file_basepath)
+                
+                rows.append((os.path.basename(data_path), max_read_size,
+                             "%.0f" % (byte_count / timer.wall_seconds),
+                             "%.3f ms" % (1000.0 * timer.cpu_seconds / stream_seconds)))
+    
+    print_table(("recording", "max_read_size", "bytes/s", "CPU/stream s"), rows)
+
+
+def benchmark_idle_reader(idle_seconds=2.0, wakeup_count=50):
+    print "Protocol reader on a pseudo terminal: idle CPU and wake-up latency"
+    
+    connection = PtySerial()
+    data_event = threading.Event()
+    protocol = Protocol(connection, [lambda data_string: data_event.set()])
+    protocol.start()
+    
+    try:
+        with CpuTimer() as idle_timer:
+            time.sleep(idle_seconds)
+        
+        wakeup_latencies = []
+        for wakeup_i in range(wakeup_count): #@UnusedVariable
+            data_event.clear()
+            write_time = time.time()
+            connection.device_write("\x02")
+            data_event.wait(1.0)
+            wakeup_latencies.append(time.time() - write_time)
+            time.sleep(0.01)
+        
+        terminate_time = time.time()
+        protocol.terminate()
+        protocol.join()
+        terminate_latency = time.time() - terminate_time
+    finally:
+        connection.close()
+    
+    wakeup_latencies.sort()
+    print_table(("idle CPU", "wake-up p50", "wake-up max", "terminate"),
+                [("%.2f %%" % (100.0 * idle_timer.cpu_seconds / idle_timer.wall_seconds),
+                  "%.3f ms" % (1000.0 * wakeup_latencies[len(wakeup_latencies) / 2]),
+                  "%.3f ms" % (1000.0 * wakeup_latencies[-1]),
+                  "%.3f ms" % (1000.0 * terminate_latency))])
+
+
+def read_recording_chunks(data_path, timing_path):
+    with open(data_path, "rb") as data_file:
+        stream_bytes = data_file.read()
+    
+    with open(timing_path) as timing_file:
+        chunk_ends = [int(line.split(",")[1]) for line in timing_file if line.strip()]
+    
+    chunk_starts = [0] + chunk_ends
+    return [stream_bytes[start:end] for start, end in zip(chunk_starts, chunk_ends + [None])
+            if stream_bytes[start:end]]
+
+
+def parse_frame_count(stream_bytes):
+    frames = []
+    MessageFrameParser([frames.append]).parse_data(stream_bytes)
+    return len(frames)
+
+
+def start_threaded_readers(devices, callbacks):
+    protocols = [Protocol(device, [callback]) for device, callback in zip(devices, callbacks)]
+    for protocol in protocols:
+        protocol.start()
+    
+    def stop():
+        for protocol in protocols:
+            protocol.terminate()
+            protocol.join()
+    
+    return stop
+
+
+def start_event_loop_readers(devices, callbacks):
+    event_loop = EventLoop()
+    for device, callback in zip(devices, callbacks):
+        connector = SerialPortConnector(os.ttyname(device.slave_fd))
+        AsyncProtocol(event_loop, connector, [callback]).start()
+    event_loop.start()
+    
+    def stop():
+        event_loop.terminate()
+        event_loop.join()
+    
+    return stop
+
+
+def benchmark_devices_per_process(device_counts=(1, 10, 50)):
+    print "N devices on one thread each vs. on one event loop (pseudo terminals)"
+    
+    data_path, timing_path = list(iterate_test_recordings())[1]
+    chunks = read_recording_chunks(data_path, timing_path)
+    expected_frame_count = parse_frame_count("".join(chunks))
+    
+    rows = []
+    for device_count in device_counts:
+        for mode, start_readers in [("threads", start_threaded_readers),
+                                    ("event loop", start_event_loop_readers)]:
+            devices = [PtySerial() for device_i in range(device_count)] #@UnusedVariable
+            frame_counter = collections.Counter()
+            frame_parsers = [MessageFrameParser([lambda frame, device_i=device_i: frame_counter.update([device_i])])
+                             for device_i in range(device_count)]
+            
+            thread_count_before = threading.active_count()
+            stop_readers = start_readers(devices, [parser.parse_data for parser in frame_parsers])
+            time.sleep(0.1)
+            thread_count = threading.active_count() - thread_count_before
+            
+            with CpuTimer() as timer:
+                for chunk in chunks:
+                    for device in devices:
+                        device.device_write(chunk)
+                
+                while sum(frame_counter.values()) < expected_frame_count * device_count:
+                    time.sleep(0.001)
+            
+            stop_readers()
+            for device in devices:
+                device.close()
+            
+            rows.append((device_count, mode, thread_count, "%.3f s" % timer.wall_seconds,
+                         "%.3f s" % timer.cpu_seconds,
+                         "%.0f" % (expected_frame_count * device_count / timer.wall_seconds)))
+    
+    print_table(("devices", "mode", "threads", "wall", "CPU", "frames/s"), rows)
+
+
+def benchmark_device_hub(device_counts=(1, 20, 50), speed=100.0):
+    print "Full receive pipeline of N devices in one DeviceHub, recordings replayed %.0fx faster" % speed
+    
+    recordings = list(iterate_test_recordings())
+    recording_seconds = max(get_recording_duration(timing_path) for data_path, timing_path in recordings) #@UnusedVariable
+    
+    rows = []
+    for device_count in device_counts:
+        devices = [PtySerial() for device_i in range(device_count)] #@UnusedVariable
+        device_recordings = [recordings[device_i % len(recordings)] for device_i in range(device_count)]
+        expected_byte_count = sum(os.path.getsize(data_path) for data_path, timing_path in device_recordings) #@UnusedVariable
+        
+        hub = DeviceHub()
+        for device_i, device in enumerate(devices):
+            hub.add_device("subject-%02d" % device_i, SerialPortConnector(os.ttyname(device.slave_fd)))
+        
+        thread_count_before = threading.active_count()
+        hub.start()
+        time.sleep(0.1)
+        thread_count = threading.active_count() - thread_count_before
+        
+        replayer = PtyRecordingReplayer(zip(devices, device_recordings), speed)
+        with silenced_logging(), CpuTimer() as timer:
+            replayer.start()
+            replayer.join()
+            while sum(statistics["byte_count"] for statistics in hub.get_statistics().values()) < expected_byte_count:
+                time.sleep(0.001)
+        
+        frame_count = sum(statistics["frame_count"] for statistics in hub.get_statistics().values())
+        hub.terminate()
+        hub.join()
+        for device in devices:
+            device.close()
+        
+        # CPU share of one core that a device needs in real time, including
+        # the replaying thread
+        real_time_cpu_share = timer.cpu_seconds / (recording_seconds * device_count)
+        rows.append((device_count, thread_count, frame_count, "%.3f s" % timer.cpu_seconds,
+                     "%.3f %%" % (100.0 * real_time_cpu_share),
+                     "%.0f" % (1.0 / real_time_cpu_share)))
+    
+    print_table(("devices", "threads", "frames", "CPU", "CPU/device in real time", "devices/core"), rows)
+
+
+def time_repeated(function, minimum_seconds=0.5):
+    repetitions = 0
+    with CpuTimer() as timer:
+        while True:
+            function()
+            repetitions += 1
+            if time.time() - timer.start_wall_time >= minimum_seconds:
+                break
+    return timer.cpu_seconds / repetitions
+
+
+def benchmark_frame_parsers(read_size=4096):
+    print "MessageFrameParser vs. BytewiseMessageFrameParser on recorded chunks and on %d-byte reads" % read_size
+    
+    rows = []
+    for data_path, timing_path in iterate_test_recordings():
+        recorded_chunks = read_recording_chunks(data_path, timing_path)
+        stream_bytes = "".join(recorded_chunks)
+        read_chunks = [stream_bytes[start:start + read_size] for start in range(0, len(stream_bytes), read_size)]
+        
+        for chunking, chunks in [("recorded", recorded_chunks), ("%d B reads" % read_size, read_chunks)]:
+            def parse_all(parser_class):
+                parser = parser_class([])
+                for chunk in chunks:
+                    parser.parse_data(chunk)
+            
+            bytewise_seconds = time_repeated(lambda: parse_all(BytewiseMessageFrameParser))
+            buffered_seconds = time_repeated(lambda: parse_all(MessageFrameParser))
+            
+            rows.append((os.path.basename(data_path), chunking,
+                         "%.2f MB/s" % (len(stream_bytes) / bytewise_seconds / 1e6),
+                         "%.2f MB/s" % (len(stream_bytes) / buffered_seconds / 1e6),
+                         "%.1fx" % (bytewise_seconds / buffered_seconds)))
+    
+    print_table(("recording", "chunks", "bytewise", "buffered", "speedup"), rows)
+
+
+def corrupt_chunk(chunk, corruption, corruption_rate, random_generator):
+    corrupted_bytes = bytearray()
+    for byte in bytearray(chunk):
+        if random_generator.random() < corruption_rate:
+            if corruption == "flipped bytes":
+                byte = random_generator.randrange(256)
+            else:
+                burst_length = random_generator.randint(1, 16)
+                corrupted_bytes.extend(random_generator.randrange(256) for burst_i in range(burst_length)) #@UnusedVariable
+        corrupted_bytes.append(byte)
+    return str(corrupted_bytes)
+
+
+def benchmark_frame_resync(corruption_rates=(0.0001, 0.001, 0.01)):
+    print "Frames recovered from corrupted recordings: dropping until the next STX vs. MessageFrameParser resync"
+    
+    random_generator = random.Random(0)
+    stream_chunks = [read_recording_chunks(data_path, timing_path)
+                     for data_path, timing_path in iterate_test_recordings()]
+    
+    def parse_streams(parser_class, streams):
+        frame_count = 0
+        for chunks in streams:
+            frames = []
+            parser = parser_class([frames.append])
+            for chunk in chunks:
+                parser.parse_data(chunk)
+            frame_count += len(frames)
+        return frame_count
+    
+    sent_frame_count = parse_streams(MessageFrameParser, stream_chunks)
+    
+    rows = []
+    for corruption in ["flipped bytes", "noise bursts"]:
+        for corruption_rate in corruption_rates:
+            corrupted_streams = [[corrupt_chunk(chunk, corruption, corruption_rate, random_generator) for chunk in chunks]
+                                 for chunks in stream_chunks]
+            
+            with silenced_logging():
+                dropping_frame_count = parse_streams(BytewiseMessageFrameParser, corrupted_streams)
+                resync_frame_count = parse_streams(MessageFrameParser, corrupted_streams)
+                resync_seconds = time_repeated(lambda: parse_streams(MessageFrameParser, corrupted_streams))
+            
+            rows.append((corruption, "%g" % corruption_rate, sent_frame_count, dropping_frame_count,
+                         resync_frame_count, "%.0f" % (resync_frame_count / resync_seconds)))
+    
+    print_table(("corruption", "rate per byte", "sent frames", "dropping", "resync", "resync frames/s"), rows)
+
+
+class AcknowledgingDevice(threading.Thread):
+    """Answers every command written to a PtySerial with an ACK frame."""
+    def __init__(self, connection):
+        threading.Thread.__init__(self)
+        self.connection = connection
+        self.read_count = 0
+        self.frame_parser = MessageFrameParser([self.acknowledge])
+    
+    def acknowledge(self, message_frame):
+        self.connection.device_write(zephyr.recording.message_frame_to_bytes(message_frame)[:-1] + "\x06")
+    
+    def run(self):
+        try:
+            while True:
+                data_string = self.connection.device_read(4096)
+                self.read_count += 1
+                self.frame_parser.parse_data(data_string)
+        except OSError:
+            pass
+
+
+def benchmark_command_round_trip(command_counts=(1, 5, 20), repetitions=20):
+    print "Session start of N acknowledged commands on a pseudo terminal: one command at a time vs. one write"
+    
+    rows = []
+    for command_count in command_counts:
+        messages = [(0x15, [1])] * command_count
+        
+        for mode in ["one at a time", "coalesced"]:
+            connection = PtySerial()
+            device = AcknowledgingDevice(connection)
+            device.start()
+            
+            frame_parser = MessageFrameParser([])
+            protocol = BioHarnessProtocol(connection, [frame_parser.parse_data])
+            frame_parser.callbacks.append(protocol.commands.handle_message)
+            protocol.start()
+            
+            # waiting without a timeout, as Event.wait() polls otherwise in
+            # Python 2
+            session_start_seconds = []
+            for repetition_i in range(repetitions): #@UnusedVariable
+                start_time = time.time()
+                if mode == "one at a time":
+                    for message_id, payload in messages:
+                        protocol.send_command(message_id, payload).wait()
+                else:
+                    for command in protocol.send_commands(messages):
+                        command.wait()
+                session_start_seconds.append(time.time() - start_time)
+            
+            protocol.terminate()
+            protocol.join()
+            connection.close()
+            device.join()
+            
+            round_trip_statistics = protocol.commands.get_round_trip_statistics()
+            rows.append((command_count, mode, "%.1f" % (float(device.read_count) / repetitions),
+                         "%.3f ms" % (1000.0 * sorted(session_start_seconds)[repetitions / 2]),
+                         "%.3f ms" % (1000.0 * round_trip_statistics["p50"]),
+                         "%.3f ms" % (1000.0 * round_trip_statistics["p95"]),
+                         protocol.commands.outcome_counts["ACK"]))
+    
+    print_table(("commands", "mode", "device reads", "session start p50", "RTT p50", "RTT p95", "ACKs"), rows)
+
+
+def benchmark_crc_8(payload_length=128, batch_sizes=(100, 10000)):
+    print "CRC-8 of %d-byte payloads" % payload_length
+    
+    random_generator = random.Random(0)
+    payload = bytearray(random_generator.randrange(256) for byte_i in range(payload_length)) #@UnusedVariable
+    
+    rows = []
+    for name, digest in [("bitwise", zephyr.util.crc_8_digest_bitwise),
+                         ("table", zephyr.util.crc_8_digest)]:
+        seconds = time_repeated(lambda: digest(payload))
+        rows.append((name, 1, "%.2f us" % (1e6 * seconds)))
+    
+    for batch_size in batch_sizes:
+        data_bytes = bytearray(random_generator.randrange(256) for byte_i in range(batch_size * payload_length)) #@UnusedVariable
+        payload_offsets = range(0, len(data_bytes), payload_length)
+        payload_lengths = [payload_length] * batch_size
+        
+        seconds = time_repeated(lambda: zephyr.util.crc_8_digests(data_bytes, payload_offsets, payload_lengths))
+        rows.append(("batch", batch_size, "%.2f us" % (1e6 * seconds / batch_size)))
+    
+    print_table(("implementation", "payloads/call", "per payload"), rows)
+
+
+def read_recorded_payloads():
+    payloads = collections.defaultdict(list)
+    frame_parser = MessageFrameParser([lambda frame: payloads[frame.message_id].append(frame.payload)])
+    
+    for data_path, timing_path in iterate_test_recordings(): #@UnusedVariable
+        with open(data_path, "rb") as data_file:
+            frame_parser.parse_data(data_file.read())
+    
+    return payloads
+
+
+def benchmark_sample_decoding():
+    print "Signal sample decoding per packet: Python loop vs. NumPy vs. NumPy batch"
+    
+    def parse_10_bit_samples_loop(signal_bytes):
+        return [value - 512 for value in zephyr.util.unpack_bit_packed_values(signal_bytes, 10, False)]
+    
+    def parse_16_bit_samples_loop(signal_bytes):
+        return [value * 0.001 for value in zephyr.util.unpack_bit_packed_values(signal_bytes, 16, True)]
+    
+    recorded_payloads = read_recorded_payloads()
+    
+    rows = []
+    for message_id, name, loop_parser, sample_parser in [
+            (0x22, "ecg", parse_10_bit_samples_loop, zephyr.message.parse_10_bit_samples),
+            (0x21, "breathing", parse_10_bit_samples_loop, zephyr.message.parse_10_bit_samples),
+            (0x24, "rr", parse_16_bit_samples_loop, zephyr.message.parse_16_bit_samples)]:
+        payloads = recorded_payloads[message_id]
+        signal_bytes = [payload[zephyr.message.SIGNAL_PACKET_HEADER_LENGTH:] for payload in payloads]
+        
+        loop_seconds = time_repeated(lambda: [loop_parser(packet_bytes) for packet_bytes in signal_bytes])
+        array_seconds = time_repeated(lambda: [sample_parser(packet_bytes) for packet_bytes in signal_bytes])
+        batch_seconds = time_repeated(lambda: zephyr.message.parse_signal_packet_sample_batch(payloads, sample_parser))
+        
+        rows.append((name, len(payloads), len(sample_parser(signal_bytes[0])),
+                     "%.1f us" % (1e6 * loop_seconds / len(payloads)),
+                     "%.1f us" % (1e6 * array_seconds / len(payloads)),
+                     "%.2f us" % (1e6 * batch_seconds / len(payloads))))
+    
+    print_table(("signal", "packets", "samples", "loop", "numpy", "numpy batch"), rows)
+
+
+def legacy_parse_timestamp(timestamp_bytes):
+    year = timestamp_bytes[0] + (timestamp_bytes[1] << 8)
+    day_milliseconds = (timestamp_bytes[4] + (timestamp_bytes[5] << 8) +
+                        (timestamp_bytes[6] << 16) + (timestamp_bytes[7] << 24))
+    date = datetime.date(year=year, month=timestamp_bytes[2], day=timestamp_bytes[3])
+    return time.mktime(date.timetuple()) + day_milliseconds / 1000.0
+
+
+def legacy_parse_summary_packet(payload):
+    timestamp = legacy_parse_timestamp(payload[1:9])
+    (heart_rate, respiration_rate, skin_temperature, posture, activity,
+     peak_acceleration, breathing_wave_amplitude) = \
+        zephyr.util.parse_uint16_values_from_byte_sequence([10, 12, 14, 16, 18, 20, 25], payload)
+    return zephyr.message.SummaryMessage(payload[0], timestamp, heart_rate, respiration_rate * 0.1,
+                                         skin_temperature * 0.1, posture, activity * 0.01,
+                                         peak_acceleration * 0.01, breathing_wave_amplitude,
+                                         payload[29], payload[34])
+
+
+def legacy_parse_hxm_message(payload):
+    heart_rate, heartbeat_number = payload[9:11]
+    distance, speed, strides = tuple(zephyr.util.parse_uint16_values_from_bytes(payload[47:53]))
+    heartbeat_milliseconds = list(zephyr.util.parse_uint16_values_from_bytes(payload[11:41]))
+    return zephyr.message.HxMMessage(heart_rate, heartbeat_number, heartbeat_milliseconds,
+                                     distance / 16.0, speed / 256.0, strides)
+
+
+def legacy_parse_battery_status(payload):
+    return zephyr.message.BatteryStatus(zephyr.util.uint16_from_two_bytes((payload[0], payload[1])), payload[2])
+
+
+def legacy_signal_packet_parser_factory(sample_parser, signal_code, samplerate):
+    def parse_signal_packet(payload):
+        timestamp = legacy_parse_timestamp(payload[1:zephyr.message.SIGNAL_PACKET_HEADER_LENGTH])
+        samples = sample_parser(payload[zephyr.message.SIGNAL_PACKET_HEADER_LENGTH:])
+        return zephyr.message.SignalPacket(signal_code, timestamp, samplerate, samples, payload[0])
+    
+    return parse_signal_packet
+
+
+def legacy_parse_10_bit_samples(signal_bytes):
+    samples = zephyr.util.unpack_bit_packed_array(signal_bytes, 10, False, numpy.int16)
+    samples -= 512
+    return samples
+
+
+def legacy_parse_accelerometer_samples(signal_bytes):
+    interleaved_samples = legacy_parse_10_bit_samples(signal_bytes)
+    interleaved_samples = [value / 20.75 for value in interleaved_samples]
+    return zip(interleaved_samples[0::3], interleaved_samples[1::3], interleaved_samples[2::3])
+
+
+# The parsers of MESSAGE_TYPES before the struct decoders, the date cache
+# and the table decoding of the samples
+LEGACY_MESSAGE_TYPES = {
+    0x2B: legacy_parse_summary_packet,
+    0x21: legacy_signal_packet_parser_factory(legacy_parse_10_bit_samples, "breathing", 18.0),
+    0x22: legacy_signal_packet_parser_factory(legacy_parse_10_bit_samples, "ecg", 250.0),
+    0x24: legacy_signal_packet_parser_factory(zephyr.message.parse_16_bit_samples, "rr", 18.0),
+    0x25: legacy_signal_packet_parser_factory(legacy_parse_accelerometer_samples, "acceleration", 50.0),
+    0x26: legacy_parse_hxm_message,
+    0xAC: legacy_parse_battery_status,
+    0x0B: zephyr.message.parse_serial_number,
+}
+
+# Payload lengths of the message types that the recordings do not contain
+SYNTHETIC_PAYLOAD_LENGTHS = {0x25: 84, 0x26: 55, 0xAC: 3}
+
+
+def create_synthetic_payloads(payload_length, count=200):
+    random_generator = random.Random(0)
+    payloads = []
+    for payload_i in range(count): #@UnusedVariable
+        payload = bytearray(random_generator.randrange(256) for byte_i in range(payload_length)) #@UnusedVariable
+        # a valid date in the timestamp of the header
+        payload[1:5] = bytearray([0xDF, 0x07, 3, 14])[:max(0, payload_length - 1)]
+        payloads.append(payload)
+    return payloads
+
+
+def benchmark_message_parsing():
+    print "Payload parsing per message type: byte slicing, mktime() and shifted samples vs. struct decoders, " \
+        "cached dates and table decoded samples"
+    
+    recorded_payloads = read_recorded_payloads()
+    
+    rows = []
+    for message_id in sorted(zephyr.message.MESSAGE_TYPES):
+        payloads = recorded_payloads.get(message_id)
+        if payloads:
+            source = "recorded"
+        else:
+            payloads = create_synthetic_payloads(SYNTHETIC_PAYLOAD_LENGTHS.get(message_id, 12))
+            source = "synthetic"
+        
+        legacy_parser = LEGACY_MESSAGE_TYPES[message_id]
+        parser = zephyr.message.MESSAGE_TYPES[message_id]
+        
+        # the samples of signal packets are decoded on access
+        legacy_seconds = time_repeated(lambda: [getattr(legacy_parser(payload), "samples", None)
+                                                for payload in payloads])
+        struct_seconds = time_repeated(lambda: [getattr(parser(payload), "samples", None) for payload in payloads])
+        
+        rows.append(("0x%02X" % message_id, "%d %s" % (len(payloads), source),
+                     "%.2f us" % (1e6 * legacy_seconds / len(payloads)),
+                     "%.2f us" % (1e6 * struct_seconds / len(payloads)),
+                     "%.1fx" % (legacy_seconds / struct_seconds)))
+    
+    print_table(("message", "payloads", "before", "struct", "speedup"), rows)
+
+
+def benchmark_lazy_samples():
+    print "Signal packet parsing per packet: eager samples vs. lazy samples, not accessed and accessed"
+    
+    recorded_payloads = read_recorded_payloads()
+    
+    rows = []
+    for message_id, name, sample_parser in [(0x21, "breathing", zephyr.message.parse_10_bit_samples),
+                                            (0x22, "ecg", zephyr.message.parse_10_bit_samples),
+                                            (0x24, "rr", zephyr.message.parse_16_bit_samples),
+                                            (0x25, "acceleration", zephyr.message.parse_accelerometer_samples)]:
+        payloads = recorded_payloads.get(message_id) or create_synthetic_payloads(SYNTHETIC_PAYLOAD_LENGTHS[message_id])
+        
+        eager_parser = zephyr.message.signal_packet_payload_parser_factory(sample_parser, name, 1.0)
+        lazy_parser = zephyr.message.MESSAGE_TYPES[message_id]
+        
+        eager_seconds = time_repeated(lambda: [eager_parser(payload) for payload in payloads])
+        header_seconds = time_repeated(lambda: [lazy_parser(payload).sequence_number for payload in payloads])
+        samples_seconds = time_repeated(lambda: [lazy_parser(payload).samples for payload in payloads])
+        
+        rows.append((name, len(payloads),
+                     "%.2f us" % (1e6 * eager_seconds / len(payloads)),
+                     "%.2f us" % (1e6 * header_seconds / len(payloads)),
+                     "%.2f us" % (1e6 * samples_seconds / len(payloads)),
+                     "%.1fx" % (eager_seconds / header_seconds)))
+    
+    print_table(("signal", "packets", "eager", "lazy, header", "lazy, samples", "header speedup"), rows)
+
+
+def benchmark_payload_dispatch():
+    print "Recorded frames with ECG enabled but only summary and breathing consumed: every message to every callback vs. subscriptions"
+    
+    def consume_summary_and_breathing(message):
+        if isinstance(message, zephyr.message.SummaryMessage):
+            pass
+        elif isinstance(message, zephyr.message.SignalPacket) and message.type == "breathing":
+            message.samples
+    
+    def consume_subscribed_message(message):
+        if isinstance(message, zephyr.message.SignalPacket):
+            message.samples
+    
+    rows = []
+    for data_path, timing_path in iterate_test_recordings(): #@UnusedVariable
+        message_frames = []
+        with open(data_path, "rb") as data_file:
+            MessageFrameParser([message_frames.append]).parse_data(data_file.read())
+        ecg_frame_count = sum(1 for message_frame in message_frames if message_frame.message_id == 0x22)
+        
+        broadcast_parser = zephyr.message.MessagePayloadParser([consume_summary_and_breathing])
+        subscribed_parser = zephyr.message.MessagePayloadParser()
+        subscribed_parser.subscribe([0x2B, 0x21], consume_subscribed_message)
+        
+        broadcast_seconds = time_repeated(lambda: [broadcast_parser.handle_message(message_frame)
+                                                   for message_frame in message_frames])
+        subscribed_seconds = time_repeated(lambda: [subscribed_parser.handle_message(message_frame)
+                                                    for message_frame in message_frames])
+        
+        rows.append((os.path.basename(data_path), len(message_frames), ecg_frame_count,
+                     "%.2f us" % (1e6 * broadcast_seconds / len(message_frames)),
+                     "%.2f us" % (1e6 * subscribed_seconds / len(message_frames)),
+                     "%.1fx" % (broadcast_seconds / subscribed_seconds)))
+    
+    print_table(("recording", "frames", "ecg frames", "broadcast", "subscribed", "speedup"), rows)
+
+
+def get_sample_list_size(samples):
+    if isinstance(samples, numpy.ndarray):
+        return samples.nbytes
+    
+    size = sys.getsizeof(samples)
+    for sample in samples:
+        size += sys.getsizeof(sample)
+        if isinstance(sample, tuple):
+            size += sum(sys.getsizeof(value) for value in sample)
+    return size
+
+
+def benchmark_accelerometer(history_length_seconds=20.0):
+    print "Acceleration packets: list of 3-tuples vs. float32 (N, 3) arrays, and the derived activity signal"
+    
+    payloads = create_synthetic_payloads(SYNTHETIC_PAYLOAD_LENGTHS[0x25])
+    packet_count = int(history_length_seconds * 50.0 / zephyr.message.count_accelerometer_samples(84 - 9))
+    
+    def create_collector(parse_signal_packet, signal_callbacks):
+        collector = MeasurementCollector(history_length_seconds)
+        signal_callbacks.insert(0, collector.handle_signal)
+        for packet_i in range(packet_count):
+            signal_packet = parse_signal_packet(payloads[packet_i % len(payloads)])
+            signal_packet = signal_packet._replace(timestamp=packet_i * 0.4)
+            for signal_callback in signal_callbacks:
+                signal_callback(signal_packet, packet_i == 0)
+        return collector
+    
+    def get_history_size(collector):
+        return sum(get_sample_list_size(signal_stream.samples)
+                   for signal_type, history in collector.iterate_signal_stream_histories() #@UnusedVariable
+                   for signal_stream in history.get_signal_streams())
+    
+    legacy_parser = LEGACY_MESSAGE_TYPES[0x25]
+    parser = zephyr.message.MESSAGE_TYPES[0x25]
+    
+    legacy_seconds = time_repeated(lambda: create_collector(legacy_parser, []))
+    array_seconds = time_repeated(lambda: create_collector(parser, []))
+    activity_seconds = time_repeated(lambda: create_collector(parser, [AccelerometerActivityAnalysis([]).handle_signal]))
+    
+    rows = [("tuples", "%.2f us" % (1e6 * legacy_seconds / packet_count),
+             "%d kB" % (get_history_size(create_collector(legacy_parser, [])) / 1024)),
+            ("float32 array", "%.2f us" % (1e6 * array_seconds / packet_count),
+             "%d kB" % (get_history_size(create_collector(parser, [])) / 1024))]
+    
+    activity_collector = MeasurementCollector(history_length_seconds)
+    create_collector(parser, [AccelerometerActivityAnalysis([activity_collector.handle_signal]).handle_signal])
+    rows.append(("float32 array + activity", "%.2f us" % (1e6 * activity_seconds / packet_count),
+                 "%d kB + %d B" % (get_history_size(create_collector(parser, [])) / 1024,
+                                   get_history_size(activity_collector))))
+    
+    print "%d packets, %.0f seconds of acceleration" % (packet_count, history_length_seconds)
+    print_table(("samples", "per packet", "history size"), rows)
+
+
+class ListSignalStream:
+    """The list based SignalStream before the circular buffer."""
+    def __init__(self, signal_packet):
+        self.samplerate = signal_packet.samplerate
+        self.samples = []
+        self.end_timestamp = None
+    
+    def append_signal_packet(self, signal_packet):
+        self.samples.extend(signal_packet.samples)
+        self.end_timestamp = signal_packet.timestamp + len(signal_packet.samples) / float(signal_packet.samplerate)
+    
+    def remove_samples_before(self, timestamp_lower_bound):
+        start_timestamp = self.end_timestamp - len(self.samples) / float(self.samplerate)
+        samples_to_remove = max(0, int((timestamp_lower_bound - start_timestamp) * self.samplerate))
+        if samples_to_remove:
+            self.samples = self.samples[samples_to_remove:]
+        return samples_to_remove
+
+
+def benchmark_signal_stream(history_lengths=(20.0, 300.0), stream_seconds=600.0, cleanup_interval=5.0):
+    print "ECG stream of %.0f seconds with cleanup every %.0f seconds: list vs. circular buffer" % \
+        (stream_seconds, cleanup_interval)
+    
+    parse_signal_packet = zephyr.message.MESSAGE_TYPES[0x22]
+    payload = create_synthetic_payloads(88, count=1)[0]
+    template_packet = parse_signal_packet(payload)
+    packet_seconds = len(template_packet.samples) / template_packet.samplerate
+    signal_packets = [template_packet._replace(timestamp=packet_i * packet_seconds)
+                      for packet_i in range(int(stream_seconds / packet_seconds))]
+    
+    def replay(signal_stream, history_length_seconds):
+        append_seconds = []
+        cleanup_seconds = []
+        next_cleanup_timestamp = cleanup_interval
+        
+        for signal_packet in signal_packets:
+            start_time = time.time()
+            signal_stream.append_signal_packet(signal_packet)
+            append_seconds.append(time.time() - start_time)
+            
+            if signal_stream.end_timestamp >= next_cleanup_timestamp:
+                start_time = time.time()
+                signal_stream.remove_samples_before(signal_stream.end_timestamp - history_length_seconds)
+                cleanup_seconds.append(time.time() - start_time)
+                next_cleanup_timestamp += cleanup_interval
+        
+        return append_seconds, cleanup_seconds
+    
+    rows = []
+    for history_length_seconds in history_lengths:
+        capacity = int(history_length_seconds * template_packet.samplerate)
+        for name, signal_stream in [("list", ListSignalStream(template_packet)),
+                                    ("circular", SignalStream(template_packet, capacity))]:
+            append_seconds, cleanup_seconds = replay(signal_stream, history_length_seconds)
+            retained_size = get_sample_list_size(signal_stream.samples) if name == "list" else \
+                signal_stream._buffer.nbytes
+            rows.append(("%.0f s" % history_length_seconds, name,
+                         "%.2f us" % (1e6 * numpy.mean(append_seconds)),
+                         "%.3f ms" % (1e3 * numpy.percentile(cleanup_seconds, 99)),
+                         "%.3f ms" % (1e3 * max(append_seconds + cleanup_seconds)),
+                         "%d kB" % (retained_size / 1024)))
+    
+    print_table(("history", "samples", "append", "p99 cleanup", "max stall", "memory"), rows)
+
+
+def legacy_iterate_samples(signal_stream_history, from_sample_index, to_end_timestamp):
+    """SignalStreamHistory.iterate_samples() before the cursor reads, which
+    walked every retained sample of the stream on every call."""
+    from_sample_index = from_sample_index - signal_stream_history.samples_cleaned_up
+    
+    signal_stream_start_index = 0
+    for signal_stream in signal_stream_history.get_signal_streams():
+        next_signal_stream_start_index = signal_stream_start_index + len(signal_stream)
+        
+        if from_sample_index < next_signal_stream_start_index:
+            for local_sample_index, (sample_timestamp, sample) in enumerate(signal_stream.iterate_timed_samples()):
+                if signal_stream_start_index + local_sample_index < from_sample_index:
+                    continue
+                elif sample_timestamp > to_end_timestamp:
+                    break
+                
+                yield sample
+        
+        signal_stream_start_index = next_signal_stream_start_index
+
+
+def benchmark_delayed_stream_poll(history_lengths=(20.0, 120.0, 600.0), poll_count=200, delay=1.2):
+    print "Delayed stream polls of an ECG history, one packet per poll: sample index scan vs. cursor"
+    
+    parse_signal_packet = zephyr.message.MESSAGE_TYPES[0x22]
+    template_packet = parse_signal_packet(create_synthetic_payloads(88, count=1)[0])
+    packet_seconds = len(template_packet.samples) / template_packet.samplerate
+    
+    def poll(signal_stream_history, read_samples):
+        history_length_seconds = signal_stream_history.history_length_seconds
+        packet_count = int(history_length_seconds / packet_seconds)
+        for packet_i in range(packet_count):
+            signal_packet = template_packet._replace(timestamp=packet_i * packet_seconds)
+            signal_stream_history.append_signal_packet(signal_packet, packet_i == 0)
+        
+        cursor = signal_stream_history.samples_cleaned_up + len(signal_stream_history.get_signal_streams()[0])
+        cursor -= int(delay * template_packet.samplerate)
+        
+        poll_seconds = 0.0
+        for packet_i in range(packet_count, packet_count + poll_count):
+            signal_stream_history.append_signal_packet(template_packet._replace(timestamp=packet_i * packet_seconds),
+                                                       False)
+            delayed_current_time = (packet_i + 1) * packet_seconds - delay
+            
+            start_time = time.time()
+            cursor = read_samples(signal_stream_history, cursor, delayed_current_time)
+            poll_seconds += time.time() - start_time
+        
+        return poll_seconds / poll_count
+    
+    def read_indexed_samples(signal_stream_history, cursor, delayed_current_time):
+        for sample in legacy_iterate_samples(signal_stream_history, cursor, delayed_current_time): #@UnusedVariable
+            cursor += 1
+        return cursor
+    
+    def read_cursor_samples(signal_stream_history, cursor, delayed_current_time):
+        cursor, chunks = signal_stream_history.read_since(cursor, delayed_current_time)
+        for start_timestamp, samples in chunks: #@UnusedVariable
+            for sample in samples: #@UnusedVariable
+                pass
+        return cursor
+    
+    rows = []
+    for history_length_seconds in history_lengths:
+        indexed_seconds = poll(SignalStreamHistory(history_length_seconds), read_indexed_samples)
+        cursor_seconds = poll(SignalStreamHistory(history_length_seconds), read_cursor_samples)
+        rows.append(("%.0f s" % history_length_seconds,
+                     "%d" % int(history_length_seconds * template_packet.samplerate),
+                     "%.1f us" % (1e6 * indexed_seconds),
+                     "%.1f us" % (1e6 * cursor_seconds),
+                     "%.0fx" % (indexed_seconds / cursor_seconds)))
+    
+    print "%d samples per poll" % len(template_packet.samples)
+    print_table(("history", "samples", "index scan", "cursor", "speedup"), rows)
+
+
+class CountingLock:
+    def __init__(self, lock):
+        self.lock = lock
+        self.acquisition_count = 0
+    
+    def __enter__(self):
+        self.lock.acquire()
+        self.acquisition_count += 1
+    
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+def legacy_iterate_events(event_stream, from_sample_index, to_end_timestamp):
+    """EventStream.iterate_samples() before the batch reads, which took the
+    lock in len() and in every item access."""
+    sample_index = from_sample_index
+    while len(event_stream) > sample_index:
+        event_timestamp, event_value = event_stream[sample_index]
+        if event_timestamp > to_end_timestamp:
+            break
+        yield event_value
+        sample_index += 1
+
+
+def benchmark_event_stream_reads(batch_sizes=(1, 10, 100), event_count=20000):
+    print "Delayed stream reads of an event stream: indexed reads vs. read_since() batches"
+    
+    def read_events(batch_size, read_batch):
+        event_stream = EventStream()
+        event_stream.lock = CountingLock(event_stream.lock)
+        cursor = 0
+        read_acquisition_count = 0
+        
+        start_time = time.time()
+        for batch_start in range(0, event_count, batch_size):
+            for event_i in range(batch_start, batch_start + batch_size):
+                event_stream.append((event_i * 0.01, event_i))
+            
+            acquisition_count = event_stream.lock.acquisition_count
+            cursor = read_batch(event_stream, cursor, (batch_start + batch_size - 0.5) * 0.01)
+            read_acquisition_count += event_stream.lock.acquisition_count - acquisition_count
+        
+        assert cursor == event_count
+        return time.time() - start_time, read_acquisition_count
+    
+    def read_indexed_batch(event_stream, cursor, until_timestamp):
+        for event_value in legacy_iterate_events(event_stream, cursor, until_timestamp): #@UnusedVariable
+            cursor += 1
+        return cursor
+    
+    def read_batch(event_stream, cursor, until_timestamp):
+        cursor, timestamps, values = event_stream.read_since(cursor, until_timestamp) #@UnusedVariable
+        return cursor
+    
+    rows = []
+    for batch_size in batch_sizes:
+        for name, read_function in [("indexed", read_indexed_batch), ("read_since", read_batch)]:
+            seconds, acquisition_count = read_events(batch_size, read_function)
+            rows.append((batch_size, name, "%.3f" % (acquisition_count / float(event_count)),
+                         "%.2f us" % (1e6 * seconds / event_count)))
+    
+    print_table(("events per read", "reads", "lock acquisitions per event", "append and read per event"), rows)
+
+
+class ListEventStream:
+    """The EventStream storage before the timestamp array."""
+    def __init__(self):
+        self.events = []
+    
+    def append(self, value):
+        self.events.append(value)
+    
+    def clean_up_events_before(self, timestamp_lower_bound):
+        cutoff_index = 0
+        for event_timestamp, event_value in self.events: #@UnusedVariable
+            if event_timestamp < timestamp_lower_bound:
+                cutoff_index += 1
+            else:
+                break
+        
+        if cutoff_index:
+            self.events = self.events[cutoff_index:]
+    
+    def query(self, start_timestamp, end_timestamp):
+        window_events = [(event_timestamp, event_value) for event_timestamp, event_value in self.events
+                         if start_timestamp <= event_timestamp <= end_timestamp]
+        return numpy.array([event[0] for event in window_events]), numpy.array([event[1] for event in window_events])
+
+
+def benchmark_collector_queries(history_lengths=(60.0, 600.0, 3600.0), window_seconds=10.0):
+    print "Cleanup and %.0f second queries of a 4 Hz event stream and a breathing history: scans vs. binary search" % \
+        window_seconds
+    
+    rows = []
+    for history_length_seconds in history_lengths:
+        event_timestamps = numpy.arange(0.0, history_length_seconds + 5.0, 0.25)
+        
+        def fill_event_stream(event_stream):
+            for event_timestamp in event_timestamps:
+                event_stream.append((event_timestamp, 60))
+            return event_stream
+        
+        def time_cleanup(create_event_stream):
+            # a cleanup every 5 seconds removes 5 seconds of events
+            event_streams = [fill_event_stream(create_event_stream()) for stream_i in range(20)] #@UnusedVariable
+            start_time = time.time()
+            for event_stream in event_streams:
+                event_stream.clean_up_events_before(5.0)
+            return (time.time() - start_time) / len(event_streams)
+        
+        def time_query(event_stream):
+            start_timestamp = history_length_seconds / 2
+            return time_repeated(lambda: event_stream.query(start_timestamp, start_timestamp + window_seconds),
+                                 minimum_seconds=0.2)
+        
+        list_event_stream, event_stream = fill_event_stream(ListEventStream()), fill_event_stream(EventStream())
+        rows.append(("%.0f s" % history_length_seconds, "events",
+                     "%.1f us" % (1e6 * time_cleanup(ListEventStream)), "%.1f us" % (1e6 * time_cleanup(EventStream)),
+                     "%.1f us" % (1e6 * time_query(list_event_stream)), "%.1f us" % (1e6 * time_query(event_stream))))
+        
+        breathing_history = SignalStreamHistory(history_length_seconds)
+        breathing_packet = zephyr.message.SignalPacket("breathing", 0.0, 18.0, numpy.zeros(18, numpy.int16), 0)
+        for packet_i in range(int(history_length_seconds)):
+            breathing_history.append_signal_packet(breathing_packet._replace(timestamp=float(packet_i)), packet_i == 0)
+        
+        def scan_breathing_window(start_timestamp):
+            signal_stream, = breathing_history.get_signal_streams()
+            window_samples = [sample for sample_timestamp, sample in signal_stream.iterate_timed_samples()
+                              if start_timestamp <= sample_timestamp <= start_timestamp + window_seconds]
+            return numpy.array(window_samples)
+        
+        start_timestamp = history_length_seconds / 2
+        scan_seconds = time_repeated(lambda: scan_breathing_window(start_timestamp), minimum_seconds=0.2)
+        query_seconds = time_repeated(lambda: breathing_history.query(start_timestamp, start_timestamp + window_seconds),
+                                      minimum_seconds=0.2)
+        rows.append(("%.0f s" % history_length_seconds, "breathing", "", "",
+                     "%.1f us" % (1e6 * scan_seconds), "%.1f us" % (1e6 * query_seconds)))
+    
+    print_table(("history", "stream", "scan cleanup", "bisect cleanup", "scan query", "indexed query"), rows)
+
+
+def benchmark_plot_envelope(window_lengths=(6.0, 60.0, 600.0), max_points=1000):
+    print "Envelopes of %d points of ECG windows: every sample vs. min/max of the window vs. decimation pyramid" % \
+        max_points
+    
+    history_length_seconds = max(window_lengths)
+    template_packet = zephyr.message.MESSAGE_TYPES[0x22](create_synthetic_payloads(88, count=1)[0])
+    packet_seconds = len(template_packet.samples) / template_packet.samplerate
+    now = zephyr.time()
+    signal_packets = [template_packet._replace(timestamp=now - history_length_seconds + packet_i * packet_seconds)
+                      for packet_i in range(int(history_length_seconds / packet_seconds))]
+    
+    def fill_history(decimate):
+        signal_stream_history = SignalStreamHistory(history_length_seconds, decimate)
+        for packet_i, signal_packet in enumerate(signal_packets):
+            signal_stream_history.append_signal_packet(signal_packet, packet_i == 0)
+        return signal_stream_history
+    
+    raw_seconds = time_repeated(lambda: fill_history(False), minimum_seconds=1.0)
+    decimated_seconds = time_repeated(lambda: fill_history(True), minimum_seconds=1.0)
+    print "Append per packet: %.1f us without and %.1f us with the pyramid" % \
+        (1e6 * raw_seconds / len(signal_packets), 1e6 * decimated_seconds / len(signal_packets))
+    
+    raw_history, decimated_history = fill_history(False), fill_history(True)
+    end_timestamp = signal_packets[-1].timestamp
+    
+    rows = []
+    for window_length in window_lengths:
+        start_timestamp = end_timestamp - window_length
+        sample_count = len(raw_history.query(start_timestamp, end_timestamp)[1])
+        query_seconds = time_repeated(lambda: raw_history.query(start_timestamp, end_timestamp), minimum_seconds=0.2)
+        scan_seconds = time_repeated(lambda: raw_history.query_envelope(start_timestamp, end_timestamp, max_points),
+                                     minimum_seconds=0.2)
+        pyramid_seconds = time_repeated(lambda: decimated_history.query_envelope(start_timestamp, end_timestamp,
+                                                                                max_points), minimum_seconds=0.2)
+        point_count = len(decimated_history.query_envelope(start_timestamp, end_timestamp, max_points)[0])
+        rows.append(("%.0f s" % window_length, sample_count, "%.1f us" % (1e6 * query_seconds),
+                     "%.1f us" % (1e6 * scan_seconds), "%.1f us" % (1e6 * pyramid_seconds), point_count))
+    
+    print_table(("window", "samples", "all samples", "window envelope", "pyramid envelope", "points"), rows)
+
+
+def benchmark_collector_retention(session_seconds=3600.0):
+    print "Collector memory after %.0f s of ECG, RR intervals and summaries: one history length vs. retention " \
+        "by stream, and the ingest cost of the cleanup check in every call" % session_seconds
+    
+    template_packet = zephyr.message.MESSAGE_TYPES[0x22](create_synthetic_payloads(88, count=1)[0])
+    packet_seconds = len(template_packet.samples) / template_packet.samplerate
+    now = zephyr.time()
+    start_timestamp = now - session_seconds
+    signal_packets = [template_packet._replace(timestamp=start_timestamp + packet_i * packet_seconds)
+                      for packet_i in range(int(session_seconds / packet_seconds))]
+    event_timestamps = numpy.arange(start_timestamp, now, 1.0).tolist()
+    summary_stream_names = ["heart_rate", "respiration_rate", "posture", "activity", "peak_acceleration"]
+    
+    def ingest(collector, legacy_cleanup):
+        for signal_i, signal_packet in enumerate(signal_packets):
+            collector.handle_signal(signal_packet, signal_i == 0)
+            if legacy_cleanup:
+                legacy_cleanup_if_needed(collector)
+        for event_timestamp in event_timestamps:
+            collector.handle_event("heartbeat_interval", (event_timestamp, 0.8))
+            for stream_name in summary_stream_names:
+                collector.handle_event(stream_name, (event_timestamp, 60.0))
+                if legacy_cleanup:
+                    legacy_cleanup_if_needed(collector)
+    
+    def legacy_cleanup_if_needed(collector):
+        if collector.last_cleanup_time is None or collector.last_cleanup_time < zephyr.time() - 5.0:
+            collector.clean_up()
+    
+    retention_seconds = dict((stream_name, 86400.0) for stream_name in summary_stream_names)
+    retention_seconds.update({"ecg": 30.0, "heartbeat_interval": 3600.0})
+    
+    rows = []
+    for name, legacy_cleanup, collector_arguments in [
+            ("history %.0f s, cleanup on ingest" % session_seconds, True, {}),
+            ("retention by stream", False, {"retention_seconds": retention_seconds})]:
+        collector = MeasurementCollector(session_seconds, **collector_arguments)
+        with CpuTimer() as timer:
+            ingest(collector, legacy_cleanup)
+        call_count = len(signal_packets) + len(event_timestamps) * (1 + len(summary_stream_names))
+        
+        collector.clean_up(now)
+        memory_usage = collector.get_memory_usage()
+        rows.append((name, "%.1f us" % (1e6 * timer.wall_seconds / call_count),
+                     "%.0f kB" % (memory_usage["stream_bytes"]["ecg"] / 1e3),
+                     "%.0f kB" % (memory_usage["stream_bytes"]["heart_rate"] / 1e3),
+                     "%.0f kB" % (memory_usage["total_bytes"] / 1e3)))
+    
+    print_table(("collector", "per call", "ecg", "heart_rate", "total"), rows)
+
+
+def benchmark_spilled_queries(session_seconds=3600.0, retention_seconds=30.0, window_seconds=10.0,
+                              cleanup_interval=5.0):
+    print "%.0f s windows of %.0f s of ECG that spills to memory-mapped segments after %.0f s in memory" % \
+        (window_seconds, session_seconds, retention_seconds)
+    
+    template_packet = zephyr.message.MESSAGE_TYPES[0x22](create_synthetic_payloads(88, count=1)[0])
+    packet_seconds = len(template_packet.samples) / template_packet.samplerate
+    now = zephyr.time()
+    start_timestamp = now - session_seconds
+    
+    with temporary_directory() as spill_directory:
+        collector = MeasurementCollector(retention_seconds, spill_directory=spill_directory)
+        next_cleanup_timestamp = start_timestamp + cleanup_interval
+        with CpuTimer() as spill_timer:
+            for packet_i in range(int(session_seconds / packet_seconds)):
+                packet_timestamp = start_timestamp + packet_i * packet_seconds
+                collector.handle_signal(template_packet._replace(timestamp=packet_timestamp), packet_i == 0)
+                if packet_timestamp >= next_cleanup_timestamp:
+                    collector.clean_up(packet_timestamp)
+                    next_cleanup_timestamp += cleanup_interval
+        collector.clean_up(now)
+        
+        memory_usage = collector.get_memory_usage()
+        print "Ingest with spills: %.1f s for the session, %.0f kB in memory, %.0f kB of segments" % \
+            (spill_timer.wall_seconds, memory_usage["stream_bytes"]["ecg"] / 1e3,
+             memory_usage["spilled_bytes"]["ecg"] / 1e3)
+        
+        rows = []
+        for name, window_start_timestamp in [("memory", now - window_seconds - 1.0),
+                                             ("segments", start_timestamp + session_seconds / 2),
+                                             ("memory and segments", now - retention_seconds - window_seconds / 2)]:
+            window_end_timestamp = window_start_timestamp + window_seconds
+            sample_count = len(collector.query("ecg", window_start_timestamp, window_end_timestamp)[1])
+            query_seconds = time_repeated(lambda: collector.query("ecg", window_start_timestamp, window_end_timestamp),
+                                          minimum_seconds=0.2)
+            rows.append((name, sample_count, "%.1f us" % (1e6 * query_seconds)))
+        collector.close()
+    
+    print_table(("window", "samples", "query"), rows)
+
+
+def benchmark_recording_seek(window_seconds=10.0):
+    print "Reading a %.0f s window from the middle of a recording: .dat/-timing.csv vs. indexed recording" % window_seconds
+    
+    def read_legacy_window(data_path, timing_path, start_timestamp):
+        frames = []
+        frame_parser = MessageFrameParser([frames.append])
+        for chunk_timestamp, chunk_bytes in iterate_legacy_recording_chunks(data_path, timing_path):
+            if chunk_timestamp > start_timestamp + window_seconds:
+                break
+            if chunk_timestamp < start_timestamp:
+                # frames before the window still have to be parsed to stay in sync
+                frame_parser.parse_data(chunk_bytes)
+                del frames[:]
+            else:
+                frame_parser.parse_data(chunk_bytes)
+        return frames
+    
+    def read_indexed_window(recording_path, start_timestamp):
+        recording = Recording(recording_path)
+        frames = list(recording.iterate_message_frames(start_timestamp, start_timestamp + window_seconds))
+        recording.close()
+        return frames
+    
+    rows = []
+    with temporary_directory() as output_directory:
+        for data_path, timing_path in iterate_test_recordings():
+            recording_path = os.path.join(output_directory, "recording.zrec")
+            convert_legacy_recording(data_path, timing_path, recording_path)
+            
+            recording = Recording(recording_path)
+            start_timestamp = (recording.start_timestamp + recording.end_timestamp) / 2
+            recording.close()
+            
+            open_seconds = time_repeated(lambda: Recording(recording_path).close())
+            legacy_seconds = time_repeated(lambda: read_legacy_window(data_path, timing_path, start_timestamp))
+            indexed_seconds = time_repeated(lambda: read_indexed_window(recording_path, start_timestamp))
+            
+            rows.append((os.path.basename(data_path), len(read_indexed_window(recording_path, start_timestamp)),
+                         "%.1f us" % (1e6 * open_seconds),
+                         "%.2f ms" % (1e3 * legacy_seconds),
+                         "%.2f ms" % (1e3 * indexed_seconds)))
+    
+    print_table(("recording", "frames", "open", ".dat window", "indexed window"), rows)
+
+
+def create_traced_pipeline(latency_tracer):
+    collector = MeasurementCollector()
+    signal_callbacks, event_callbacks = [collector.handle_signal], [collector.handle_event]
+    frame_callbacks, data_callbacks = [], []
+    payload_parser = zephyr.message.MessagePayloadParser()
+    
+    if latency_tracer is not None:
+        signal_callbacks.append(latency_tracer.handle_signal)
+        event_callbacks.append(latency_tracer.handle_event)
+        payload_parser.subscribe(zephyr.message.SIGNAL_MESSAGE_IDS.values() + [0x2B], latency_tracer.handle_message)
+        frame_callbacks.append(latency_tracer.handle_frame)
+        data_callbacks.append(latency_tracer.handle_data)
+    
+    packet_handler = BioHarnessPacketHandler(signal_callbacks, event_callbacks)
+    packet_handler.subscribe(payload_parser)
+    frame_parser = MessageFrameParser(frame_callbacks + [payload_parser.handle_message])
+    return data_callbacks + [frame_parser.parse_data]
+
+
+def benchmark_latency_tracing(sample_intervals=(100, 10, 1), round_count=7):
+    print "Receive pipeline throughput with latency tracing of every n-th frame"
+    
+    rows = []
+    for data_path, timing_path in iterate_test_recordings():
+        chunks = read_recording_chunks(data_path, timing_path)
+        byte_count = sum(len(chunk) for chunk in chunks)
+        
+        def parse_all(sample_interval):
+            latency_tracer = LatencyTracer(sample_interval) if sample_interval is not None else None
+            callbacks = create_traced_pipeline(latency_tracer)
+            for chunk in chunks:
+                for callback in callbacks:
+                    callback(chunk)
+        
+        # the best of interleaved rounds, the differences are small compared
+        # to the noise of a busy machine
+        sample_intervals_to_run = (None,) + tuple(sample_intervals)
+        with silenced_logging():
+            rounds = [[time_repeated(lambda: parse_all(sample_interval), 0.3)
+                       for sample_interval in sample_intervals_to_run]
+                      for round_i in range(round_count)] #@UnusedVariable
+        untraced_seconds, traced_seconds = min(zip(*rounds)[0]), [min(seconds) for seconds in zip(*rounds)[1:]]
+        
+        rows.append([os.path.basename(data_path), "%.2f MB/s" % (byte_count / untraced_seconds / 1e6)] +
+                    ["%+.1f %%" % (100.0 * (seconds / untraced_seconds - 1.0)) for seconds in traced_seconds])
+    
+    print_table(["recording", "untraced"] + ["every %d" % sample_interval for sample_interval in sample_intervals],
+                rows)
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("protocol_read_modes", benchmark_protocol_read_modes),
+    ("idle_reader", benchmark_idle_reader),
+    ("command_round_trip", benchmark_command_round_trip),
+    ("devices_per_process", benchmark_devices_per_process),
+    ("device_hub", benchmark_device_hub),
+    ("frame_parsers", benchmark_frame_parsers),
+    ("frame_resync", benchmark_frame_resync),
+    ("crc_8", benchmark_crc_8),
+    ("sample_decoding", benchmark_sample_decoding),
+    ("message_parsing", benchmark_message_parsing),
+    ("lazy_samples", benchmark_lazy_samples),
+    ("payload_dispatch", benchmark_payload_dispatch),
+    ("accelerometer", benchmark_accelerometer),
+    ("signal_stream", benchmark_signal_stream),
+    ("delayed_stream_poll", benchmark_delayed_stream_poll),
+    ("event_stream_reads", benchmark_event_stream_reads),
+    ("collector_queries", benchmark_collector_queries),
+    ("plot_envelope", benchmark_plot_envelope),
+    ("collector_retention", benchmark_collector_retention),
+    ("spilled_queries", benchmark_spilled_queries),
+    ("recording_seek", benchmark_recording_seek),
+    ("latency_tracing", benchmark_latency_tracing),
+])
+
+
+def main(benchmark_names):
+    for benchmark_name in benchmark_names or BENCHMARKS.keys():
+        BENCHMARKS[benchmark_name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,6 +1,8 @@
 
 import logging
 
+import numpy
+
 import zephyr.message
 import zephyr.util
 
@@ -29,16 +31,73 @@ class BioHarnessSignalAnalysis:
 
                 self.latest_rr_value_sign = rr_value_sign
 
+
+class AccelerometerActivityAnalysis:
+    """Derives the "acceleration_activity" signal from the acceleration
+    packets: the mean vector magnitude of the acceleration without gravity,
+    in g (vector magnitude units), over every window_seconds. Gravity is the
+    mean acceleration of the window, so there is one activity count per
+    window and the signal has a samplerate of 1 / window_seconds."""
+    def __init__(self, signal_callbacks, window_seconds=1.0):
+        self.signal_callbacks = signal_callbacks
+        self.window_seconds = window_seconds
+        
+        # the acceleration samples of the window that is not complete yet
+        self.pending_samples = None
+        self.sequence_number = 0
+        self.starts_new_stream = True
+    
+    def handle_signal(self, signal_packet, starts_new_stream):
+        if signal_packet.type != "acceleration":
+            return
+        
+        if starts_new_stream or self.pending_samples is None:
+            self.pending_samples = numpy.empty((0, 3), numpy.float32)
+            self.starts_new_stream = True
+        
+        window_start_timestamp = signal_packet.timestamp - len(self.pending_samples) / float(signal_packet.samplerate)
+        samples = numpy.concatenate((self.pending_samples, signal_packet.samples))
+        
+        window_length = max(1, int(round(self.window_seconds * signal_packet.samplerate)))
+        window_count = len(samples) // window_length
+        self.pending_samples = samples[window_count * window_length:]
+        if not window_count:
+            return
+        
+        windows = samples[:window_count * window_length].reshape(window_count, window_length, 3)
+        dynamic_acceleration = windows - windows.mean(axis=1)[:, numpy.newaxis, :]
+        vector_magnitudes = numpy.sqrt(numpy.square(dynamic_acceleration).sum(axis=2))
+        activity_counts = vector_magnitudes.mean(axis=1)
+        
+        activity_samplerate = signal_packet.samplerate / float(window_length)
+        activity_packet = zephyr.message.SignalPacket("acceleration_activity", window_start_timestamp,
+                                                      activity_samplerate, activity_counts, self.sequence_number)
+        self.sequence_number = (self.sequence_number + 1) % 256
+        
+        for signal_callback in self.signal_callbacks:
+            signal_callback(activity_packet, self.starts_new_stream)
+        self.starts_new_stream = False
+
+
 class BioHarnessPacketHandler:
     def __init__(self, signal_callbacks, event_callbacks):
         self.signal_callbacks = signal_callbacks
         self.event_callbacks = event_callbacks
         
         self.sequence_numbers = {}
+        self.connection_interrupted = False
         self.clock_difference_correction = zephyr.util.ClockDifferenceEstimator()
     
+    def handle_connection_event(self, event):
+        """Protocol connection callback. The first packet of every signal
+        after a reconnect starts a new stream, even if its sequence number
+        happens to follow the last one received."""
+        if event == "disconnected":
+            self.sequence_numbers.clear()
+            self.connection_interrupted = True
+    
     def get_message_end_timestamp(self, signal_packet):
-        temporal_message_length = (len(signal_packet.samples) - 1) / signal_packet.samplerate
+        temporal_message_length = (zephyr.message.get_sample_count(signal_packet) - 1) / signal_packet.samplerate
         return signal_packet.timestamp + temporal_message_length
     
     def get_expected_sequence_number(self, packet_type):
@@ -50,38 +109,55 @@ class BioHarnessPacketHandler:
         
         return expected_sequence_number
     
+    def subscribe(self, payload_parser, signal_types=None):
+        """Subscribe to the summary messages and to the signal packets of
+        signal_types, which are all signal types by default."""
+        if signal_types is None:
+            signal_types = zephyr.message.SIGNAL_MESSAGE_IDS.keys()
+        
+        payload_parser.subscribe([zephyr.message.SIGNAL_MESSAGE_IDS[signal_type] for signal_type in signal_types],
+                                 self.handle_signal_packet)
+        payload_parser.subscribe([0x2B], self.handle_summary_message)
+    
     def handle_packet(self, packet):
         if isinstance(packet, zephyr.message.SignalPacket):
-            expected_sequence_number = self.get_expected_sequence_number(packet.type)
-            self.sequence_numbers[packet.type] = packet.sequence_number
-            
-            if expected_sequence_number is not None and expected_sequence_number != packet.sequence_number:
-                logging.warning("Invalid sequence number in stream %s: %d != %d",
-                                packet.type, expected_sequence_number,
-                                packet.sequence_number)
-                
-                starts_new_stream = True
-            else:
-                starts_new_stream = False
-            
-            
-            end_timestamp = self.get_message_end_timestamp(packet)
-            
-            corrected_end_timestamp = self.clock_difference_correction.estimate_and_correct_timestamp(end_timestamp, packet.type)
-            corrected_timestamp = packet.timestamp + corrected_end_timestamp - end_timestamp
-            
-            corrected_signal_packet = packet._replace(timestamp=corrected_timestamp)
-            
-            for signal_callback in self.signal_callbacks:
-                signal_callback(corrected_signal_packet, starts_new_stream)
-        
+            self.handle_signal_packet(packet)
         elif isinstance(packet, zephyr.message.SummaryMessage):
-            corrected_timestamp = self.clock_difference_correction.estimate_and_correct_timestamp(packet.timestamp, "bh_summary")
+            self.handle_summary_message(packet)
+    
+    def handle_signal_packet(self, packet):
+        expected_sequence_number = self.get_expected_sequence_number(packet.type)
+        self.sequence_numbers[packet.type] = packet.sequence_number
+        
+        if expected_sequence_number is None:
+            starts_new_stream = self.connection_interrupted
+        elif expected_sequence_number != packet.sequence_number:
+            logging.warning("Invalid sequence number in stream %s: %d != %d",
+                            packet.type, expected_sequence_number,
+                            packet.sequence_number)
             
-            for event_callback in self.event_callbacks:
-                event_callback("activity", (corrected_timestamp, packet.activity))
-                event_callback("heart_rate", (corrected_timestamp, packet.heart_rate))
-                event_callback("respiration_rate", (corrected_timestamp, packet.respiration_rate))
-                event_callback("posture", (corrected_timestamp, packet.posture))
-                event_callback("breathing_wave_amplitude", (corrected_timestamp, packet.breathing_wave_amplitude))
+            starts_new_stream = True
+        else:
+            starts_new_stream = False
+        
+        
+        end_timestamp = self.get_message_end_timestamp(packet)
+        
+        corrected_end_timestamp = self.clock_difference_correction.estimate_and_correct_timestamp(end_timestamp, packet.type)
+        corrected_timestamp = packet.timestamp + corrected_end_timestamp - end_timestamp
+        
+        corrected_signal_packet = packet._replace(timestamp=corrected_timestamp)
+        
+        for signal_callback in self.signal_callbacks:
+            signal_callback(corrected_signal_packet, starts_new_stream)
+    
+    def handle_summary_message(self, packet):
+        corrected_timestamp = self.clock_difference_correction.estimate_and_correct_timestamp(packet.timestamp, "bh_summary")
+        
+        for event_callback in self.event_callbacks:
+            event_callback("activity", (corrected_timestamp, packet.activity))
+            event_callback("heart_rate", (corrected_timestamp, packet.heart_rate))
+            event_callback("respiration_rate", (corrected_timestamp, packet.respiration_rate))
+            event_callback("posture", (corrected_timestamp, packet.posture))
+            event_callback("breathing_wave_amplitude", (corrected_timestamp, packet.breathing_wave_amplitude))
 
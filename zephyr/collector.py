@@ -1,23 +1,68 @@
 
+import os
+import sys
+import math
+import logging
+import tempfile
 import threading
 import collections
 
+import numpy
+
 import zephyr
+from zephyr.decimation import DecimationPyramid, compute_envelope
+from zephyr.segments import SegmentStore
 
 
 class EventStream:
-    def __init__(self):
-        self.events = []
-        self.events_cleaned_up = 0
+    """The events are (timestamp, value) pairs that are appended in the
+    order of their timestamps. The timestamps are kept in an array, so the
+    cleanup, the reads and the time range queries find their bounds with a
+    binary search. Cleaned up events are only dropped from the storage when
+    it is full, before it grows, or by compact()."""
+    def __init__(self, initial_capacity=64):
+        self.initial_capacity = initial_capacity
+        self._timestamps = numpy.empty(initial_capacity, numpy.float64)
+        self._values = []
+        # the estimated size of the value objects in the storage
+        self._value_bytes = 0
+        # the events before the start position are cleaned up, and the
+        # dropped count is the number of events removed from the storage
+        self._start_position = 0
+        self._dropped_count = 0
         self.lock = threading.RLock()
     
-    def __iter__(self):
+    @property
+    def events_cleaned_up(self):
+        return self._dropped_count + self._start_position
+    
+    @property
+    def events(self):
+        with self.lock:
+            start_position, end_position = self._start_position, len(self._values)
+            return zip(self._timestamps[start_position:end_position].tolist(), self._values[start_position:])
+    
+    @property
+    def nbytes(self):
+        """The bytes held by the storage, including the cleaned up events
+        that were not dropped yet."""
+        with self.lock:
+            return self._timestamps.nbytes + sys.getsizeof(self._values) + self._value_bytes
+    
+    @property
+    def start_timestamp(self):
+        """The timestamp of the first retained event, or None."""
         with self.lock:
-            return iter(self.events[:])
+            if self._start_position == len(self._values):
+                return None
+            return float(self._timestamps[self._start_position])
+    
+    def __iter__(self):
+        return iter(self.events)
     
     def __len__(self):
         with self.lock:
-            corrected_length = len(self.events) + self.events_cleaned_up
+            corrected_length = len(self._values) + self._dropped_count
             return corrected_length
     
     def __getitem__(self, index):
@@ -25,148 +70,608 @@ class EventStream:
             assert 0 <= index < len(self)
             assert index >= self.events_cleaned_up
             
-            corrected_index = index - self.events_cleaned_up
-            return self.events[corrected_index]
+            position = index - self._dropped_count
+            return float(self._timestamps[position]), self._values[position]
     
     def append(self, value):
+        event_timestamp, event_value = value
+        
         with self.lock:
-            self.events.append(value)
+            if len(self._values) == len(self._timestamps):
+                self._compact()
+            
+            self._timestamps[len(self._values)] = event_timestamp
+            self._values.append(event_value)
+            self._value_bytes += sys.getsizeof(event_value)
+    
+    def _compact(self):
+        """Drop the cleaned up events from the storage, and double its
+        capacity if it is still more than half full."""
+        event_count = len(self._values) - self._start_position
+        
+        capacity = len(self._timestamps)
+        if event_count * 2 > capacity:
+            capacity *= 2
+        
+        self._reallocate(capacity)
+    
+    def _reallocate(self, capacity):
+        start_position = self._start_position
+        event_count = len(self._values) - start_position
+        
+        timestamps = numpy.empty(capacity, numpy.float64)
+        timestamps[:event_count] = self._timestamps[start_position:start_position + event_count]
+        self._timestamps = timestamps
+        self._value_bytes -= sum(sys.getsizeof(value) for value in self._values[:start_position])
+        del self._values[:start_position]
+        
+        self._dropped_count += start_position
+        self._start_position = 0
+    
+    def compact(self):
+        """Drop the cleaned up events from the storage now and shrink it to
+        twice the number of retained events."""
+        with self.lock:
+            event_count = len(self._values) - self._start_position
+            capacity = max(self.initial_capacity, 2 * event_count)
+            if self._start_position or capacity < len(self._timestamps):
+                self._reallocate(capacity)
     
     def clean_up_events_before(self, timestamp_lower_bound):
         with self.lock:
-            cutoff_index = 0
+            start_position, end_position = self._start_position, len(self._values)
+            cutoff_count = self._timestamps[start_position:end_position].searchsorted(timestamp_lower_bound, "left")
+            self._start_position += int(cutoff_count)
+    
+    def read_since(self, cursor, until_timestamp):
+        """Read the events after the cursor up to until_timestamp in one
+        lock acquisition. The cursor counts all events ever appended, start
+        with 0 and pass the returned cursor to the next call. Returns the
+        cursor, the timestamps as an array and the values as a parallel list.
+        Events that were cleaned up before they were read are skipped."""
+        with self.lock:
+            from_position = max(self._start_position, cursor - self._dropped_count)
+            end_position = len(self._values)
+            to_position = from_position + int(self._timestamps[from_position:end_position].searchsorted(until_timestamp,
+                                                                                                        "right"))
             
-            for event_timestamp, event_value in self.events: #@UnusedVariable
-                if event_timestamp < timestamp_lower_bound:
-                    cutoff_index += 1
-                else:
-                    break
+            timestamps = self._timestamps[from_position:to_position].copy()
+            values = self._values[from_position:to_position]
+            cursor = max(cursor, self._dropped_count + to_position)
+        
+        return cursor, timestamps, values
+    
+    def query(self, start_timestamp, end_timestamp):
+        """The timestamps and the values of the events from start_timestamp
+        to end_timestamp as two arrays."""
+        with self.lock:
+            start_position, end_position = self._start_position, len(self._values)
+            retained_timestamps = self._timestamps[start_position:end_position]
+            from_position = start_position + int(retained_timestamps.searchsorted(start_timestamp, "left"))
+            to_position = start_position + int(retained_timestamps.searchsorted(end_timestamp, "right"))
             
-            if cutoff_index:
-                self.events = self.events[cutoff_index:]
-                self.events_cleaned_up += cutoff_index
+            timestamps = self._timestamps[from_position:to_position].copy()
+            values = self._values[from_position:to_position]
+        
+        return timestamps, numpy.array(values)
     
     def iterate_samples(self, from_sample_index, to_end_timestamp):
-        sample_index = from_sample_index
-        
-        while True:
-            if len(self) > sample_index:
-                event_timestamp, event_value = self[sample_index]
-                
-                if event_timestamp <= to_end_timestamp:
-                    yield event_value
-                    sample_index += 1
-                    continue
-            
-            break
+        cursor, timestamps, values = self.read_since(from_sample_index, to_end_timestamp) #@UnusedVariable
+        return iter(values)
 
 
 class SignalStream:
-    def __init__(self, signal_packet):
+    """The samples of one continuous stream in a circular buffer of
+    capacity samples, with the sample shape and type of the signal packet.
+    Appending a packet overwrites the oldest samples once the buffer is
+    full, and removing samples only moves the start, so neither copies the
+    history. The samples of multi-channel signals like the acceleration have
+    the shape (N, channels). With decimate the stream maintains a
+    DecimationPyramid for envelope queries of long windows.
+    
+    One thread appends, and the changes of the writer and of the cleanup
+    are serialized by the lock. read_samples() does not take the lock. The
+    writer moves the removed count past the samples before it overwrites
+    them and publishes the appended count with the end timestamp after it
+    wrote them, so a reader that checks the removed count after its copy
+    knows which samples of the copy are valid."""
+    def __init__(self, signal_packet, capacity, decimate=False, first_sequence=0):
         self.samplerate = signal_packet.samplerate
-        self.samples = []
         self.lock = threading.RLock()
+        # the index of the first sample of the stream in its history
+        self.first_sequence = first_sequence
+        
+        packet_samples = numpy.asarray(signal_packet.samples)
+        self._buffer = numpy.empty((max(1, int(capacity)),) + packet_samples.shape[1:], packet_samples.dtype)
+        # the number of samples ever appended with the end timestamp of the
+        # last of them, and the number of them that were removed or
+        # overwritten, the samples at the positions between them modulo the
+        # capacity are in the buffer
+        self._head = (0, None)
+        self._removed_count = 0
+        
+        if decimate:
+            self.pyramid = DecimationPyramid(self.capacity, packet_samples.shape[1:], packet_samples.dtype)
+        else:
+            self.pyramid = None
+        # the index of the first sample of the pyramid in the stream
+        self._pyramid_first_index = 0
+    
+    @property
+    def capacity(self):
+        return len(self._buffer)
+    
+    @property
+    def appended_count(self):
+        return self._head[0]
+    
+    @property
+    def end_timestamp(self):
+        return self._head[1]
+    
+    def __len__(self):
+        return self._head[0] - self._removed_count
+    
+    @property
+    def nbytes(self):
+        """The bytes of the samples in the buffer and of the pyramid."""
+        sample_bytes = len(self) * (self._buffer.nbytes // len(self._buffer))
+        if self.pyramid is None:
+            return sample_bytes
+        return sample_bytes + self.pyramid.nbytes
+    
+    def resize(self, capacity):
+        """Move the latest samples to a buffer of the new capacity and
+        rebuild the pyramid from them. Returns the number of samples that
+        did not fit."""
+        with self.lock:
+            capacity = max(1, int(capacity))
+            appended_count = self._head[0]
+            retained_samples = numpy.concatenate(self.get_latest_samples(capacity))
+            dropped_count = len(self) - len(retained_samples)
+            first_index = appended_count - len(retained_samples)
+            
+            buffer = numpy.empty((capacity,) + self._buffer.shape[1:], self._buffer.dtype)
+            buffer[numpy.arange(first_index, appended_count) % capacity] = retained_samples
+            # readers that still use the old buffer find its samples intact
+            self._removed_count = first_index
+            self._buffer = buffer
+            
+            if self.pyramid is not None:
+                self.pyramid = DecimationPyramid(capacity, buffer.shape[1:], buffer.dtype)
+                self.pyramid.append_samples(retained_samples)
+                self._pyramid_first_index = first_index
         
-        self.end_timestamp = None
-        self.append_signal_packet(signal_packet)
+        return dropped_count
     
     def append_signal_packet(self, signal_packet):
+        """Returns the number of old samples that were overwritten."""
         with self.lock:
             assert signal_packet.samplerate == self.samplerate
             
-            self.samples.extend(signal_packet.samples)
-            self.end_timestamp = signal_packet.timestamp + len(signal_packet.samples) / float(signal_packet.samplerate)
+            packet_samples = signal_packet.samples
+            sample_count = len(packet_samples)
+            end_timestamp = signal_packet.timestamp + sample_count / float(signal_packet.samplerate)
+            
+            appended_count = self._head[0]
+            capacity = self.capacity
+            if sample_count > capacity:
+                packet_samples = packet_samples[-capacity:]
+                write_position = (appended_count + sample_count - capacity) % capacity
+                write_count = capacity
+            else:
+                write_position = appended_count % capacity
+                write_count = sample_count
+            
+            overwritten_count = max(0, appended_count + sample_count - self._removed_count - capacity)
+            self._removed_count += overwritten_count
+            
+            if write_position + write_count <= capacity:
+                self._buffer[write_position:write_position + write_count] = packet_samples
+            else:
+                first_part_length = capacity - write_position
+                self._buffer[write_position:] = packet_samples[:first_part_length]
+                self._buffer[:write_count - first_part_length] = packet_samples[first_part_length:]
+            
+            if self.pyramid is not None:
+                self.pyramid.append_samples(numpy.asarray(signal_packet.samples))
+            
+            self._head = (appended_count + sample_count, end_timestamp)
+        
+        return overwritten_count
     
     def remove_samples_before(self, timestamp_lower_bound):
         with self.lock:
             samples_to_remove = max(0, int((timestamp_lower_bound - self.start_timestamp) * self.samplerate))
-            
-            if samples_to_remove:
-                self.samples = self.samples[samples_to_remove:]
+            samples_to_remove = min(samples_to_remove, len(self))
+            self._removed_count += samples_to_remove
         
         return samples_to_remove
     
     @property
     def start_timestamp(self):
-        return self.end_timestamp - len(self.samples) / float(self.samplerate)
+        appended_count, end_timestamp = self._head
+        return end_timestamp - (appended_count - self._removed_count) / float(self.samplerate)
     
-    def iterate_timed_samples(self):
+    def read_samples(self, from_index=0, start_timestamp=None, end_timestamp=None):
+        """Copy the samples from from_index, which counts all samples ever
+        appended to the stream, that are from start_timestamp to
+        end_timestamp, without taking the lock. Returns the index and the
+        timestamp of the first copied sample and the samples. Samples that
+        are removed or overwritten during the copy are left out."""
+        appended_count, stream_end_timestamp = self._head
+        buffer = self._buffer
+        capacity = len(buffer)
+        samplerate = self.samplerate
+        first_timestamp = stream_end_timestamp - appended_count / float(samplerate)
+        
+        to_index = appended_count
+        if end_timestamp is not None:
+            to_index = min(to_index, int(math.floor((end_timestamp - first_timestamp) * samplerate + 1e-9)) + 1)
+        if start_timestamp is not None:
+            from_index = max(from_index, int(math.ceil((start_timestamp - first_timestamp) * samplerate - 1e-9)))
+        from_index = max(from_index, self._removed_count)
+        
+        if from_index < to_index:
+            start_position = from_index % capacity
+            end_position = start_position + to_index - from_index
+            if end_position <= capacity:
+                samples = buffer[start_position:end_position].copy()
+            else:
+                samples = numpy.concatenate((buffer[start_position:], buffer[:end_position - capacity]))
+            
+            removed_count = self._removed_count
+            if removed_count > from_index:
+                samples = samples[removed_count - from_index:]
+                from_index = removed_count
+        else:
+            samples = buffer[:0].copy()
+        
+        return from_index, first_timestamp + from_index / float(samplerate), samples
+    
+    def get_sample_views(self, from_index=0, to_index=None):
+        """The samples from_index to to_index of the stream as at most two
+        views of the buffer, split where the buffer wraps around. The views
+        stay valid until the writer overwrites their samples."""
         with self.lock:
-            start_timestamp = self.start_timestamp
-            sample_period = 1.0 / self.samplerate
+            sample_count = len(self)
+            if to_index is None or to_index > sample_count:
+                to_index = sample_count
+            if from_index >= to_index:
+                return [self._buffer[:0]]
             
-            for sample_i, sample in enumerate(self.samples):
-                sample_timestamp = start_timestamp + sample_i * sample_period
-                yield sample_timestamp, sample
+            capacity = self.capacity
+            start_position = (self._removed_count + from_index) % capacity
+            view_length = to_index - from_index
+            
+            if start_position + view_length <= capacity:
+                return [self._buffer[start_position:start_position + view_length]]
+            return [self._buffer[start_position:],
+                    self._buffer[:start_position + view_length - capacity]]
+    
+    def get_latest_samples(self, sample_count):
+        with self.lock:
+            return self.get_sample_views(max(0, len(self) - sample_count))
+    
+    def get_envelope(self, start_timestamp, end_timestamp, max_points):
+        """The samples from start_timestamp to end_timestamp reduced to about
+        max_points points, as arrays of the timestamps, minimums, maximums and
+        means of the points. Short windows return the samples themselves.
+        The pyramid is read under the lock."""
+        with self.lock:
+            # the timestamp of the first sample ever appended to the stream
+            appended_count, stream_end_timestamp = self._head
+            first_timestamp = stream_end_timestamp - appended_count / float(self.samplerate)
+            from_index = int(math.ceil((start_timestamp - first_timestamp) * self.samplerate - 1e-9))
+            from_index = max(self._removed_count, from_index)
+            to_index = int(math.floor((end_timestamp - first_timestamp) * self.samplerate + 1e-9)) + 1
+            to_index = min(appended_count, to_index)
+            
+            envelope = None
+            if self.pyramid is not None and to_index > from_index:
+                pyramid_first_index = self._pyramid_first_index
+                envelope = self.pyramid.get_envelope(from_index - pyramid_first_index, to_index - pyramid_first_index,
+                                                     max_points)
+                if envelope is not None:
+                    envelope = (pyramid_first_index + envelope[0],) + envelope[1:]
+            
+            if envelope is None:
+                samples = numpy.concatenate(self.get_sample_views(from_index - self._removed_count,
+                                                                  to_index - self._removed_count))
+                if self.pyramid is not None or len(samples) <= max_points:
+                    envelope = numpy.arange(from_index, from_index + len(samples)), samples, samples, samples
+                else:
+                    sample_indices, minimums, maximums, means = compute_envelope(samples, max_points)
+                    envelope = from_index + sample_indices, minimums, maximums, means
+        
+        sample_indices, minimums, maximums, means = envelope
+        return first_timestamp + sample_indices / float(self.samplerate), minimums, maximums, means
+    
+    @property
+    def samples(self):
+        """A copy of all samples of the stream in one array."""
+        return self.read_samples()[2]
+    
+    def iterate_timed_samples(self):
+        from_index, start_timestamp, samples = self.read_samples() #@UnusedVariable
+        sample_period = 1.0 / self.samplerate
+        
+        for sample_i, sample in enumerate(samples):
+            yield start_timestamp + sample_i * sample_period, sample
 
 
 class SignalStreamHistory:
-    def __init__(self):
-        self._signal_streams = []
+    """The streams of one signal type. The latest stream keeps the samples
+    of history_length_seconds in its buffer, and the buffer of a stream
+    shrinks to its samples when a newer stream starts.
+    
+    One thread appends the signal packets, and the cleanup can run in
+    another one, their changes are serialized by the lock. The readers
+    do not take it: the streams are a tuple that is replaced rather than
+    changed, so a reader works on the snapshot it read, and every stream
+    numbers its samples from first_sequence, the number of samples that
+    were appended to the history before it, so the cursors do not depend on
+    the cleanup."""
+    def __init__(self, history_length_seconds=20.0, decimate=False):
+        self._signal_streams = ()
+        self.history_length_seconds = history_length_seconds
+        self.decimate = decimate
+        self.lock = threading.RLock()
         
+        self.samples_appended = 0
         self.samples_cleaned_up = 0
     
     def append_signal_packet(self, signal_packet, starts_new_stream):
-        if starts_new_stream or not len(self._signal_streams):
-            signal_stream = SignalStream(signal_packet)
-            self._signal_streams.append(signal_stream)
-        else:
-            signal_stream = self._signal_streams[-1]
-            signal_stream.append_signal_packet(signal_packet)
+        with self.lock:
+            starts_new_stream = starts_new_stream or not len(self._signal_streams)
+            if starts_new_stream:
+                if self._signal_streams:
+                    ended_stream = self._signal_streams[-1]
+                    ended_stream.resize(len(ended_stream))
+                
+                capacity = int(math.ceil(self.history_length_seconds * signal_packet.samplerate))
+                signal_stream = SignalStream(signal_packet, capacity, self.decimate, self.samples_appended)
+            else:
+                signal_stream = self._signal_streams[-1]
+            
+            self.samples_cleaned_up += signal_stream.append_signal_packet(signal_packet)
+            
+            # a new stream is only published once it has samples, and before
+            # the samples are counted in samples_appended
+            if starts_new_stream:
+                self._signal_streams += (signal_stream,)
+            self.samples_appended += len(signal_packet.samples)
     
     def get_signal_streams(self):
+        """A snapshot of the streams."""
         return self._signal_streams
     
+    @property
+    def nbytes(self):
+        return sum(signal_stream.nbytes for signal_stream in self._signal_streams)
+    
+    @property
+    def start_timestamp(self):
+        """The timestamp of the first sample in the history, or None."""
+        signal_streams = self._signal_streams
+        if not signal_streams:
+            return None
+        return signal_streams[0].start_timestamp
+    
+    def set_history_length(self, history_length_seconds):
+        """Resize the buffer of the latest stream to the new history length,
+        and shrink the buffers of the ended streams that are longer. The
+        samples that do not fit are cleaned up."""
+        with self.lock:
+            self.history_length_seconds = history_length_seconds
+            for signal_stream in self._signal_streams:
+                capacity = int(math.ceil(history_length_seconds * signal_stream.samplerate))
+                if capacity < signal_stream.capacity or \
+                        (signal_stream is self._signal_streams[-1] and capacity != signal_stream.capacity):
+                    self.samples_cleaned_up += signal_stream.resize(capacity)
+    
     def _cleanup_signal_stream(self, signal_stream, timestamp_bound):
         if timestamp_bound >= signal_stream.end_timestamp:
-            self._signal_streams.remove(signal_stream)
-            samples_removed = len(signal_stream.samples)
+            self._signal_streams = tuple(other_stream for other_stream in self._signal_streams
+                                         if other_stream is not signal_stream)
+            samples_removed = len(signal_stream)
         else:
             samples_removed = signal_stream.remove_samples_before(timestamp_bound)
         
         self.samples_cleaned_up += samples_removed
     
     def clean_up_samples_before(self, history_limit):
-        for signal_stream in self._signal_streams[:]:
-            first_timestamp = signal_stream.start_timestamp
+        with self.lock:
+            for signal_stream in self._signal_streams:
+                first_timestamp = signal_stream.start_timestamp
+                
+                if first_timestamp >= history_limit:
+                    break
+                
+                self._cleanup_signal_stream(signal_stream, history_limit)
+    
+    def read_since(self, cursor, until_timestamp):
+        """Read the samples after the cursor up to until_timestamp. The
+        cursor counts all samples ever appended to the history, start with
+        0 and pass the returned cursor to the next call. Returns the cursor
+        and a list of (start_timestamp, samples) with a copy of the new
+        samples of every stream, so the cost depends only on the number of
+        new samples. Samples that were cleaned up before they were read are
+        skipped."""
+        cursor, stream_chunks = self.read_stream_chunks_since(cursor, until_timestamp)
+        return cursor, [(start_timestamp, samples) for signal_stream, start_timestamp, samples in stream_chunks] #@UnusedVariable
+    
+    def read_stream_chunks_since(self, cursor, until_timestamp):
+        """read_since() with the stream of every chunk, as (signal_stream,
+        start_timestamp, samples)."""
+        chunks = []
+        # the samples before samples_appended are in the snapshot of the
+        # streams that is read after it, or in streams that were removed
+        samples_appended = self.samples_appended
+        
+        for signal_stream in self._signal_streams:
+            first_sequence = signal_stream.first_sequence
+            if cursor >= first_sequence + signal_stream.appended_count:
+                continue
             
-            if first_timestamp >= history_limit:
-                break
+            from_index, start_timestamp, samples = signal_stream.read_samples(max(0, cursor - first_sequence),
+                                                                              end_timestamp=until_timestamp)
+            if len(samples):
+                chunks.append((signal_stream, start_timestamp, samples))
+            cursor = max(cursor, first_sequence + from_index + len(samples))
             
-            self._cleanup_signal_stream(signal_stream, history_limit)
+            if cursor < first_sequence + signal_stream.appended_count:
+                return cursor, chunks
+        
+        return max(cursor, samples_appended), chunks
     
-    def iterate_samples(self, from_sample_index, to_end_timestamp):
-        from_sample_index = from_sample_index - self.samples_cleaned_up
+    def query(self, start_timestamp, end_timestamp):
+        """The timestamps and the samples from start_timestamp to
+        end_timestamp as two arrays. The sample indices of every stream are
+        computed from its start timestamp and samplerate."""
+        timestamp_chunks = []
+        sample_chunks = []
         
-        signal_stream_start_index = 0
         for signal_stream in self._signal_streams:
-            sample_count = len(signal_stream.samples)
-            next_signal_stream_start_index = signal_stream_start_index + sample_count
-            
-            if from_sample_index < next_signal_stream_start_index:
-                for local_sample_index, (sample_timestamp, sample) in enumerate(signal_stream.iterate_timed_samples()):
-                    global_sample_index = signal_stream_start_index + local_sample_index
-                    
-                    if global_sample_index < from_sample_index:
-                        continue
-                    elif sample_timestamp > to_end_timestamp:
-                        break
-                    
-                    yield sample
-            
-            signal_stream_start_index = next_signal_stream_start_index
+            from_index, chunk_start_timestamp, samples = signal_stream.read_samples(0, start_timestamp, #@UnusedVariable
+                                                                                    end_timestamp)
+            if not len(samples):
+                continue
+            
+            sample_chunks.append(samples)
+            timestamp_chunks.append(chunk_start_timestamp + numpy.arange(len(samples)) / signal_stream.samplerate)
+        
+        if not sample_chunks:
+            return numpy.empty(0), numpy.empty(0)
+        return numpy.concatenate(timestamp_chunks), numpy.concatenate(sample_chunks)
+    
+    def query_envelope(self, start_timestamp, end_timestamp, max_points):
+        """The envelope of the samples from start_timestamp to end_timestamp
+        in about max_points points, as arrays of the timestamps, minimums,
+        maximums and means of the points. The points are shared between the
+        streams in the window by their duration in it."""
+        window_streams = []
+        for signal_stream in self._signal_streams:
+            overlap_seconds = (min(end_timestamp, signal_stream.end_timestamp) -
+                               max(start_timestamp, signal_stream.start_timestamp))
+            if overlap_seconds >= 0.0:
+                window_streams.append((signal_stream, overlap_seconds))
+        
+        total_overlap_seconds = sum(overlap_seconds for signal_stream, overlap_seconds in window_streams) #@UnusedVariable
+        envelopes = []
+        for signal_stream, overlap_seconds in window_streams:
+            stream_max_points = max(1, int(max_points * overlap_seconds / total_overlap_seconds)) \
+                if total_overlap_seconds else max_points
+            envelopes.append(signal_stream.get_envelope(start_timestamp, end_timestamp, stream_max_points))
+        
+        if not envelopes:
+            return numpy.empty(0), numpy.empty(0), numpy.empty(0), numpy.empty(0)
+        return tuple(numpy.concatenate(arrays) for arrays in zip(*envelopes))
+    
+    def iterate_samples(self, from_sample_index, to_end_timestamp):
+        cursor, chunks = self.read_since(from_sample_index, to_end_timestamp) #@UnusedVariable
+        for start_timestamp, samples in chunks: #@UnusedVariable
+            for sample in samples:
+                yield sample
 
 
 class MeasurementCollector:
-    def __init__(self, history_length_seconds=20.0):
-        self._signal_stream_histories = collections.defaultdict(SignalStreamHistory)
+    """Every stream keeps the data of its retention_seconds, or of
+    history_length_seconds if it has no entry there, for example
+    {"ecg": 30.0, "heartbeat_interval": 3600.0, "heart_rate": 86400.0}.
+    clean_up() removes the older data and is meant to run on a cadence of
+    its own, from a CollectorCleanupThread or a timer of the event loop.
+    If the streams hold more than memory_budget_bytes, clean_up() lowers
+    the retention of the largest streams to fit, down to
+    minimum_retention_seconds, and it raises the lowered retention back
+    towards retention_seconds while the streams hold less than
+    memory_low_water_fraction of the budget. The signal types in
+    decimated_signal_types get decimation pyramids for query_envelope().
+    
+    With a spill_directory, clean_up() first copies the data that arrived
+    since the previous clean_up() to a SegmentStore of every stream, in a
+    new subdirectory of spill_directory for every collector, and query()
+    reads what is no longer in memory from the segments. The buffer of a
+    signal overwrites the samples that are older than its retention, so
+    the retention of a signal must be longer than the interval of the
+    cleanup for all of its samples to reach the disk. The memory budget
+    does not lower it below twice that interval."""
+    def __init__(self, history_length_seconds=20.0, decimated_signal_types=(), retention_seconds=None,
+                 memory_budget_bytes=None, minimum_retention_seconds=5.0, spill_directory=None,
+                 segment_length=65536, memory_low_water_fraction=0.8):
+        self._signal_stream_histories = {}
         self._event_streams = collections.defaultdict(EventStream)
+        self._segment_stores = {}
+        # the cursors of the data that was copied to the segment stores
+        self._spill_cursors = collections.defaultdict(int)
+        self.spill_directory = spill_directory
+        # the subdirectory of spill_directory with the segments of the collector
+        self.segment_directory = None
+        self.segment_length = segment_length
         
         self.history_length_seconds = history_length_seconds
-        self.last_cleanup_time = 0.0
+        self.decimated_signal_types = frozenset(decimated_signal_types)
+        # the configured retention, and the retention in effect, which the
+        # memory budget may have lowered
+        self.configured_retention_seconds = dict(retention_seconds or {})
+        self.retention_seconds = dict(self.configured_retention_seconds)
+        self.memory_budget_bytes = memory_budget_bytes
+        self.minimum_retention_seconds = minimum_retention_seconds
+        self.memory_low_water_fraction = memory_low_water_fraction
+        
+        self.last_cleanup_time = None
+        self.budget_eviction_count = 0
+    
+    def get_retention_seconds(self, stream_name):
+        return self.retention_seconds.get(stream_name, self.history_length_seconds)
+    
+    def get_configured_retention_seconds(self, stream_name):
+        return self.configured_retention_seconds.get(stream_name, self.history_length_seconds)
+    
+    def get_minimum_retention_seconds(self, now):
+        """minimum_retention_seconds, or twice the time since the previous
+        clean_up() if the collector spills and that is longer, so that the
+        buffers keep the samples until the next clean_up() copies them."""
+        if self.spill_directory is None or self.last_cleanup_time is None:
+            return self.minimum_retention_seconds
+        return max(self.minimum_retention_seconds, 2.0 * (now - self.last_cleanup_time))
+    
+    def get_held_seconds(self, stream_name, now):
+        """The duration of the data in memory of a stream, at most its
+        retention."""
+        if stream_name in self._signal_stream_histories:
+            start_timestamp = self._signal_stream_histories[stream_name].start_timestamp
+        else:
+            start_timestamp = self._event_streams[stream_name].start_timestamp
+        
+        retention_seconds = self.get_retention_seconds(stream_name)
+        if start_timestamp is None:
+            return retention_seconds
+        return min(retention_seconds, now - start_timestamp)
+    
+    def set_retention_seconds(self, stream_name, retention_seconds, now):
+        """Apply the retention to the data of the stream in memory. Returns
+        the bytes that the stream holds with it."""
+        self.retention_seconds[stream_name] = retention_seconds
+        
+        if stream_name in self._signal_stream_histories:
+            signal_stream_history = self._signal_stream_histories[stream_name]
+            signal_stream_history.set_history_length(retention_seconds)
+            signal_stream_history.clean_up_samples_before(now - retention_seconds)
+            return signal_stream_history.nbytes
+        
+        event_stream = self._event_streams[stream_name]
+        event_stream.clean_up_events_before(now - retention_seconds)
+        event_stream.compact()
+        return event_stream.nbytes
     
     def get_signal_stream_history(self, stream_type):
-        return self._signal_stream_histories[stream_type]
+        signal_stream_history = self._signal_stream_histories.get(stream_type)
+        if signal_stream_history is None:
+            signal_stream_history = SignalStreamHistory(self.get_retention_seconds(stream_type),
+                                                        stream_type in self.decimated_signal_types)
+            self._signal_stream_histories[stream_type] = signal_stream_history
+        return signal_stream_history
     
     def get_event_stream(self, stream_type):
         return self._event_streams[stream_type]
@@ -177,24 +682,188 @@ class MeasurementCollector:
     def iterate_event_streams(self):
         return self._event_streams.items()
     
+    def get_segment_store(self, stream_name):
+        segment_store = self._segment_stores.get(stream_name)
+        if segment_store is None:
+            if self.segment_directory is None:
+                if not os.path.isdir(self.spill_directory):
+                    os.makedirs(self.spill_directory)
+                self.segment_directory = tempfile.mkdtemp(prefix="collector-", dir=self.spill_directory)
+            segment_store = SegmentStore(self.segment_directory, stream_name, self.segment_length)
+            self._segment_stores[stream_name] = segment_store
+        return segment_store
+    
+    def query(self, stream_name, start_timestamp, end_timestamp):
+        """The timestamps and the values of a signal or event stream from
+        start_timestamp to end_timestamp as two arrays, which are empty for
+        a stream that has not received anything yet. The part of the range
+        before the data in memory is read from the segments."""
+        if stream_name in self._signal_stream_histories:
+            timestamps, values = self._signal_stream_histories[stream_name].query(start_timestamp, end_timestamp)
+        elif stream_name in self._event_streams:
+            timestamps, values = self._event_streams[stream_name].query(start_timestamp, end_timestamp)
+        else:
+            timestamps, values = numpy.empty(0), numpy.empty(0)
+        
+        segment_store = self._segment_stores.get(stream_name)
+        if segment_store is None or (len(timestamps) and timestamps[0] <= start_timestamp):
+            return timestamps, values
+        
+        spilled_data = segment_store.query(start_timestamp, end_timestamp, timestamps[0] if len(timestamps) else None)
+        if spilled_data is None:
+            return timestamps, values
+        if not len(timestamps):
+            return spilled_data
+        return numpy.concatenate((spilled_data[0], timestamps)), numpy.concatenate((spilled_data[1], values))
+    
+    def query_envelope(self, signal_type, start_timestamp, end_timestamp, max_points):
+        """The envelope of a signal from start_timestamp to end_timestamp in
+        about max_points points, see SignalStreamHistory.query_envelope()."""
+        if signal_type not in self._signal_stream_histories:
+            return numpy.empty(0), numpy.empty(0), numpy.empty(0), numpy.empty(0)
+        return self._signal_stream_histories[signal_type].query_envelope(start_timestamp, end_timestamp, max_points)
+    
     def handle_signal(self, signal_packet, starts_new_stream):
-        signal_stream_history = self._signal_stream_histories[signal_packet.type]
+        signal_stream_history = self.get_signal_stream_history(signal_packet.type)
         signal_stream_history.append_signal_packet(signal_packet, starts_new_stream)
-        self.cleanup_if_needed()
     
     def handle_event(self, stream_name, value):
         self._event_streams[stream_name].append(value)
-        self.cleanup_if_needed()
     
-    def cleanup_if_needed(self):
-        now = zephyr.time()
+    def get_stream_bytes(self):
+        """The bytes held by every stream, by stream name."""
+        stream_bytes = {}
+        for stream_name, signal_stream_history in self._signal_stream_histories.items():
+            stream_bytes[stream_name] = signal_stream_history.nbytes
+        for stream_name, event_stream in self._event_streams.items():
+            stream_bytes[stream_name] = event_stream.nbytes
+        return stream_bytes
+    
+    def get_memory_usage(self):
+        stream_bytes = self.get_stream_bytes()
+        return {"total_bytes": sum(stream_bytes.values()),
+                "budget_bytes": self.memory_budget_bytes,
+                "stream_bytes": stream_bytes,
+                "retention_seconds": dict((stream_name, self.get_retention_seconds(stream_name))
+                                          for stream_name in stream_bytes),
+                "budget_eviction_count": self.budget_eviction_count,
+                "spilled_bytes": dict((stream_name, segment_store.nbytes)
+                                      for stream_name, segment_store in self._segment_stores.items())}
+    
+    def clean_up(self, now=None):
+        """Copy the new data to the segments if the collector spills,
+        remove the data that is older than the retention of its stream,
+        then enforce the memory budget."""
+        if now is None:
+            now = zephyr.time()
+        
+        if self.spill_directory is not None:
+            self.spill(now)
+        
+        for stream_name, signal_stream_history in self._signal_stream_histories.items():
+            signal_stream_history.clean_up_samples_before(now - self.get_retention_seconds(stream_name))
+        
+        for stream_name, event_stream in self._event_streams.items():
+            event_stream.clean_up_events_before(now - self.get_retention_seconds(stream_name))
+        
+        if self.memory_budget_bytes is not None:
+            self.enforce_memory_budget(now)
+        
+        self.last_cleanup_time = now
+    
+    def spill(self, until_timestamp):
+        """Copy the data up to until_timestamp that was not copied yet to
+        the segment stores."""
+        for stream_name, signal_stream_history in self._signal_stream_histories.items():
+            cursor, stream_chunks = signal_stream_history.read_stream_chunks_since(self._spill_cursors[stream_name],
+                                                                                   until_timestamp)
+            self._spill_cursors[stream_name] = cursor
+            for signal_stream, start_timestamp, samples in stream_chunks:
+                timestamps = start_timestamp + numpy.arange(len(samples)) / signal_stream.samplerate
+                self.get_segment_store(stream_name).append(timestamps, samples)
+        
+        for stream_name, event_stream in self._event_streams.items():
+            cursor, timestamps, values = event_stream.read_since(self._spill_cursors[stream_name], until_timestamp)
+            self._spill_cursors[stream_name] = cursor
+            if len(timestamps):
+                self.get_segment_store(stream_name).append(timestamps, numpy.array(values))
+    
+    def close(self):
+        """Flush the segment stores."""
+        for segment_store in self._segment_stores.values():
+            segment_store.close()
+    
+    def enforce_memory_budget(self, now):
+        """Lower the retention of the streams that hold the most bytes
+        until they all fit in the budget. The bytes of a stream are assumed
+        to be proportional to the duration that it holds."""
+        stream_bytes = self.get_stream_bytes()
+        total_bytes = sum(stream_bytes.values())
+        excess_bytes = total_bytes - self.memory_budget_bytes
+        if total_bytes < self.memory_budget_bytes * self.memory_low_water_fraction:
+            self.restore_retention(stream_bytes, self.memory_budget_bytes * self.memory_low_water_fraction - total_bytes,
+                                   now)
+            return
         
-        if self.last_cleanup_time < now - 5.0:
-            history_limit = now - self.history_length_seconds
-            for signal_stream_history in self._signal_stream_histories.values():
-                signal_stream_history.clean_up_samples_before(history_limit)
+        minimum_retention_seconds = self.get_minimum_retention_seconds(now)
+        for stream_name in sorted(stream_bytes, key=stream_bytes.get, reverse=True):
+            if excess_bytes <= 0:
+                break
             
-            for event_stream in self._event_streams.values():
-                event_stream.clean_up_events_before(history_limit)
+            held_seconds = self.get_held_seconds(stream_name, now)
+            if held_seconds <= minimum_retention_seconds or not stream_bytes[stream_name]:
+                continue
             
-            self.last_cleanup_time = now
+            kept_fraction = max(0.0, 1.0 - float(excess_bytes) / stream_bytes[stream_name])
+            retention_seconds = max(minimum_retention_seconds, held_seconds * kept_fraction)
+            logging.warning("Memory budget of %d bytes exceeded, retention of %s lowered to %.1f seconds",
+                            self.memory_budget_bytes, stream_name, retention_seconds)
+            self.budget_eviction_count += 1
+            
+            stream_nbytes = self.set_retention_seconds(stream_name, retention_seconds, now)
+            excess_bytes -= stream_bytes[stream_name] - stream_nbytes
+    
+    def restore_retention(self, stream_bytes, free_bytes, now):
+        """Raise the lowered retention of the streams towards the configured
+        one, as far as free_bytes allow. The bytes of a stream are assumed
+        to be proportional to the duration that it holds."""
+        for stream_name in sorted(stream_bytes):
+            if free_bytes <= 0:
+                break
+            
+            retention_seconds = self.get_retention_seconds(stream_name)
+            configured_seconds = self.get_configured_retention_seconds(stream_name)
+            if retention_seconds >= configured_seconds:
+                continue
+            
+            held_seconds = self.get_held_seconds(stream_name, now)
+            bytes_per_second = float(stream_bytes[stream_name]) / held_seconds if held_seconds > 0 else 0.0
+            restored_seconds = configured_seconds
+            if bytes_per_second:
+                restored_seconds = min(configured_seconds, retention_seconds + free_bytes / bytes_per_second)
+            logging.info("Memory usage below %d bytes, retention of %s raised to %.1f seconds",
+                         self.memory_budget_bytes * self.memory_low_water_fraction, stream_name, restored_seconds)
+            
+            self.set_retention_seconds(stream_name, restored_seconds, now)
+            free_bytes -= (restored_seconds - retention_seconds) * bytes_per_second
+
+
+class CollectorCleanupThread(threading.Thread):
+    """Runs clean_up() of the collectors every interval seconds, so that
+    the threads that append to them never do."""
+    def __init__(self, collectors, interval=5.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.collectors = list(collectors)
+        self.interval = interval
+        
+        self._terminate_event = threading.Event()
+    
+    def terminate(self):
+        self._terminate_event.set()
+    
+    def run(self):
+        while not self._terminate_event.wait(self.interval):
+            for collector in self.collectors:
+                collector.clean_up()
+        logging.debug("Collector cleanup thread is out of the while loop.")
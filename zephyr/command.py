@@ -0,0 +1,213 @@
+"""Outbound commands with tracking of the device responses.
+
+The device answers every command with a frame of the same message id that
+ends in ACK or NAK instead of ETX. CommandPipeline queues the commands,
+sends everything queued in one write, matches the responses to the pending
+commands in the order they were sent and resends commands that got no
+response within the timeout."""
+
+import time
+import logging
+import threading
+import collections
+
+import numpy
+
+import zephyr.protocol
+
+
+RESPONSE_STATUSES = ("ACK", "NAK")
+
+
+class CommandFuture:
+    """Result of one command. status becomes "ACK", "NAK" or "TIMEOUT", and
+    response is the response message frame if one was received."""
+    def __init__(self, message_id, payload):
+        self.message_id = message_id
+        self.payload = payload
+        self.message_frame = zephyr.protocol.create_message_frame(message_id, payload)
+        
+        self.status = None
+        self.response = None
+        self.attempt_count = 0
+        self.submit_time = None
+        self.send_time = None
+        self.round_trip_seconds = None
+        
+        self._done_event = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+    
+    def done(self):
+        return self._done_event.is_set()
+    
+    def wait(self, timeout=None):
+        """Returns the status, or None if the command is still pending after
+        timeout seconds."""
+        self._done_event.wait(timeout)
+        return self.status
+    
+    def add_done_callback(self, callback):
+        with self._callbacks_lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+    
+    def resolve(self, status, response=None):
+        with self._callbacks_lock:
+            self.status = status
+            self.response = response
+            self._done_event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        
+        for callback in callbacks:
+            callback(self)
+
+
+class CommandPipeline:
+    """send_data(data_string) writes to the connection and returns False if
+    the connection is not available, in which case the commands stay queued
+    until the next flush(). Responses are fed in through handle_message(),
+    which is a MessageFrameParser callback.
+    
+    submit() can be called from any thread, the other methods are called
+    from the thread that owns the connection."""
+    def __init__(self, send_data, response_timeout=1.0, max_attempts=3, round_trip_history_length=1000):
+        self.send_data = send_data
+        self.response_timeout = response_timeout
+        self.max_attempts = max_attempts
+        
+        self.queued_commands = collections.deque()
+        self.pending_commands = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+        
+        self.outcome_counts = collections.Counter()
+        self.write_count = 0
+        self.round_trip_times = collections.deque(maxlen=round_trip_history_length)
+    
+    def submit(self, message_id, payload, callback=None):
+        command = CommandFuture(message_id, payload)
+        command.submit_time = time.time()
+        if callback is not None:
+            command.add_done_callback(callback)
+        
+        with self.lock:
+            self.queued_commands.append(command)
+        
+        return command
+    
+    def submit_many(self, messages):
+        commands = []
+        with self.lock:
+            for message_id, payload in messages:
+                command = CommandFuture(message_id, payload)
+                command.submit_time = time.time()
+                self.queued_commands.append(command)
+                commands.append(command)
+        
+        return commands
+    
+    def has_queued_commands(self):
+        return bool(self.queued_commands)
+    
+    def flush(self):
+        """Send all queued commands in a single write. The write happens
+        outside the lock, so that submit() does not wait for it and the
+        callbacks of a failing connection can submit commands. The commands
+        of a failed write are queued again ahead of the newer ones."""
+        with self.lock:
+            if not self.queued_commands:
+                return 0
+            commands = list(self.queued_commands)
+            self.queued_commands.clear()
+        
+        sent = False
+        try:
+            sent = self.send_data("".join(command.message_frame for command in commands))
+        finally:
+            if not sent:
+                with self.lock:
+                    self.queued_commands.extendleft(reversed(commands))
+        if not sent:
+            return 0
+        
+        with self.lock:
+            self.write_count += 1
+            
+            now = time.time()
+            for command in commands:
+                command.attempt_count += 1
+                command.send_time = now
+                self.pending_commands[command.message_id].append(command)
+                self.outcome_counts["sent"] += 1
+        
+        return len(commands)
+    
+    def handle_message(self, message_frame):
+        if message_frame.eom not in RESPONSE_STATUSES:
+            return
+        
+        with self.lock:
+            pending_commands = self.pending_commands.get(message_frame.message_id)
+            if not pending_commands:
+                logging.debug("Unexpected response to message 0x%02X", message_frame.message_id)
+                return
+            
+            command = pending_commands.popleft()
+            command.round_trip_seconds = time.time() - command.send_time
+            self.round_trip_times.append(command.round_trip_seconds)
+            self.outcome_counts[message_frame.eom] += 1
+        
+        command.resolve(message_frame.eom, message_frame)
+    
+    def get_next_deadline(self):
+        with self.lock:
+            send_times = [pending_commands[0].send_time for pending_commands in self.pending_commands.values()
+                          if pending_commands]
+        
+        if not send_times:
+            return None
+        return min(send_times) + self.response_timeout
+    
+    def check_timeouts(self):
+        """Requeue the commands that got no response in time, or resolve them
+        as timed out after max_attempts. Returns the number of requeued
+        commands, which the caller should flush."""
+        failed_commands = []
+        retry_count = 0
+        deadline = time.time() - self.response_timeout
+        
+        with self.lock:
+            for pending_commands in self.pending_commands.values():
+                while pending_commands and pending_commands[0].send_time <= deadline:
+                    command = pending_commands.popleft()
+                    
+                    if command.attempt_count < self.max_attempts:
+                        logging.info("No response to message 0x%02X, resending", command.message_id)
+                        self.queued_commands.append(command)
+                        self.outcome_counts["retried"] += 1
+                        retry_count += 1
+                    else:
+                        logging.warning("No response to message 0x%02X after %d attempts",
+                                        command.message_id, command.attempt_count)
+                        self.outcome_counts["TIMEOUT"] += 1
+                        failed_commands.append(command)
+        
+        for command in failed_commands:
+            command.resolve("TIMEOUT")
+        
+        return retry_count
+    
+    def get_round_trip_statistics(self):
+        round_trip_times = numpy.array(self.round_trip_times)
+        if not len(round_trip_times):
+            return {"count": 0}
+        
+        p50, p95, p99 = numpy.percentile(round_trip_times, [50, 95, 99])
+        return {"count": len(round_trip_times),
+                "mean": round_trip_times.mean(),
+                "p50": p50,
+                "p95": p95,
+                "p99": p99,
+                "max": round_trip_times.max()}
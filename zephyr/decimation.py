@@ -0,0 +1,277 @@
+"""Min/max/mean decimation pyramids of signal streams for long plot windows.
+
+Level k of a DecimationPyramid aggregates the samples of a stream in
+buckets of factor ** (k + 1) samples, which start at the multiples of the
+bucket length counted from the first sample of the stream. Every level
+keeps the minimum, the maximum and the sum of its completed buckets in
+circular buffers as long as the stream history. Appended samples are
+queued and merged into the levels in batches of merge_length samples, or
+before an envelope query. The first level is updated from the queued
+samples and every other level from the buckets that the level below
+completed, with a few vectorized reductions per level and batch. An
+envelope query reads one level, so its cost depends on max_points and not
+on the length of the window."""
+
+import numpy
+
+
+class DecimationLevel:
+    """Buckets of factor buckets (or samples) of the level below, which have
+    child_length samples each."""
+    def __init__(self, child_length, factor, capacity, sample_shape, dtype):
+        self.child_length = child_length
+        self.factor = factor
+        self.bucket_length = child_length * factor
+        self.capacity = max(1, int(capacity))
+        
+        self.minimums = numpy.empty((self.capacity,) + sample_shape, dtype)
+        self.maximums = numpy.empty((self.capacity,) + sample_shape, dtype)
+        self.sums = numpy.empty((self.capacity,) + sample_shape, numpy.float64)
+        self.completed_count = 0
+        
+        # the aggregate of the children of the bucket that is not complete yet
+        self.pending_count = 0
+        self.pending_minimum = None
+        self.pending_maximum = None
+        self.pending_sum = None
+    
+    def append_children(self, minimums, maximums, sums):
+        """Add completed children of the level below, or samples for the
+        first level. Returns the buckets that this adds to the level as
+        (minimums, maximums, sums)."""
+        child_count = len(minimums)
+        first_boundary = (self.factor - self.pending_count) % self.factor
+        
+        if first_boundary >= child_count and self.pending_count:
+            # the children all go into the pending bucket
+            self.pending_minimum = numpy.minimum(self.pending_minimum, minimums.min(axis=0))
+            self.pending_maximum = numpy.maximum(self.pending_maximum, maximums.max(axis=0))
+            self.pending_sum = self.pending_sum + sums.sum(axis=0)
+            self.pending_count += child_count
+            if self.pending_count == self.factor:
+                return self.complete_pending_bucket()
+            return minimums[:0], maximums[:0], sums[:0]
+        
+        segment_starts = numpy.arange(first_boundary, child_count, self.factor)
+        if not len(segment_starts) or segment_starts[0]:
+            segment_starts = numpy.concatenate(([0], segment_starts))
+        
+        bucket_minimums = numpy.minimum.reduceat(minimums, segment_starts)
+        bucket_maximums = numpy.maximum.reduceat(maximums, segment_starts)
+        bucket_sums = numpy.add.reduceat(sums, segment_starts, dtype=numpy.float64)
+        last_count = child_count - segment_starts[-1]
+        
+        if self.pending_count:
+            bucket_minimums[0] = numpy.minimum(bucket_minimums[0], self.pending_minimum)
+            bucket_maximums[0] = numpy.maximum(bucket_maximums[0], self.pending_maximum)
+            bucket_sums[0] += self.pending_sum
+            if len(segment_starts) == 1:
+                last_count += self.pending_count
+        
+        # only the last segment can be incomplete
+        if last_count == self.factor:
+            self.pending_count = 0
+            completed_bucket_count = len(segment_starts)
+        else:
+            self.pending_count = last_count
+            self.pending_minimum = bucket_minimums[-1]
+            self.pending_maximum = bucket_maximums[-1]
+            self.pending_sum = bucket_sums[-1]
+            completed_bucket_count = len(segment_starts) - 1
+        
+        completed_buckets = (bucket_minimums[:completed_bucket_count], bucket_maximums[:completed_bucket_count],
+                             bucket_sums[:completed_bucket_count])
+        self.write_buckets(*completed_buckets)
+        return completed_buckets
+    
+    def complete_pending_bucket(self):
+        completed_buckets = (numpy.array([self.pending_minimum]), numpy.array([self.pending_maximum]),
+                             numpy.array([self.pending_sum]))
+        self.pending_count = 0
+        self.write_buckets(*completed_buckets)
+        return completed_buckets
+    
+    def write_buckets(self, minimums, maximums, sums):
+        bucket_count = len(minimums)
+        if not bucket_count:
+            return
+        if bucket_count > self.capacity:
+            minimums, maximums, sums = minimums[-self.capacity:], maximums[-self.capacity:], sums[-self.capacity:]
+        
+        write_position = (self.completed_count + bucket_count - len(minimums)) % self.capacity
+        first_part_length = min(len(minimums), self.capacity - write_position)
+        for buffer, buckets in [(self.minimums, minimums), (self.maximums, maximums), (self.sums, sums)]:
+            buffer[write_position:write_position + first_part_length] = buckets[:first_part_length]
+            buffer[:len(buckets) - first_part_length] = buckets[first_part_length:]
+        
+        self.completed_count += bucket_count
+    
+    def get_buckets(self, from_bucket, to_bucket):
+        """The minimums, maximums and sums of the completed buckets from
+        from_bucket to to_bucket. Buckets that were overwritten are left out.
+        Returns the index of the first returned bucket and the three
+        arrays."""
+        from_bucket = max(from_bucket, self.completed_count - self.capacity, 0)
+        to_bucket = max(from_bucket, min(to_bucket, self.completed_count))
+        
+        positions = numpy.arange(from_bucket, to_bucket) % self.capacity
+        return from_bucket, self.minimums[positions], self.maximums[positions], self.sums[positions]
+
+
+class DecimationPyramid:
+    """The levels of a stream that keeps the last capacity samples. The
+    top level holds at most about max_top_buckets buckets."""
+    def __init__(self, capacity, sample_shape=(), dtype=numpy.float64, factor=4, max_top_buckets=64,
+                 merge_length=1024):
+        self.levels = []
+        self.sample_count = 0
+        self.merge_length = merge_length
+        
+        # the appended samples that are not in the levels yet
+        self.queued_chunks = []
+        self.queued_count = 0
+        
+        child_length = 1
+        while True:
+            bucket_length = child_length * factor
+            self.levels.append(DecimationLevel(child_length, factor, capacity // bucket_length + 2,
+                                               sample_shape, dtype))
+            if capacity // bucket_length <= max_top_buckets:
+                break
+            child_length = bucket_length
+    
+    def append_samples(self, samples):
+        if not len(samples):
+            return
+        
+        self.queued_chunks.append(samples)
+        self.queued_count += len(samples)
+        self.sample_count += len(samples)
+        
+        if self.queued_count >= self.merge_length:
+            self.merge_queued_samples()
+    
+    def merge_queued_samples(self):
+        if not self.queued_chunks:
+            return
+        
+        if len(self.queued_chunks) == 1:
+            samples = self.queued_chunks[0]
+        else:
+            samples = numpy.concatenate(self.queued_chunks)
+        self.queued_chunks = []
+        self.queued_count = 0
+        
+        children = (samples, samples, samples)
+        for level in self.levels:
+            children = level.append_children(*children)
+            if not len(children[0]):
+                break
+    
+    @property
+    def nbytes(self):
+        return sum(level.minimums.nbytes + level.maximums.nbytes + level.sums.nbytes for level in self.levels)
+    
+    def get_level(self, sample_count, max_points):
+        """The index of the finest level that needs at most max_points
+        buckets for sample_count samples, or the top level if none does, or
+        None if the samples themselves fit."""
+        if sample_count <= max_points:
+            return None
+        
+        for level_i, level in enumerate(self.levels):
+            # one more for a bucket that overlaps each end of the range
+            if sample_count // level.bucket_length + 2 <= max_points:
+                return level_i
+        return len(self.levels) - 1
+    
+    def get_pending_bucket(self, level_i):
+        """The aggregate of the incomplete bucket of a level, which is made of
+        the pending children of the level and of all levels below it."""
+        minimum = maximum = total = None
+        sample_count = 0
+        
+        for level in self.levels[:level_i + 1]:
+            if not level.pending_count:
+                continue
+            if minimum is None:
+                minimum, maximum, total = level.pending_minimum, level.pending_maximum, level.pending_sum
+            else:
+                minimum = numpy.minimum(minimum, level.pending_minimum)
+                maximum = numpy.maximum(maximum, level.pending_maximum)
+                total = total + level.pending_sum
+            sample_count += level.pending_count * level.child_length
+        
+        return minimum, maximum, total, sample_count
+    
+    def get_envelope(self, from_index, to_index, max_points):
+        """The envelope of the samples from from_index to to_index of the
+        stream for a plot of max_points points. Returns the index of the
+        first sample of every point and the minimums, maximums and means of
+        the points, or None if the samples should be plotted themselves. The
+        buckets at the ends of the range can extend past it by less than the
+        width of one point."""
+        level_i = self.get_level(to_index - from_index, max_points)
+        if level_i is None:
+            return None
+        
+        self.merge_queued_samples()
+        
+        level = self.levels[level_i]
+        bucket_length = level.bucket_length
+        from_bucket = from_index // bucket_length
+        to_bucket = (to_index + bucket_length - 1) // bucket_length
+        
+        from_bucket, minimums, maximums, sums = level.get_buckets(from_bucket, to_bucket)
+        sample_counts = numpy.full(len(minimums), bucket_length)
+        
+        if to_bucket > level.completed_count:
+            minimum, maximum, total, sample_count = self.get_pending_bucket(level_i)
+            if sample_count:
+                minimums = numpy.concatenate((minimums, [minimum]))
+                maximums = numpy.concatenate((maximums, [maximum]))
+                sums = numpy.concatenate((sums, [total]))
+                sample_counts = numpy.append(sample_counts, sample_count)
+        
+        if len(minimums) > max_points:
+            # even the top level is too fine, so its buckets are merged in
+            # groups of bucket_group_length
+            bucket_group_length = -(-len(minimums) // max_points)
+            group_starts = numpy.arange(0, len(minimums), bucket_group_length)
+            minimums = numpy.minimum.reduceat(minimums, group_starts)
+            maximums = numpy.maximum.reduceat(maximums, group_starts)
+            sums = numpy.add.reduceat(sums, group_starts)
+            sample_counts = numpy.add.reduceat(sample_counts, group_starts)
+            bucket_length *= bucket_group_length
+        
+        means = sums / sample_counts.reshape((-1,) + (1,) * (sums.ndim - 1))
+        sample_indices = from_bucket * level.bucket_length + numpy.arange(len(minimums)) * bucket_length
+        return sample_indices, minimums, maximums, means
+
+
+def compute_envelope(samples, max_points):
+    """The envelope of a window of samples without a pyramid, in buckets of
+    a power of two samples, as (sample indices, minimums, maximums, means).
+    This reads every sample of the window."""
+    bucket_length = 1
+    while len(samples) // bucket_length + 1 > max_points:
+        bucket_length *= 2
+    
+    segment_starts = numpy.arange(0, len(samples), bucket_length)
+    if not len(segment_starts):
+        return segment_starts, samples[:0], samples[:0], numpy.zeros(samples[:0].shape)
+    
+    counts = numpy.diff(numpy.append(segment_starts, len(samples)))
+    counts = counts.reshape((-1,) + (1,) * (samples.ndim - 1))
+    return (segment_starts,
+            numpy.minimum.reduceat(samples, segment_starts),
+            numpy.maximum.reduceat(samples, segment_starts),
+            numpy.add.reduceat(samples, segment_starts, dtype=numpy.float64) / counts)
+
+
+def get_envelope_curve(timestamps, minimums, maximums):
+    """The points of a curve that draws the envelope as a vertical line from
+    the minimum to the maximum at the timestamp of every point."""
+    curve_timestamps = numpy.repeat(timestamps, 2)
+    curve_values = numpy.column_stack((minimums, maximums)).reshape(-1)
+    return curve_timestamps, curve_values
@@ -1,19 +1,19 @@
 
 import threading
 import collections
-import itertools
 import time
 import logging
 
 import zephyr
 
 class DelayedRealTimeStream(threading.Thread):
-    def __init__(self, signal_collector, callbacks, default_delay, specific_delays={}):
+    def __init__(self, signal_collector, callbacks, default_delay, specific_delays={}, latency_tracer=None):
         threading.Thread.__init__(self)
         self.signal_collector = signal_collector
         self.callbacks = callbacks
         self.default_delay = default_delay
         self.specific_delays = specific_delays
+        self.latency_tracer = latency_tracer
         
         self.stream_output_positions = collections.defaultdict(lambda: 0)
         
@@ -28,19 +28,41 @@ class DelayedRealTimeStream(threading.Thread):
     def run(self):
         while not self.terminate_requested:
             now = zephyr.time()
-            all_streams = itertools.chain(self.signal_collector.iterate_signal_stream_histories(),
-                                          self.signal_collector.iterate_event_streams())
             
-            for signal_stream_name, signal_stream_history in all_streams:
+            for signal_stream_name, signal_stream_history in self.signal_collector.iterate_signal_stream_histories():
                 delay = self.specific_delays.get(signal_stream_name, self.default_delay)
                 
                 delayed_current_time = now - delay
                 
-                from_sample = self.stream_output_positions[signal_stream_name]
-                for sample in signal_stream_history.iterate_samples(from_sample, delayed_current_time):
-                    self.stream_output_positions[signal_stream_name] += 1
+                # only the samples after the cursor are read, however long the history is
+                cursor = self.stream_output_positions[signal_stream_name]
+                cursor, sample_chunks = signal_stream_history.read_since(cursor, delayed_current_time)
+                self.stream_output_positions[signal_stream_name] = cursor
+                
+                for start_timestamp, samples in sample_chunks: #@UnusedVariable
+                    for sample in samples:
+                        for callback in self.callbacks:
+                            callback(signal_stream_name, sample)
+                
+                if self.latency_tracer is not None:
+                    self.latency_tracer.handle_stream_output(signal_stream_name, delayed_current_time, delay)
+            
+            for signal_stream_name, signal_stream_history in self.signal_collector.iterate_event_streams():
+                delay = self.specific_delays.get(signal_stream_name, self.default_delay)
+                
+                delayed_current_time = now - delay
+                
+                # a batch of events in one lock acquisition of the stream
+                cursor = self.stream_output_positions[signal_stream_name]
+                cursor, timestamps, values = signal_stream_history.read_since(cursor, delayed_current_time) #@UnusedVariable
+                self.stream_output_positions[signal_stream_name] = cursor
+                
+                for value in values:
                     for callback in self.callbacks:
-                        callback(signal_stream_name, sample)
+                        callback(signal_stream_name, value)
+                
+                if self.latency_tracer is not None:
+                    self.latency_tracer.handle_stream_output(signal_stream_name, delayed_current_time, delay)
             
             time.sleep(0.01)
         logging.debug("Delayed Stream Thread is out of the while loop.")
@@ -0,0 +1,163 @@
+"""Supervision of many devices from one process. Every device gets its own
+parser state, packet handler and collector, but all of their connections
+are served by the single thread of one EventLoop, which also cleans up the
+collectors on a timer."""
+
+import threading
+import collections
+
+import zephyr
+from zephyr.async_protocol import EventLoop, AsyncBioHarnessProtocol
+from zephyr.bioharness import AccelerometerActivityAnalysis, BioHarnessSignalAnalysis, BioHarnessPacketHandler
+from zephyr.collector import MeasurementCollector
+from zephyr.message import MessagePayloadParser
+from zephyr.protocol import MessageFrameParser
+
+
+class DeviceStatistics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        
+        self.byte_count = 0
+        self.chunk_count = 0
+        self.frame_count = 0
+        self.message_counts = collections.Counter()
+        self.first_receive_time = None
+        self.last_receive_time = None
+    
+    def handle_data(self, data_string):
+        now = zephyr.time()
+        
+        with self.lock:
+            self.byte_count += len(data_string)
+            self.chunk_count += 1
+            if self.first_receive_time is None:
+                self.first_receive_time = now
+            self.last_receive_time = now
+    
+    def handle_frame(self, message_frame):
+        with self.lock:
+            self.frame_count += 1
+            self.message_counts[message_frame.message_id] += 1
+    
+    def get_snapshot(self):
+        with self.lock:
+            return {"byte_count": self.byte_count,
+                    "chunk_count": self.chunk_count,
+                    "frame_count": self.frame_count,
+                    "message_counts": dict(self.message_counts),
+                    "first_receive_time": self.first_receive_time,
+                    "last_receive_time": self.last_receive_time}
+
+
+class HubDevice:
+    """The receive pipeline of one device, from the connection to the
+    MeasurementCollector. message_callbacks receive all parsed messages
+    of this device in the event loop thread, so with message_callbacks
+    every frame is parsed. Callbacks that need only some message types
+    should subscribe to payload_parser instead."""
+    def __init__(self, name, event_loop, connector, message_callbacks=(), history_length_seconds=20.0,
+                 retention_seconds=None, memory_budget_bytes=None):
+        self.name = name
+        self.statistics = DeviceStatistics()
+        self.collector = MeasurementCollector(history_length_seconds, retention_seconds=retention_seconds,
+                                              memory_budget_bytes=memory_budget_bytes)
+        
+        rr_signal_analysis = BioHarnessSignalAnalysis([], [self.collector.handle_event])
+        activity_analysis = AccelerometerActivityAnalysis([self.collector.handle_signal])
+        self.packet_handler = BioHarnessPacketHandler([self.collector.handle_signal, rr_signal_analysis.handle_signal,
+                                                       activity_analysis.handle_signal],
+                                                      [self.collector.handle_event])
+        
+        self.payload_parser = MessagePayloadParser(list(message_callbacks))
+        self.packet_handler.subscribe(self.payload_parser)
+        self.frame_parser = MessageFrameParser([self.statistics.handle_frame, self.payload_parser.handle_message])
+        
+        self.protocol = AsyncBioHarnessProtocol(event_loop, connector,
+                                                [self.statistics.handle_data, self.frame_parser.parse_data],
+                                                connection_callbacks=[self.packet_handler.handle_connection_event])
+        self.frame_parser.callbacks.append(self.protocol.commands.handle_message)
+    
+    @property
+    def connected(self):
+        return self.protocol.connected
+    
+    def get_statistics(self):
+        statistics = self.statistics.get_snapshot()
+        statistics["connected"] = self.connected
+        statistics["error_counts"] = dict(self.frame_parser.error_counts)
+        statistics["discarded_byte_counts"] = dict(self.frame_parser.discarded_byte_counts)
+        statistics["command_counts"] = dict(self.protocol.commands.outcome_counts)
+        statistics["command_round_trip"] = self.protocol.commands.get_round_trip_statistics()
+        statistics["reconnect"] = self.protocol.reconnect_backoff.get_statistics()
+        statistics["memory"] = self.collector.get_memory_usage()
+        return statistics
+
+
+class DeviceHub:
+    """Devices can be added and removed from any thread, before or after
+    start(). The retention_seconds and the memory_budget_bytes apply to the
+    collector of every device, see MeasurementCollector."""
+    def __init__(self, history_length_seconds=20.0, retention_seconds=None, memory_budget_bytes=None,
+                 cleanup_interval=5.0):
+        self.history_length_seconds = history_length_seconds
+        self.retention_seconds = retention_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+        self.cleanup_interval = cleanup_interval
+        self.event_loop = EventLoop()
+        
+        self.devices = collections.OrderedDict()
+        self.devices_lock = threading.Lock()
+    
+    def add_device(self, name, connector, message_callbacks=(), enable_periodic_packets=True):
+        device = HubDevice(name, self.event_loop, connector, message_callbacks, self.history_length_seconds,
+                           self.retention_seconds, self.memory_budget_bytes)
+        
+        with self.devices_lock:
+            if name in self.devices:
+                raise ValueError("Device %s is already in the hub" % name)
+            self.devices[name] = device
+        
+        if enable_periodic_packets:
+            device.protocol.enable_periodic_packets()
+        device.protocol.start()
+        
+        return device
+    
+    def remove_device(self, name):
+        with self.devices_lock:
+            device = self.devices.pop(name)
+        
+        device.protocol.terminate()
+        return device
+    
+    def get_device(self, name):
+        with self.devices_lock:
+            return self.devices[name]
+    
+    def get_devices(self):
+        with self.devices_lock:
+            return self.devices.values()
+    
+    def get_statistics(self):
+        return collections.OrderedDict((device.name, device.get_statistics()) for device in self.get_devices())
+    
+    def clean_up_collectors(self):
+        for device in self.get_devices():
+            device.collector.clean_up()
+        
+        if not self.event_loop.terminated:
+            self.event_loop.call_later(self.cleanup_interval, self.clean_up_collectors)
+    
+    def start(self):
+        self.event_loop.call_later(self.cleanup_interval, self.clean_up_collectors)
+        self.event_loop.start()
+    
+    def terminate(self):
+        for device in self.get_devices():
+            device.protocol.terminate()
+        
+        self.event_loop.terminate()
+    
+    def join(self, timeout=None):
+        self.event_loop.join(timeout)
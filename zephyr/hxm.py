@@ -86,21 +86,27 @@ class HxMPacketAnalysis:
         self.event_callbacks = event_callbacks
         self.heartbeat_analysis = RelativeHeartbeatTimestampAnalysis()
     
+    def subscribe(self, payload_parser):
+        payload_parser.subscribe([0x26], self.handle_hxm_message)
+    
     def handle_packet(self, packet):
         if isinstance(packet, zephyr.message.HxMMessage):
-            current_timestamp = zephyr.time()
-            
-            try:
-                results = list(self.heartbeat_analysis.process(packet))
-            except CalculationHistoryOverflow:
-                self.heartbeat_analysis = RelativeHeartbeatTimestampAnalysis()
-                results = list(self.heartbeat_analysis.process(packet))
-            
-            for timestamp, heartbeat_interval in results:
-                for event_callback in self.event_callbacks:
-                    event_callback("heartbeat_interval", (timestamp, heartbeat_interval))
-            
+            self.handle_hxm_message(packet)
+    
+    def handle_hxm_message(self, packet):
+        current_timestamp = zephyr.time()
+        
+        try:
+            results = list(self.heartbeat_analysis.process(packet))
+        except CalculationHistoryOverflow:
+            self.heartbeat_analysis = RelativeHeartbeatTimestampAnalysis()
+            results = list(self.heartbeat_analysis.process(packet))
+        
+        for timestamp, heartbeat_interval in results:
             for event_callback in self.event_callbacks:
-                event_callback("heart_rate", (current_timestamp, packet.heart_rate))
-                event_callback("activity", (current_timestamp, packet.speed / 3.0))
-                event_callback("strides", (current_timestamp, packet.strides))
+                event_callback("heartbeat_interval", (timestamp, heartbeat_interval))
+        
+        for event_callback in self.event_callbacks:
+            event_callback("heart_rate", (current_timestamp, packet.heart_rate))
+            event_callback("activity", (current_timestamp, packet.speed / 3.0))
+            event_callback("strides", (current_timestamp, packet.strides))
@@ -1,6 +1,9 @@
 
+import struct
 import collections
 
+import numpy
+
 import zephyr.util
 
 
@@ -18,6 +21,99 @@ SummaryMessage = collections.namedtuple("SummaryMessage",
 SignalPacket = collections.namedtuple("SignalPacket", ["type", "timestamp", "samplerate",
                                                        "samples", "sequence_number"])
 
+
+class LazySignalPacket(SignalPacket):
+    """SignalPacket that keeps the payload and decodes the samples when they
+    are first accessed, so that callbacks that only use the header, or only
+    record the frames, do not pay for the decoding. The samples are decoded
+    from a NumPy view of the payload, without copying the signal bytes.
+    
+    sample_count is known without decoding. _replace() keeps the packet lazy
+    unless it replaces the samples.
+    
+    The samples field of the tuple itself stays None, so code that reads
+    the tuple directly, like f(*packet) or "%s" % packet, does not see the
+    samples. decode() returns a plain SignalPacket, and MessagePayloadParser
+    only delivers lazy packets to subscribers that asked for the headers
+    only."""
+    def __new__(cls, type, timestamp, samplerate, sequence_number, payload, sample_parser, sample_counter): #@ReservedAssignment
+        signal_packet = tuple.__new__(cls, (type, timestamp, samplerate, None, sequence_number))
+        signal_packet.__dict__.update(_payload=payload, _sample_parser=sample_parser,
+                                      _sample_counter=sample_counter, _samples=None)
+        return signal_packet
+    
+    @property
+    def samples(self):
+        samples = self._samples
+        if samples is None:
+            signal_bytes = zephyr.util.as_byte_array(self._payload)[SIGNAL_PACKET_HEADER_LENGTH:]
+            samples = self._samples = self._sample_parser(signal_bytes)
+        return samples
+    
+    @property
+    def sample_count(self):
+        if self._samples is not None:
+            return len(self._samples)
+        return self._sample_counter(len(self._payload) - SIGNAL_PACKET_HEADER_LENGTH)
+    
+    def __iter__(self):
+        signal_type, timestamp, samplerate, samples, sequence_number = tuple.__iter__(self) #@UnusedVariable
+        return iter((signal_type, timestamp, samplerate, self.samples, sequence_number))
+    
+    def __getitem__(self, index):
+        # the field properties of the namedtuple get the fields by index
+        if index in (3, -2):
+            return self.samples
+        elif isinstance(index, slice):
+            return tuple(self)[index]
+        return tuple.__getitem__(self, index)
+    
+    def __getslice__(self, start, end):
+        return tuple(self)[start:end]
+    
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash(tuple(self))
+    
+    def __repr__(self):
+        return repr(self.decode())
+    
+    def __reduce__(self):
+        return (SignalPacket, tuple(self))
+    
+    def _asdict(self):
+        return self.decode()._asdict()
+    
+    def decode(self):
+        """The packet as a SignalPacket with the decoded samples."""
+        # iter() decodes the samples, unlike SignalPacket(*self)
+        return SignalPacket._make(iter(self))
+    
+    def _replace(self, **fields):
+        if "samples" in fields:
+            return self.decode()._replace(**fields)
+        
+        signal_packet = LazySignalPacket(fields.pop("type", self.type), fields.pop("timestamp", self.timestamp),
+                                         fields.pop("samplerate", self.samplerate),
+                                         fields.pop("sequence_number", self.sequence_number),
+                                         self._payload, self._sample_parser, self._sample_counter)
+        if fields:
+            raise ValueError("Got unexpected field names: %r" % fields.keys())
+        
+        signal_packet._samples = self._samples
+        return signal_packet
+
+
+def get_sample_count(signal_packet):
+    if isinstance(signal_packet, LazySignalPacket):
+        return signal_packet.sample_count
+    return len(signal_packet.samples)
+
 BatteryStatus = collections.namedtuple("BatteryStatus",["Voltage", "Charge"])
 
 SerialNumber = collections.namedtuple("SerialNumber",["Number"])
@@ -45,60 +141,65 @@ SerialNumber = collections.namedtuple("SerialNumber",["Number"])
 #Reserved
 #Reserved
 
+HXM_MESSAGE_STRUCT = struct.Struct("<9xBB15H6x3H")
+
 def parse_hxm_message(payload):
-    heart_rate, heartbeat_number = payload[9:11]
-    
-    heartbeat_timestamp_bytes = payload[11:41]
-    
-    movement_data_bytes = payload[47:53]
+    fields = zephyr.util.unpack_payload(HXM_MESSAGE_STRUCT, payload)
     
-    distance, speed, strides = tuple(zephyr.util.parse_uint16_values_from_bytes(movement_data_bytes))
+    heart_rate, heartbeat_number = fields[:2]
+    heartbeat_milliseconds = list(fields[2:17])
+    distance, speed, strides = fields[17:]
     
     distance = distance / 16.0
     speed = speed / 256.0
     
-    heartbeat_milliseconds = list(zephyr.util.parse_uint16_values_from_bytes(heartbeat_timestamp_bytes))
-    
-    hxm_message = HxMMessage(heart_rate=heart_rate, heartbeat_number=heartbeat_number,
-                             heartbeat_milliseconds=heartbeat_milliseconds, distance=distance,
-                             speed=speed, strides=strides)
+    # tuple.__new__() skips the keyword handling of the namedtuple __new__()
+    hxm_message = tuple.__new__(HxMMessage, (heart_rate, heartbeat_number, heartbeat_milliseconds,
+                                             distance, speed, strides))
     return hxm_message
 
 
+# sequence number, timestamp, the uint16 values at bytes 10-21 and 25, and
+# the confidences at bytes 29 and 34
+SUMMARY_PACKET_STRUCT = struct.Struct("<BHBBIx6H3xH2xB4xB")
+
 def parse_summary_packet(payload):
-    sequence_number = payload[0]
+    (sequence_number, year, month, day, day_milliseconds,
+     heart_rate, respiration_rate, skin_temperature, posture, activity,
+     peak_acceleration, breathing_wave_amplitude,
+     breathing_confidence, heart_rate_confidence) = \
+        zephyr.util.unpack_payload(SUMMARY_PACKET_STRUCT, payload)
     
-    timestamp = zephyr.util.parse_timestamp(payload[1:9])
-    
-    (heart_rate, respiration_rate, skin_temperature, posture, activity,
-     peak_acceleration, breathing_wave_amplitude) = \
-        zephyr.util.parse_uint16_values_from_byte_sequence([10, 12, 14, 16, 18, 20, 25], payload)
+    timestamp = zephyr.util.get_timestamp(year, month, day, day_milliseconds)
     
     respiration_rate *= 0.1
     skin_temperature *= 0.1
     activity *= 0.01
     peak_acceleration *= 0.01
     
-    breathing_confidence = payload[29]
-    heart_rate_confidence = payload[34]
-    
-    message = SummaryMessage(sequence_number, timestamp, heart_rate,
-                             respiration_rate, skin_temperature,
-                             posture, activity, peak_acceleration,
-                             breathing_wave_amplitude, breathing_confidence,
-                             heart_rate_confidence)
+    message = tuple.__new__(SummaryMessage, (sequence_number, timestamp, heart_rate,
+                                             respiration_rate, skin_temperature,
+                                             posture, activity, peak_acceleration,
+                                             breathing_wave_amplitude, breathing_confidence,
+                                             heart_rate_confidence))
     
     return message
 
 
-def signal_packet_payload_parser_factory(sample_parser, signal_code, samplerate):
+def signal_packet_payload_parser_factory(sample_parser, signal_code, samplerate, sample_counter=None):
+    """Without a sample_counter, which returns the number of samples in a
+    number of signal bytes, the samples are decoded right away."""
     def parse_signal_packet(payload):
-        sequence_number = payload[0]
-        timestamp_bytes = payload[1:9]
-        signal_bytes = payload[9:]
+        sequence_number, year, month, day, day_milliseconds = \
+            zephyr.util.unpack_payload(SIGNAL_PACKET_HEADER_STRUCT, payload)
         
-        message_timestamp = zephyr.util.parse_timestamp(timestamp_bytes)
-        samples = sample_parser(signal_bytes)
+        message_timestamp = zephyr.util.get_timestamp(year, month, day, day_milliseconds)
+        
+        if sample_counter is not None:
+            return LazySignalPacket(signal_code, message_timestamp, samplerate, sequence_number,
+                                    payload, sample_parser, sample_counter)
+        
+        samples = sample_parser(payload[SIGNAL_PACKET_HEADER_LENGTH:])
         
         signal_packet = zephyr.message.SignalPacket(signal_code, message_timestamp, samplerate, samples, sequence_number)
         return signal_packet
@@ -106,35 +207,56 @@ def signal_packet_payload_parser_factory(sample_parser, signal_code, samplerate)
     return parse_signal_packet
 
 
+# The sequence number and timestamp at the start of signal packets
+SIGNAL_PACKET_HEADER_STRUCT = struct.Struct("<BHBBI")
+SIGNAL_PACKET_HEADER_LENGTH = SIGNAL_PACKET_HEADER_STRUCT.size
+
+
+def parse_signal_packet_sample_batch(payloads, sample_parser):
+    """Decode the samples of equally long signal packet payloads of one type
+    into a 2-D array with one row per packet."""
+    signal_bytes = zephyr.util.stack_payloads(payloads)[:, SIGNAL_PACKET_HEADER_LENGTH:]
+    return sample_parser(signal_bytes)
+
+
+def count_10_bit_samples(byte_count):
+    return byte_count * 8 // 10
+
+
+def count_16_bit_samples(byte_count):
+    return byte_count // 2
+
+
+def count_accelerometer_samples(byte_count):
+    return count_10_bit_samples(byte_count) // 3
+
+
 def parse_10_bit_samples(signal_bytes):
-    samples = zephyr.util.unpack_bit_packed_values(signal_bytes, 10, False)
-    samples = [value - 512 for value in samples]
-    return samples
+    return zephyr.util.decode_bit_packed_samples(signal_bytes, 10, False, offset=-512, dtype=numpy.int16)
 
 
 def parse_16_bit_samples(signal_bytes):
-    samples = zephyr.util.unpack_bit_packed_values(signal_bytes, 16, True)
-    samples = [value * 0.001 for value in samples]
-    return samples
+    return zephyr.util.decode_bit_packed_samples(signal_bytes, 16, True, scale=0.001)
+
 
+# 83 correspond to one g in the 14-bit acceleration
+# signal, and this of 1/4 of that
+ACCELEROMETER_ONE_G_VALUE = numpy.float32(20.75)
 
 def parse_accelerometer_samples(signal_bytes):
+    """Returns the X, Y and Z acceleration in g as a contiguous float32
+    array of shape (N, 3)."""
     interleaved_samples = parse_10_bit_samples(signal_bytes)
     
-    # 83 correspond to one g in the 14-bit acceleration
-    # signal, and this of 1/4 of that
-    one_g_value = 20.75
-    interleaved_samples = [value / one_g_value for value in interleaved_samples]
-    
-    samples = zip(interleaved_samples[0::3],
-                        interleaved_samples[1::3],
-                        interleaved_samples[2::3])
+    sample_count = len(interleaved_samples) // 3
+    samples = interleaved_samples[:sample_count * 3].reshape(sample_count, 3).astype(numpy.float32)
+    samples /= ACCELEROMETER_ONE_G_VALUE
     return samples
 
+BATTERY_STATUS_STRUCT = struct.Struct("<HB")
+
 def parse_battery_status(payload):
-    voltage = zephyr.util.uint16_from_two_bytes((payload[0],payload[1]))
-    charge = payload[2]
-    return BatteryStatus(voltage, charge)
+    return tuple.__new__(BatteryStatus, zephyr.util.unpack_payload(BATTERY_STATUS_STRUCT, payload))
 
 def parse_serial_number(payload):
     number = str(bytearray(payload[0:11]))
@@ -142,22 +264,75 @@ def parse_serial_number(payload):
 
 
 class MessagePayloadParser:
-    def __init__(self, callbacks):
-        self.callbacks = callbacks
+    """The callbacks receive every message. Callbacks that subscribe() to
+    message ids receive only the messages with those ids, and the payload
+    of a frame is only parsed if some callback receives the message.
+    
+    Signal packets are delivered with their samples decoded, unless all
+    the callbacks that receive them subscribed with header_only, in which
+    case they get a LazySignalPacket."""
+    def __init__(self, callbacks=None):
+        self.callbacks = callbacks if callbacks is not None else []
+        self.subscriptions = {}
+        self.header_only_subscriptions = {}
+    
+    def subscribe(self, message_ids, callback, header_only=False):
+        for message_id in message_ids:
+            if message_id not in MESSAGE_TYPES:
+                raise ValueError("Unknown message id 0x%02X" % message_id)
+            
+            # handle_message() may be iterating over the old list
+            self.subscriptions[message_id] = self.subscriptions.get(message_id, []) + [callback]
+            if header_only:
+                self.header_only_subscriptions[message_id] = \
+                    self.header_only_subscriptions.get(message_id, []) + [callback]
+    
+    def unsubscribe(self, message_ids, callback):
+        for subscriptions in (self.subscriptions, self.header_only_subscriptions):
+            for message_id in message_ids:
+                subscribers = [subscriber for subscriber in subscriptions.get(message_id, [])
+                               if subscriber != callback]
+                if subscribers:
+                    subscriptions[message_id] = subscribers
+                else:
+                    subscriptions.pop(message_id, None)
     
     def handle_message(self, message_frame):
+        subscribers = self.subscriptions.get(message_frame.message_id)
+        if subscribers is None and not self.callbacks:
+            return
+        
         handler = MESSAGE_TYPES.get(message_frame.message_id)
         if handler is not None:
             message = handler(message_frame.payload)
+            if isinstance(message, LazySignalPacket) and \
+                    (self.callbacks or
+                     len(subscribers) > len(self.header_only_subscriptions.get(message_frame.message_id, ()))):
+                message = message.decode()
+            
             for callback in self.callbacks:
                 callback(message)
+            
+            if subscribers is not None:
+                for callback in subscribers:
+                    callback(message)
+
 
+# Message ids of the signal packets by signal type
+SIGNAL_MESSAGE_IDS = collections.OrderedDict([("breathing", 0x21),
+                                              ("ecg", 0x22),
+                                              ("rr", 0x24),
+                                              ("acceleration", 0x25)])
 
 MESSAGE_TYPES = {0x2B: parse_summary_packet,
-                 0x21: signal_packet_payload_parser_factory(parse_10_bit_samples, "breathing", 18.0),
-                 0x22: signal_packet_payload_parser_factory(parse_10_bit_samples, "ecg", 250.0),
-                 0x24: signal_packet_payload_parser_factory(parse_16_bit_samples, "rr", 18.0),
-                 0x25: signal_packet_payload_parser_factory(parse_accelerometer_samples, "acceleration", 50.0),
+                 0x21: signal_packet_payload_parser_factory(parse_10_bit_samples, "breathing", 18.0,
+                                                            count_10_bit_samples),
+                 0x22: signal_packet_payload_parser_factory(parse_10_bit_samples, "ecg", 250.0,
+                                                            count_10_bit_samples),
+                 0x24: signal_packet_payload_parser_factory(parse_16_bit_samples, "rr", 18.0,
+                                                            count_16_bit_samples),
+                 0x25: signal_packet_payload_parser_factory(parse_accelerometer_samples, "acceleration", 50.0,
+                                                            count_accelerometer_samples),
                  0x26: parse_hxm_message,
                  0xAC: parse_battery_status,
                  0x0B: parse_serial_number}
\ No newline at end of file
@@ -1,101 +1,444 @@
 
+import os
 import time
+import errno
+import random
+import select
 import logging
 import threading
+import collections
+
+import serial
 
 import zephyr.util
+import zephyr.command
+
+if os.name == "posix":
+    import fcntl
 
 
 class MessageDataLogger:
-    def __init__(self, log_file_basepath):
+    """Records the received byte stream to <basepath>.dat and the arrival
+    times of the data to <basepath>-timing.csv. Both files are kept open
+    and flushed once flush_bytes have been written or flush_interval
+    seconds have passed. The recording continues in a new pair of files
+    named <basepath>-001, <basepath>-002, ... whenever the data file
+    reaches max_file_bytes or max_file_seconds."""
+    def __init__(self, log_file_basepath, flush_bytes=64 * 1024, flush_interval=1.0, fsync=False,
+                 max_file_bytes=None, max_file_seconds=None):
         self.log_file_basepath = log_file_basepath
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_file_bytes = max_file_bytes
+        self.max_file_seconds = max_file_seconds
+        
+        self.file_index = 0
+        self.data_file = None
+        self.timing_file = None
         self.data_file_position = 0
+        # the data file position of the latest timing row
+        self.timed_position = 0
         self.time_before = None
+        
+        self.file_start_time = None
+        self.last_flush_time = None
+        self.bytes_since_flush = 0
+    
+    def get_file_basepath(self):
+        if self.file_index == 0:
+            return self.log_file_basepath
+        else:
+            return "%s-%03d" % (self.log_file_basepath, self.file_index)
+    
+    def open_files(self, now):
+        file_basepath = self.get_file_basepath()
+        self.data_file = open(file_basepath + ".dat", "ab", self.flush_bytes)
+        self.timing_file = open(file_basepath + "-timing.csv", "a")
+        
+        self.data_file.seek(0, os.SEEK_END)
+        self.data_file_position = self.timed_position = self.data_file.tell()
+        
+        self.file_start_time = now
+        self.last_flush_time = now
+    
+    def flush(self, now):
+        for log_file in (self.timing_file, self.data_file):
+            log_file.flush()
+            if self.fsync:
+                os.fsync(log_file.fileno())
+        
+        self.last_flush_time = now
+        self.bytes_since_flush = 0
+    
+    def write_timing_row(self):
+        """Record the arrival time of the data written since the latest
+        timing row, which is the time of the latest write."""
+        if self.data_file_position > self.timed_position:
+            self.timing_file.write("%s,%s\n" % (self.time_before, self.data_file_position))
+            self.timed_position = self.data_file_position
+    
+    def close(self):
+        if self.data_file is not None:
+            self.write_timing_row()
+            self.flush(zephyr.time())
+            self.data_file.close()
+            self.timing_file.close()
+            self.data_file = self.timing_file = None
+    
+    def rotation_due(self, now):
+        if self.max_file_bytes is not None and self.data_file_position >= self.max_file_bytes:
+            return True
+        elif self.max_file_seconds is not None and now - self.file_start_time >= self.max_file_seconds:
+            return True
+        else:
+            return False
+    
+    def rotate(self, now):
+        self.close()
+        self.file_index += 1
+        self.open_files(now)
+        logging.info("Recording continues in %s.dat", self.get_file_basepath())
     
     def __call__(self, stream_bytes):
+        now = zephyr.time()
+        
         if self.time_before is None:
-            self.time_before = zephyr.time()
+            self.time_before = now
         
-        delay = zephyr.time() - self.time_before
+        if self.data_file is None:
+            self.open_files(now)
+        elif self.rotation_due(now):
+            self.rotate(now)
+        
+        delay = now - self.time_before
         
         if delay > 0.0001 :
-            with open(self.log_file_basepath + "-timing.csv", "a") as timing_file:
-                timing_file.writelines("%s,%s\n" % (self.time_before, self.data_file_position))
-            print self.time_before, self.data_file_position
+            self.write_timing_row()
+        
+        self.data_file.write(stream_bytes)
+        self.data_file_position += len(stream_bytes)
+        self.bytes_since_flush += len(stream_bytes)
+        
+        if self.bytes_since_flush >= self.flush_bytes or now - self.last_flush_time >= self.flush_interval:
+            self.flush(now)
+        
+        self.time_before = zephyr.time()
 
-        with open(self.log_file_basepath + ".dat", "ab") as data_file:
-            data_file.writelines(stream_bytes)
-            self.data_file_position = data_file.tell()
 
-        self.time_before = zephyr.time()
+DEFAULT_MAX_READ_SIZE = 4096
+
+# Upper bound of a blocking wait on the port file descriptor. terminate()
+# interrupts the wait right away, so this only bounds the wait when the
+# wake-up pipe is not available.
+IDLE_WAKEUP_INTERVAL = 1.0
+
+# Wait between inWaiting() checks for connections without a file
+# descriptor, such as the virtual serial ports used for replay
+IDLE_POLL_INTERVAL = 0.01
+
+
+class ReconnectBackoff:
+    """Reconnect state of a connection. After the connection is lost, the
+    attempts are spaced by a delay that starts at initial_delay and is
+    multiplied by multiplier after every failure up to max_delay, each
+    randomized by +-jitter so that many devices that drop at once do not
+    retry in lockstep. The time from the loss of the connection to its
+    re-establishment is kept in reconnect_durations."""
+    def __init__(self, initial_delay=0.1, max_delay=10.0, multiplier=2.0, jitter=0.2,
+                 random_generator=random, history_length=100):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.random_generator = random_generator
+        
+        self.connected = True
+        self.delay = initial_delay
+        self.next_attempt_time = None
+        self.disconnect_time = None
+        
+        self.disconnect_count = 0
+        self.failed_attempt_count = 0
+        self.reconnect_durations = collections.deque(maxlen=history_length)
+    
+    def schedule_attempt(self, now):
+        jitter_factor = 1.0 + self.jitter * (2.0 * self.random_generator.random() - 1.0)
+        self.next_attempt_time = now + self.delay * jitter_factor
+    
+    def connection_lost(self, now):
+        self.connected = False
+        self.disconnect_time = now
+        self.disconnect_count += 1
+        self.delay = self.initial_delay
+        self.schedule_attempt(now)
+    
+    def attempt_failed(self, now):
+        self.failed_attempt_count += 1
+        self.delay = min(self.delay * self.multiplier, self.max_delay)
+        self.schedule_attempt(now)
+    
+    def connection_made(self, now):
+        if not self.connected:
+            self.reconnect_durations.append(now - self.disconnect_time)
+        self.connected = True
+        self.next_attempt_time = None
+    
+    def get_time_to_next_attempt(self, now):
+        return max(0.0, self.next_attempt_time - now)
+    
+    def get_statistics(self):
+        statistics = {"connected": self.connected,
+                      "disconnect_count": self.disconnect_count,
+                      "failed_attempt_count": self.failed_attempt_count,
+                      "reconnect_count": len(self.reconnect_durations)}
+        if self.reconnect_durations:
+            statistics["last_reconnect_seconds"] = self.reconnect_durations[-1]
+            statistics["max_reconnect_seconds"] = max(self.reconnect_durations)
+            statistics["mean_reconnect_seconds"] = sum(self.reconnect_durations) / len(self.reconnect_durations)
+        return statistics
 
 
 class Protocol(threading.Thread):
-    def __init__(self, connection, callbacks):
+    """Reads the connection in a thread of its own and passes the received
+    data to callbacks in chunks. A connection that times out or fails is
+    closed and reopened with backoff by the same thread, and
+    connection_callbacks are called with "disconnected" and "connected"
+    around the gap."""
+    def __init__(self, connection, callbacks, max_read_size=DEFAULT_MAX_READ_SIZE,
+                 connection_callbacks=(), reconnect_backoff=None):
         super(Protocol, self).__init__()
         self.connection = connection
         self.callbacks = callbacks
+        self.connection_callbacks = list(connection_callbacks)
+        self.reconnect_backoff = reconnect_backoff or ReconnectBackoff()
+        
+        # Upper bound of bytes drained from the port per read call. A value
+        # of 1 gives the legacy byte-per-call behaviour.
+        self.max_read_size = max_read_size
         
-        self.initialization_messages = []
+        # commands are written by the protocol thread, which also receives
+        # the responses if commands.handle_message is a frame callback
+        self.commands = zephyr.command.CommandPipeline(self.write_commands)
         self.terminated = False
+        
+        self._terminate_event = threading.Event()
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_fds = None
+    
+    def wakeup(self):
+        with self._wakeup_lock:
+            if self._wakeup_fds is not None:
+                try:
+                    os.write(self._wakeup_fds[1], "\0")
+                except OSError as e:
+                    # a full pipe wakes the loop up already
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
     
     def terminate(self):
         self.terminated = True
+        self._terminate_event.set()
+        self.wakeup()
+    
+    def send_command(self, message_id, payload, callback=None):
+        """Queue a command for the protocol thread. Returns a CommandFuture
+        that is resolved by the response of the device."""
+        command = self.commands.submit(message_id, payload, callback)
+        self.wakeup()
+        return command
+    
+    def send_commands(self, messages):
+        """Queue several (message id, payload) commands so that they are
+        sent in a single write."""
+        commands = self.commands.submit_many(messages)
+        self.wakeup()
+        return commands
     
     def add_initilization_message(self, message_id, payload):
-        message_frame = create_message_frame(message_id, payload)
-        
+        return self.send_command(message_id, payload)
+    
+    def write_commands(self, data_string):
         try:
-            self.connection.write(message_frame)
-            logging.debug("Message sent")
+            self.connection.write(data_string)
         except ValueError:
-            self.initialization_messages.append(message_frame)
-    
-    def read_and_handle_byte(self):
-        data_string = self.connection.read(1)
+            # the port is not open yet
+            return False
+        except (IOError, OSError, serial.SerialException) as e:
+            # the commands stay queued until the port has been reopened
+            logging.info("Writing to port failed (%s)", e)
+            self.close_connection()
+            return False
         
-        timeout_occurred = hasattr(self.connection, "timeout") and not len(data_string)
+        logging.debug("Commands sent")
+        return True
+    
+    def process_commands(self):
+        if self.commands.check_timeouts() or self.commands.has_queued_commands():
+            self.commands.flush()
+    
+    def get_wait_timeout(self):
+        command_deadline = self.commands.get_next_deadline()
+        if command_deadline is None:
+            return IDLE_WAKEUP_INTERVAL
+        return max(0.0, min(command_deadline - time.time(), IDLE_WAKEUP_INTERVAL))
+    
+    @property
+    def connected(self):
+        return self.reconnect_backoff.connected
+    
+    def handle_connection_event(self, event):
+        for connection_callback in self.connection_callbacks:
+            connection_callback(event)
+    
+    def close_connection(self):
+        logging.info("Connection lost, closing port")
         
-        if timeout_occurred:
-            logging.info("Timeout occurred, closing port")
+        try:
             self.connection.close()
-            
-            retries = 100
-            for retry_i in range(retries):
-                if self.terminated:
-                    break
-                
-                try:
-                    self.connection.open()
-                except Exception as e:
-                    logging.info("Re-opening port failed, retry %d (%s)", retry_i, e)
-                    time.sleep(1.0)
-                    continue
-                
-                logging.info("Re-opening port successful")
-                break
-            else:
-                raise OSError("Unable to re-open")
+        except (IOError, OSError) as e:
+            logging.info("Closing port failed (%s)", e)
+        
+        self.reconnect_backoff.connection_lost(time.time())
+        self.handle_connection_event("disconnected")
+    
+    def reopen_connection(self):
+        """Make one attempt to reopen the port and schedule the next one
+        if it fails. Returns whether the port is open."""
+        try:
+            self.connection.open()
+        except Exception as e:
+            self.reconnect_backoff.attempt_failed(time.time())
+            logging.info("Re-opening port failed, retrying in %.2f s (%s)", self.reconnect_backoff.delay, e)
+            return False
+        
+        self.reconnect_backoff.connection_made(time.time())
+        logging.info("Re-opening port successful")
+        self.handle_connection_event("connected")
+        return True
+    
+    def wait_and_reopen_connection(self):
+        """Wait for the next reconnect attempt unless terminate() is called
+        in the meantime."""
+        time_to_attempt = self.reconnect_backoff.get_time_to_next_attempt(time.time())
+        
+        if self._wakeup_fds is not None:
+            # unlike Event.wait() with a timeout, select() returns as soon as
+            # terminate() writes to the pipe
+            if self._wakeup_fds[0] in select.select([self._wakeup_fds[0]], [], [], time_to_attempt)[0]:
+                os.read(self._wakeup_fds[0], 4096)
+                return
+        else:
+            self._terminate_event.wait(time_to_attempt)
+        
+        if not self.terminated and self.reconnect_backoff.get_time_to_next_attempt(time.time()) == 0.0:
+            self.reopen_connection()
+    
+    def read_and_handle_bytes(self, byte_count):
+        try:
+            data_string = self.connection.read(byte_count)
+            read_failed = False
+        except (IOError, OSError) as e:
+            # a port that selects readable but fails to read has been
+            # disconnected, which is handled like a timeout
+            logging.info("Reading from port failed (%s)", e)
+            data_string = ""
+            read_failed = True
+        
+        if not len(data_string):
+            if hasattr(self.connection, "timeout") or read_failed:
+                self.close_connection()
+            return data_string
         
         for callback in self.callbacks:
             callback(data_string)
         
         return data_string
     
+    def read_and_handle_byte(self):
+        return self.read_and_handle_bytes(1)
+    
+    def get_connection_fileno(self):
+        if os.name != "posix":
+            return None
+        
+        try:
+            return self.connection.fileno()
+        except (AttributeError, ValueError, IOError):
+            return None
+    
+    def wait_for_data(self, timeout=IDLE_WAKEUP_INTERVAL):
+        """Block until the connection has data to read, a command is queued
+        or terminate() is called, for at most timeout seconds. Returns the
+        number of bytes to read, which is at least one if the port file
+        descriptor became readable."""
+        connection_fileno = self.get_connection_fileno()
+        
+        if connection_fileno is None or self._wakeup_fds is None:
+            waiting_byte_count = int(self.connection.inWaiting())
+            if not waiting_byte_count:
+                self._terminate_event.wait(IDLE_POLL_INTERVAL)
+            return waiting_byte_count
+        
+        readable_fds = select.select([connection_fileno, self._wakeup_fds[0]], [],
+                                     [], timeout)[0]
+        
+        if self._wakeup_fds[0] in readable_fds:
+            os.read(self._wakeup_fds[0], 4096)
+        
+        if connection_fileno in readable_fds and not self.terminated:
+            # a readable port without waiting bytes has hung up, reading
+            # a single byte surfaces the error
+            try:
+                return max(1, int(self.connection.inWaiting()))
+            except (IOError, OSError):
+                return 1
+        else:
+            return 0
+    
+    def open_wakeup_pipe(self):
+        with self._wakeup_lock:
+            if os.name == "posix":
+                self._wakeup_fds = os.pipe()
+                # wakeup() must not block while the loop is not reading
+                fcntl.fcntl(self._wakeup_fds[1], fcntl.F_SETFL,
+                            fcntl.fcntl(self._wakeup_fds[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+    
+    def close_wakeup_pipe(self):
+        with self._wakeup_lock:
+            if self._wakeup_fds is not None:
+                for fd in self._wakeup_fds:
+                    os.close(fd)
+                self._wakeup_fds = None
+    
     def run(self):
         #self.connection.open()
         
-        for message_frame in self.initialization_messages:
-            self.connection.write(message_frame)
+        self.open_wakeup_pipe()
+        
+        try:
+            while not self.terminated:
+                if not self.connected:
+                    self.wait_and_reopen_connection()
+                    continue
+                
+                self.process_commands()
+                if not self.connected:
+                    # writing the commands failed
+                    continue
+                
+                waiting_byte_count = self.wait_for_data(self.get_wait_timeout())
+                if waiting_byte_count:
+                    self.read_and_handle_bytes(min(waiting_byte_count, self.max_read_size))
+        finally:
+            self.close_wakeup_pipe()
         
-        while not self.terminated:
-            if self.connection.inWaiting():
-                self.read_and_handle_byte()
-
         logging.debug("Protocol Thread is out of the while loop.")
 
 
-class BioHarnessProtocol(Protocol):
+class BioHarnessCommands:
+    """Device configuration messages of the BioHarness, shared by the
+    threaded and the event loop protocol implementations."""
     def enable_ecg_waveform(self):
         self.add_initilization_message(0x16, [1])
     
@@ -119,6 +462,10 @@ class BioHarnessProtocol(Protocol):
         #self.set_summary_packet_transmit_interval_to_one_second()
 
 
+class BioHarnessProtocol(Protocol, BioHarnessCommands):
+    pass
+
+
 def create_message_frame(message_id, payload):
     dlc = len(payload)
     assert 0 <= dlc <= 128
@@ -132,11 +479,22 @@ def create_message_frame(message_id, payload):
 
 
 class MessageFrame:
-    def __init__(self, message_id):
+    """A message id, a payload and the end of message status. The payload is
+    a bytearray when MessageFrameParser slices it out of the buffer, and a
+    list of ints when BytewiseMessageFrameParser collects it. Both give the
+    byte values as ints by index and iteration, but a bytearray does not
+    compare equal to a list, and its slices are bytearrays. Callbacks that
+    need a list use list(message_frame.payload)."""
+    def __init__(self, message_id, payload=None, eom=None):
         self.message_id = message_id
-        self.length = None
-        self.eom = None
-        self.payload = []
+        self.eom = eom
+        
+        if payload is None:
+            self.length = None
+            self.payload = []
+        else:
+            self.length = len(payload)
+            self.payload = payload
     
     def set_length(self, length):
         assert self.length is None
@@ -161,7 +519,159 @@ class ProtocolError(Exception):
     pass
 
 
+MESSAGE_STATUSES = {0x03: "ETX", 0x06: "ACK", 0x15: "NAK"}
+
+
 class MessageFrameParser:
+    """Splits the received byte stream into message frames. Whole frames are
+    sliced out of the buffered data, and an incomplete trailing frame is
+    kept until the next call.
+    
+    A rejected frame only discards its STX byte. Scanning resumes at the
+    next byte, so that a real frame that starts inside a corrupted one is
+    still found. discarded_byte_counts counts the bytes that did not end up
+    in a frame by the error that caused them to be skipped.
+    
+    The CRCs of the frames are calculated in one batch when at least
+    batch_crc_frame_count frames have arrived together, as they do when
+    the reader falls behind and drains the port in large reads.
+    
+    The payloads of the frames are bytearrays, see MessageFrame. In the
+    frame_parsers benchmark the parser is 4-5x as fast as
+    BytewiseMessageFrameParser on the chunks of the test recordings, which
+    are 10-90 bytes on average, 7-9x on 1 KB reads, 8-12x on 4 KB reads and
+    8-14x on reads of 16 KB or more. Only reads of several KB reach 10x."""
+    def __init__(self, callbacks, batch_crc_frame_count=8):
+        self.callbacks = callbacks
+        self.batch_crc_frame_count = batch_crc_frame_count
+        self.buffer = bytearray()
+        
+        # the length that the buffer needs before the frame at its start
+        # can be completed
+        self._required_length = 0
+        
+        self.error_counts = collections.Counter()
+        self.discarded_byte_counts = collections.Counter()
+        
+        # bytes up to the end of the latest rejected frame are discarded
+        # because of its error, and any others because they precede an STX
+        self._resync_error = None
+        self._resync_end = 0
+    
+    def reject_frame(self, error, frame_end):
+        logging.warning("ProtocolError: %s", error)
+        self.error_counts[error] += 1
+        self.discarded_byte_counts[error] += 1
+        
+        if frame_end > self._resync_end:
+            self._resync_error = error
+            self._resync_end = frame_end
+    
+    def discard_bytes(self, start, end):
+        resync_byte_count = max(0, min(end, self._resync_end) - start)
+        if resync_byte_count:
+            self.discarded_byte_counts[self._resync_error] += resync_byte_count
+        if end - start > resync_byte_count:
+            self.discarded_byte_counts["Missing STX"] += end - start - resync_byte_count
+    
+    def get_batch_crcs(self, position):
+        """The CRCs of the consecutive frames from the first STX at or after
+        position by the offsets of their payloads, if there are enough of
+        them for a batch."""
+        buffer = self.buffer
+        buffer_length = len(buffer)
+        payload_offsets = []
+        payload_lengths = []
+        
+        frame_start = buffer.find("\x02", position)
+        while 0 <= frame_start and frame_start + 3 <= buffer_length and buffer[frame_start] == 0x02:
+            payload_length = buffer[frame_start + 2]
+            frame_end = frame_start + payload_length + 5
+            if payload_length > 128 or frame_end > buffer_length:
+                break
+            
+            payload_offsets.append(frame_start + 3)
+            payload_lengths.append(payload_length)
+            frame_start = frame_end
+        
+        if len(payload_offsets) < self.batch_crc_frame_count:
+            return {}
+        
+        crcs = zephyr.util.crc_8_digests(buffer, payload_offsets, payload_lengths)
+        return dict(zip(payload_offsets, crcs.tolist()))
+    
+    def parse_data(self, data_string):
+        buffer = self.buffer
+        buffer += data_string
+        buffer_length = len(buffer)
+        if buffer_length < self._required_length:
+            return
+        
+        position = 0
+        batch_crcs = self.get_batch_crcs(position)
+        
+        while True:
+            stx_position = buffer.find("\x02", position)
+            
+            if stx_position < 0:
+                self.discard_bytes(position, buffer_length)
+                position = buffer_length
+                break
+            elif stx_position > position:
+                self.discard_bytes(position, stx_position)
+            
+            payload_start = stx_position + 3
+            if payload_start > buffer_length:
+                position = stx_position
+                break
+            
+            payload_length = buffer[stx_position + 2]
+            if payload_length > 128:
+                self.reject_frame("Incorrect data length", payload_start)
+                position = stx_position + 1
+                continue
+            
+            payload_end = payload_start + payload_length
+            if payload_end + 2 > buffer_length:
+                position = stx_position
+                break
+            
+            payload = buffer[payload_start:payload_end]
+            
+            crc = batch_crcs.get(payload_start)
+            if crc is None:
+                crc = zephyr.util.crc_8_digest(payload)
+            
+            if buffer[payload_end] != crc:
+                self.reject_frame("CRC does not match", payload_end + 2)
+                position = stx_position + 1
+                continue
+            
+            status = MESSAGE_STATUSES.get(buffer[payload_end + 1])
+            if status is None:
+                self.reject_frame("Invalid ACK byte", payload_end + 2)
+                position = stx_position + 1
+                continue
+            
+            position = payload_end + 2
+            
+            message = MessageFrame(buffer[stx_position + 1], payload, status)
+            for callback in self.callbacks:
+                callback(message)
+        
+        del buffer[:position]
+        self._resync_end = max(0, self._resync_end - position)
+        
+        if len(buffer) < 3:
+            self._required_length = 3
+        else:
+            self._required_length = buffer[2] + 5
+
+
+class BytewiseMessageFrameParser:
+    """The original state machine that handles one byte at a time. It agrees
+    with MessageFrameParser on valid streams, but drops everything up to the
+    next STX after a rejected frame."""
     def __init__(self, callbacks):
         self.callbacks = callbacks
         self.handler = self.handle_stx
@@ -215,8 +725,7 @@ class MessageFrameParser:
     def handle_eom(self, byte):
         """Handle the end of message byte. Continue to handling the start
         of message byte."""
-        status_dict = {0x03: "ETX", 0x06: "ACK", 0x15: "NAK"}
-        status = status_dict.get(byte)
+        status = MESSAGE_STATUSES.get(byte)
         
         if status is None:
             raise ProtocolError("Invalid ACK byte")
@@ -0,0 +1,224 @@
+"""Single-file binary recordings of received message frames.
+
+File layout (all values little-endian):
+    header      "ZREC", format version (uint16), index interval (float64)
+    frames      receive timestamp (float64), frame length (uint8), frame bytes
+    index       sparse (timestamp, file offset, frame number) entries
+    counts      256 uint32 frame counts, one per message id
+    trailer     offsets and totals of the above, ending with "ZEND"
+
+Opening a recording only reads the header and the trailer, and seeking
+by time is a binary search in the on-disk index followed by a scan of
+at most one index interval of frames.
+"""
+
+import os
+import sys
+import csv
+import mmap
+import struct
+import logging
+
+import zephyr
+import zephyr.util
+from zephyr.protocol import MessageFrame, MessageFrameParser, MESSAGE_STATUSES
+
+
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<4sHd")
+FRAME_HEADER = struct.Struct("<dB")
+INDEX_ENTRY = struct.Struct("<dQQ")
+MESSAGE_COUNTS = struct.Struct("<256I")
+TRAILER = struct.Struct("<QQQQdd4s")
+
+EOM_BYTES = dict((status, chr(byte)) for byte, status in MESSAGE_STATUSES.items())
+
+
+class RecordingError(Exception):
+    pass
+
+
+def message_frame_to_bytes(message_frame):
+    payload = message_frame.payload
+    crc = zephyr.util.crc_8_digest(payload)
+    return "".join([chr(0x02), chr(message_frame.message_id), chr(len(payload)),
+                    str(bytearray(payload)), chr(crc), EOM_BYTES[message_frame.eom]])
+
+
+def message_frame_from_bytes(frame_bytes):
+    frame_bytes = bytearray(frame_bytes)
+    return MessageFrame(frame_bytes[1], frame_bytes[3:-2], MESSAGE_STATUSES[frame_bytes[-1]])
+
+
+class RecordingWriter:
+    def __init__(self, path, index_interval=1.0):
+        self.path = path
+        self.index_interval = index_interval
+        
+        self.output_file = open(path, "wb")
+        self.output_file.write(HEADER.pack("ZREC", FORMAT_VERSION, index_interval))
+        
+        self.frame_count = 0
+        self.message_counts = [0] * 256
+        self.index_entries = []
+        self.first_timestamp = None
+        self.last_timestamp = None
+    
+    def write_frame(self, timestamp, frame_bytes):
+        # the index is searched by time, so it is kept monotonic even if
+        # the clock of the recording host jumped back
+        if self.last_timestamp is not None:
+            timestamp = max(timestamp, self.last_timestamp)
+        else:
+            self.first_timestamp = timestamp
+        
+        if not self.index_entries or timestamp >= self.index_entries[-1][0] + self.index_interval:
+            self.index_entries.append((timestamp, self.output_file.tell(), self.frame_count))
+        
+        self.output_file.write(FRAME_HEADER.pack(timestamp, len(frame_bytes)))
+        self.output_file.write(frame_bytes)
+        
+        self.frame_count += 1
+        self.message_counts[ord(frame_bytes[1])] += 1
+        self.last_timestamp = timestamp
+    
+    def handle_message(self, message_frame):
+        self.write_frame(zephyr.time(), message_frame_to_bytes(message_frame))
+    
+    def close(self):
+        index_offset = self.output_file.tell()
+        for index_entry in self.index_entries:
+            self.output_file.write(INDEX_ENTRY.pack(*index_entry))
+        
+        counts_offset = self.output_file.tell()
+        self.output_file.write(MESSAGE_COUNTS.pack(*self.message_counts))
+        
+        self.output_file.write(TRAILER.pack(index_offset, len(self.index_entries), counts_offset,
+                                            self.frame_count, self.first_timestamp or 0.0,
+                                            self.last_timestamp or 0.0, "ZEND"))
+        self.output_file.close()
+
+
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        
+        with open(path, "rb") as input_file:
+            self.file_size = os.fstat(input_file.fileno()).st_size
+            if self.file_size < HEADER.size + TRAILER.size:
+                raise RecordingError("%s is not a complete recording" % path)
+            
+            self.data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, version, self.index_interval = HEADER.unpack_from(self.data, 0)
+        if magic != "ZREC" or version != FORMAT_VERSION:
+            raise RecordingError("%s is not a recording of version %d" % (path, FORMAT_VERSION))
+        
+        (self.index_offset, self.index_count, self.counts_offset, self.frame_count,
+         self.start_timestamp, self.end_timestamp, end_magic) = \
+            TRAILER.unpack_from(self.data, self.file_size - TRAILER.size)
+        if end_magic != "ZEND":
+            raise RecordingError("%s was not closed properly" % path)
+    
+    def close(self):
+        self.data.close()
+    
+    def get_message_counts(self):
+        message_counts = MESSAGE_COUNTS.unpack_from(self.data, self.counts_offset)
+        return dict((message_id, count) for message_id, count in enumerate(message_counts) if count)
+    
+    def get_index_entry(self, index_i):
+        return INDEX_ENTRY.unpack_from(self.data, self.index_offset + index_i * INDEX_ENTRY.size)
+    
+    def find_frame_offset(self, timestamp):
+        """File offset of the first frame received at or after timestamp."""
+        low, high = 0, self.index_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_index_entry(middle)[0] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        
+        if low == 0:
+            return HEADER.size
+        
+        frame_offset = self.get_index_entry(low - 1)[1]
+        while frame_offset < self.index_offset:
+            frame_timestamp, frame_length = FRAME_HEADER.unpack_from(self.data, frame_offset)
+            if frame_timestamp >= timestamp:
+                break
+            frame_offset += FRAME_HEADER.size + frame_length
+        
+        return frame_offset
+    
+    def iterate_frames(self, start_timestamp=None, end_timestamp=None):
+        """Lazily yield (receive timestamp, frame bytes) of the frames
+        received between the given timestamps."""
+        if start_timestamp is None:
+            frame_offset = HEADER.size
+        else:
+            frame_offset = self.find_frame_offset(start_timestamp)
+        
+        while frame_offset < self.index_offset:
+            frame_timestamp, frame_length = FRAME_HEADER.unpack_from(self.data, frame_offset)
+            if end_timestamp is not None and frame_timestamp > end_timestamp:
+                break
+            
+            frame_start = frame_offset + FRAME_HEADER.size
+            frame_offset = frame_start + frame_length
+            yield frame_timestamp, self.data[frame_start:frame_offset]
+    
+    def iterate_message_frames(self, start_timestamp=None, end_timestamp=None):
+        for frame_timestamp, frame_bytes in self.iterate_frames(start_timestamp, end_timestamp):
+            yield frame_timestamp, message_frame_from_bytes(frame_bytes)
+
+
+def iterate_legacy_recording_chunks(data_path, timing_path):
+    """Yield (timestamp, bytes) chunks of a .dat/-timing.csv recording in the
+    way TimedVirtualSerial replays them. Bytes after the last timing row
+    are given the last timestamp."""
+    with open(timing_path) as timing_file:
+        timings = [(float(timestamp_str), int(byte_count_str))
+                   for timestamp_str, byte_count_str in csv.reader(timing_file)]
+    
+    with open(data_path, "rb") as data_file:
+        position = 0
+        for chunk_timestamp, chunk_cumulative_byte_count in timings:
+            if chunk_cumulative_byte_count > position:
+                yield chunk_timestamp, data_file.read(chunk_cumulative_byte_count - position)
+                position = chunk_cumulative_byte_count
+        
+        remaining_bytes = data_file.read()
+        if remaining_bytes and timings:
+            yield timings[-1][0], remaining_bytes
+
+
+def convert_legacy_recording(data_path, timing_path, output_path, index_interval=1.0):
+    writer = RecordingWriter(output_path, index_interval)
+    
+    message_frames = []
+    frame_parser = MessageFrameParser([message_frames.append])
+    
+    for chunk_timestamp, chunk_bytes in iterate_legacy_recording_chunks(data_path, timing_path):
+        frame_parser.parse_data(chunk_bytes)
+        
+        for message_frame in message_frames:
+            writer.write_frame(chunk_timestamp, message_frame_to_bytes(message_frame))
+        del message_frames[:]
+    
+    writer.close()
+    logging.info("Converted %d frames of %s to %s", writer.frame_count, data_path, output_path)
+    return writer.frame_count
+
+
+def main(data_paths):
+    for data_path in data_paths:
+        basepath = os.path.splitext(data_path)[0]
+        convert_legacy_recording(data_path, basepath + "-timing.csv", basepath + ".zrec")
+
+
+if __name__ == "__main__":
+    zephyr.configure_root_logger()
+    main(sys.argv[1:])
@@ -0,0 +1,194 @@
+"""Memory-mapped segment files that keep the history of a stream on disk.
+
+A SegmentStore appends the timestamps and the samples (or event values) of
+one stream to segments of segment_length rows. Every segment is a pair of
+.npy files, one with the timestamps and one with the samples, which are
+created at their full size and mapped into memory. When a segment is full
+it is flushed, sealed and unmapped, and the next one is created. Time range
+queries find the segments by their first timestamps and the rows in them
+with a binary search of the mapped timestamps, so they only touch the pages
+of the requested range. Sealed segments are mapped read-only for queries,
+and only the most recently queried of them stay mapped, so that a long
+session does not hold two file descriptors for every segment."""
+
+import os
+import errno
+import bisect
+import threading
+import collections
+
+import numpy
+from numpy.lib.format import open_memmap
+
+
+class Segment:
+    """segment_length rows, of which the first count are filled. The files
+    must not exist yet. A sealed segment takes no more rows, and is mapped
+    read-only by map() and released by unmap()."""
+    def __init__(self, path_prefix, segment_length, sample_shape, dtype):
+        self.timestamps_path = path_prefix + ".timestamps.npy"
+        self.samples_path = path_prefix + ".samples.npy"
+        for path in (self.timestamps_path, self.samples_path):
+            if os.path.exists(path):
+                raise IOError(errno.EEXIST, "Segment file exists", path)
+        
+        self.timestamps = open_memmap(self.timestamps_path, "w+", numpy.float64, (segment_length,))
+        self.samples = open_memmap(self.samples_path, "w+", dtype, (segment_length,) + sample_shape)
+        self.segment_length = segment_length
+        self.sample_shape = sample_shape
+        self.dtype = self.samples.dtype
+        self.nbytes = self.timestamps.nbytes + self.samples.nbytes
+        self.count = 0
+        self.sealed = False
+        
+        self.start_timestamp = None
+        self.end_timestamp = None
+    
+    @property
+    def free_count(self):
+        if self.sealed:
+            return 0
+        return self.segment_length - self.count
+    
+    @property
+    def mapped(self):
+        return self.timestamps is not None
+    
+    def append(self, timestamps, samples):
+        """Returns the number of rows that fit in the segment."""
+        row_count = min(len(timestamps), self.free_count)
+        if not row_count:
+            return 0
+        
+        self.samples[self.count:self.count + row_count] = samples[:row_count]
+        self.timestamps[self.count:self.count + row_count] = timestamps[:row_count]
+        if not self.count:
+            self.start_timestamp = float(timestamps[0])
+        self.end_timestamp = float(timestamps[row_count - 1])
+        self.count += row_count
+        return row_count
+    
+    def seal(self):
+        if self.sealed:
+            return
+        
+        self.timestamps.flush()
+        self.samples.flush()
+        self.sealed = True
+        self.unmap()
+    
+    def map(self):
+        self.timestamps = numpy.load(self.timestamps_path, mmap_mode="r")
+        self.samples = numpy.load(self.samples_path, mmap_mode="r")
+    
+    def unmap(self):
+        # the maps and their file descriptors are closed with the last
+        # reference to them, so a query that still uses them is safe
+        self.timestamps = None
+        self.samples = None
+    
+    def query(self, start_timestamp, end_timestamp, end_side="right"):
+        timestamps = self.timestamps[:self.count]
+        from_row = timestamps.searchsorted(start_timestamp, "left")
+        to_row = timestamps.searchsorted(end_timestamp, end_side)
+        return numpy.array(timestamps[from_row:to_row]), numpy.array(self.samples[from_row:to_row])
+
+
+class SegmentStore:
+    """The segments of one stream in directory, which are named after the
+    stream and numbered from 0. Creating a segment over an existing file
+    raises an IOError. Rows must be appended in the order of their
+    timestamps. One thread appends and any thread can query. At most
+    mapped_segment_count sealed segments stay mapped after queries."""
+    def __init__(self, directory, name, segment_length=65536, mapped_segment_count=4):
+        self.directory = directory
+        self.name = name
+        self.segment_length = segment_length
+        self.mapped_segment_count = mapped_segment_count
+        
+        self.segments = []
+        # the first timestamps of the segments, for the binary search
+        self.segment_start_timestamps = []
+        # the mapped sealed segments, the least recently queried first
+        self.mapped_segments = collections.OrderedDict()
+        self.lock = threading.RLock()
+    
+    @property
+    def end_timestamp(self):
+        """The timestamp of the last appended row, or None."""
+        with self.lock:
+            if not self.segments:
+                return None
+            return self.segments[-1].end_timestamp
+    
+    @property
+    def nbytes(self):
+        """The size of the segment files."""
+        with self.lock:
+            return sum(segment.nbytes for segment in self.segments)
+    
+    def append(self, timestamps, samples):
+        timestamps = numpy.asarray(timestamps, numpy.float64)
+        samples = numpy.asarray(samples)
+        
+        with self.lock:
+            while len(timestamps):
+                if not self.segments or not self.segments[-1].free_count:
+                    self.add_segment(samples.shape[1:], samples.dtype)
+                    self.segment_start_timestamps.append(float(timestamps[0]))
+                
+                row_count = self.segments[-1].append(timestamps, samples)
+                timestamps, samples = timestamps[row_count:], samples[row_count:]
+    
+    def add_segment(self, sample_shape, dtype):
+        if self.segments:
+            self.segments[-1].seal()
+        
+        path_prefix = os.path.join(self.directory, "%s-%06d" % (self.name, len(self.segments)))
+        self.segments.append(Segment(path_prefix, self.segment_length, sample_shape, dtype))
+    
+    def query(self, start_timestamp, end_timestamp, before_timestamp=None):
+        """The timestamps and the samples of the rows from start_timestamp
+        to end_timestamp, and before before_timestamp if it is given, as
+        two arrays. Returns None if the store is empty."""
+        end_side = "right"
+        if before_timestamp is not None and before_timestamp <= end_timestamp:
+            end_timestamp, end_side = before_timestamp, "left"
+        
+        with self.lock:
+            if not self.segments:
+                return None
+            
+            first_segment_i = max(0, bisect.bisect_right(self.segment_start_timestamps, start_timestamp) - 1)
+            first_segment = self.segments[first_segment_i]
+            timestamp_chunks = [numpy.empty(0)]
+            sample_chunks = [numpy.empty((0,) + first_segment.sample_shape, first_segment.dtype)]
+            for segment in self.segments[first_segment_i:]:
+                if segment.start_timestamp > end_timestamp:
+                    break
+                self.map_segment(segment)
+                timestamps, samples = segment.query(start_timestamp, end_timestamp, end_side)
+                timestamp_chunks.append(timestamps)
+                sample_chunks.append(samples)
+        
+        return numpy.concatenate(timestamp_chunks), numpy.concatenate(sample_chunks)
+    
+    def map_segment(self, segment):
+        """Map a sealed segment for a query, and unmap the least recently
+        queried ones beyond mapped_segment_count."""
+        if not segment.sealed:
+            return
+        
+        if segment in self.mapped_segments:
+            del self.mapped_segments[segment]
+        elif not segment.mapped:
+            segment.map()
+        self.mapped_segments[segment] = True
+        
+        while len(self.mapped_segments) > self.mapped_segment_count:
+            self.mapped_segments.popitem(last=False)[0].unmap()
+    
+    def close(self):
+        with self.lock:
+            if self.segments:
+                self.segments[-1].seal()
@@ -0,0 +1,139 @@
+import os
+import time
+import socket
+import unittest
+
+from zephyr.async_protocol import EventLoop, AsyncBioHarnessProtocol, TcpConnector, SerialPortConnector
+from zephyr.protocol import MessageFrameParser, create_message_frame
+from zephyr.testing import PtySerial, iterate_test_recordings
+
+
+def run_until(event_loop, condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        event_loop.run_once()
+    return condition()
+
+
+def parse_frames(data_string):
+    frames = []
+    MessageFrameParser([frames.append]).parse_data(data_string)
+    return [(frame.message_id, frame.payload, frame.eom) for frame in frames]
+
+
+class AsyncProtocolTcpTest(unittest.TestCase):
+    def setUp(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.listen(1)
+        self.server_socket.settimeout(5.0)
+        
+        self.event_loop = EventLoop()
+        self.frames = []
+        frame_parser = MessageFrameParser([self.frames.append])
+        
+        connector = TcpConnector(*self.server_socket.getsockname())
+        self.protocol = AsyncBioHarnessProtocol(self.event_loop, connector, [frame_parser.parse_data],
+                                                reconnect_delay=0.01)
+        frame_parser.callbacks.append(self.protocol.commands.handle_message)
+    
+    def tearDown(self):
+        self.protocol.terminate()
+        self.event_loop.terminate()
+        self.event_loop.run()
+        self.server_socket.close()
+    
+    def accept_device_connection(self):
+        self.protocol.start()
+        self.assertTrue(run_until(self.event_loop, lambda: self.protocol.connected))
+        device_socket = self.server_socket.accept()[0]
+        device_socket.settimeout(5.0)
+        return device_socket
+    
+    def test_initialization_messages_are_sent_on_connect(self):
+        self.protocol.enable_periodic_packets()
+        device_socket = self.accept_device_connection()
+        
+        expected_bytes = create_message_frame(0x15, [1]) + create_message_frame(0x19, [1])
+        received_bytes = ""
+        while len(received_bytes) < len(expected_bytes):
+            self.event_loop.run_once()
+            received_bytes += device_socket.recv(4096)
+        
+        self.assertEqual(received_bytes, expected_bytes)
+        device_socket.close()
+    
+    def test_command_is_acknowledged(self):
+        device_socket = self.accept_device_connection()
+        command = self.protocol.send_command(0x16, [1])
+        
+        self.assertTrue(run_until(self.event_loop, lambda: command.attempt_count == 1 and
+                                  not self.protocol.dispatcher.out_buffer))
+        self.assertEqual(device_socket.recv(4096), create_message_frame(0x16, [1]))
+        
+        device_socket.sendall(create_message_frame(0x16, [])[:-1] + "\x06")
+        self.assertTrue(run_until(self.event_loop, command.done))
+        self.assertEqual(command.status, "ACK")
+        self.assertEqual(self.protocol.commands.outcome_counts["ACK"], 1)
+        device_socket.close()
+    
+    def test_recorded_stream_is_parsed(self):
+        data_path = list(iterate_test_recordings())[0][0]
+        with open(data_path, "rb") as data_file:
+            stream_bytes = data_file.read()
+        expected_frames = parse_frames(stream_bytes)
+        
+        device_socket = self.accept_device_connection()
+        device_socket.sendall(stream_bytes)
+        
+        self.assertTrue(run_until(self.event_loop, lambda: len(self.frames) == len(expected_frames)))
+        frame_contents = [(frame.message_id, frame.payload, frame.eom) for frame in self.frames]
+        self.assertEqual(frame_contents, expected_frames)
+        device_socket.close()
+    
+    def test_reconnect_after_connection_loss(self):
+        device_socket = self.accept_device_connection()
+        device_socket.close()
+        
+        self.assertTrue(run_until(self.event_loop, lambda: not self.protocol.connected))
+        self.assertTrue(run_until(self.event_loop, lambda: self.protocol.connected))
+        
+        device_socket = self.server_socket.accept()[0]
+        device_socket.sendall(create_message_frame(0x23, []))
+        self.assertTrue(run_until(self.event_loop, lambda: len(self.frames) == 1))
+        device_socket.close()
+
+
+@unittest.skipIf(os.name != "posix", "pseudo terminals are not available")
+class AsyncProtocolSerialPortTest(unittest.TestCase):
+    def test_many_devices_on_one_loop(self):
+        event_loop = EventLoop()
+        devices = [PtySerial() for device_i in range(20)] #@UnusedVariable
+        device_frames = [[] for device in devices]
+        
+        protocols = []
+        for device, frames in zip(devices, device_frames):
+            frame_parser = MessageFrameParser([frames.append])
+            connector = SerialPortConnector(os.ttyname(device.slave_fd))
+            protocol = AsyncBioHarnessProtocol(event_loop, connector, [frame_parser.parse_data])
+            protocol.start()
+            protocols.append(protocol)
+        
+        self.assertTrue(run_until(event_loop, lambda: all(protocol.connected for protocol in protocols)))
+        
+        for device_i, device in enumerate(devices):
+            for frame_i in range(device_i + 1): #@UnusedVariable
+                device.device_write(create_message_frame(0x23, []))
+        
+        expected_counts = range(1, len(devices) + 1)
+        self.assertTrue(run_until(event_loop, lambda: map(len, device_frames) == expected_counts))
+        
+        for protocol in protocols:
+            protocol.terminate()
+        event_loop.run_once()
+        self.assertEqual(len(event_loop.socket_map), 1) # only the wake-up pipe is left
+        
+        event_loop.terminate()
+        event_loop.run()
+        for device in devices:
+            device.close()
@@ -0,0 +1,79 @@
+import unittest
+
+import numpy
+
+from zephyr.bioharness import AccelerometerActivityAnalysis, BioHarnessPacketHandler
+from zephyr.message import MessagePayloadParser, SignalPacket
+
+
+class BioHarnessPacketHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.signals = []
+        self.packet_handler = BioHarnessPacketHandler([self.handle_signal], [])
+    
+    def handle_signal(self, signal_packet, starts_new_stream):
+        self.signals.append((signal_packet.sequence_number, starts_new_stream))
+    
+    def create_packet(self, sequence_number):
+        return SignalPacket("breathing", 1000.0 + sequence_number, 18.0, [0] * 18, sequence_number)
+    
+    def test_reconnect_starts_new_stream(self):
+        for sequence_number in [10, 11]:
+            self.packet_handler.handle_packet(self.create_packet(sequence_number))
+        
+        self.packet_handler.handle_connection_event("disconnected")
+        self.packet_handler.handle_connection_event("connected")
+        
+        for sequence_number in [12, 13]:
+            self.packet_handler.handle_packet(self.create_packet(sequence_number))
+        
+        self.assertEqual(self.signals, [(10, False), (11, False), (12, True), (13, False)])
+    
+    def test_subscribed_signal_types(self):
+        payload_parser = MessagePayloadParser()
+        self.packet_handler.subscribe(payload_parser, ["breathing"])
+        
+        self.assertEqual(sorted(payload_parser.subscriptions), [0x21, 0x2B])
+        self.assertEqual(payload_parser.subscriptions[0x21], [self.packet_handler.handle_signal_packet])
+
+
+class AccelerometerActivityAnalysisTest(unittest.TestCase):
+    def setUp(self):
+        self.activity_packets = []
+        self.activity_analysis = AccelerometerActivityAnalysis([self.handle_signal])
+    
+    def handle_signal(self, signal_packet, starts_new_stream):
+        self.activity_packets.append((signal_packet, starts_new_stream))
+    
+    def create_packet(self, timestamp, samples):
+        return SignalPacket("acceleration", timestamp, 50.0, numpy.array(samples, numpy.float32), 0)
+    
+    def test_activity_counts_per_second(self):
+        still_samples = [(0.0, 0.0, 1.0)] * 30
+        moving_samples = [(0.5, 0.0, 1.0), (-0.5, 0.0, 1.0)] * 15
+        
+        # the first second ends in the second packet and the second second
+        # in the third packet
+        self.activity_analysis.handle_signal(self.create_packet(100.0, still_samples[:20]), True)
+        self.activity_analysis.handle_signal(self.create_packet(100.4, still_samples + moving_samples), False)
+        
+        self.assertEqual(len(self.activity_packets), 1)
+        activity_packet, starts_new_stream = self.activity_packets[0]
+        self.assertTrue(starts_new_stream)
+        self.assertEqual((activity_packet.type, activity_packet.samplerate), ("acceleration_activity", 1.0))
+        self.assertAlmostEqual(activity_packet.timestamp, 100.0)
+        numpy.testing.assert_allclose(activity_packet.samples, [0.0], atol=1e-6)
+        
+        self.activity_analysis.handle_signal(self.create_packet(101.6, moving_samples[:20] + still_samples[:20]), False)
+        self.assertEqual(len(self.activity_packets), 2)
+        activity_packet, starts_new_stream = self.activity_packets[1]
+        self.assertFalse(starts_new_stream)
+        self.assertAlmostEqual(activity_packet.timestamp, 101.0)
+        numpy.testing.assert_allclose(activity_packet.samples, [0.5], atol=1e-6)
+        
+        # a new stream drops the incomplete window
+        self.activity_analysis.handle_signal(self.create_packet(200.0, still_samples + still_samples[:20]), True)
+        activity_packet, starts_new_stream = self.activity_packets[2]
+        self.assertTrue(starts_new_stream)
+        self.assertAlmostEqual(activity_packet.timestamp, 200.0)
+        numpy.testing.assert_allclose(activity_packet.samples, [0.0], atol=1e-6)
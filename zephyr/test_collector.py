@@ -0,0 +1,395 @@
+import time
+import unittest
+import threading
+import collections
+
+import numpy
+
+import zephyr
+import zephyr.util
+from zephyr.collector import EventStream, SignalStream, SignalStreamHistory, MeasurementCollector, \
+    CollectorCleanupThread
+from zephyr.bioharness import BioHarnessPacketHandler
+from zephyr.message import SignalPacket, MessagePayloadParser
+from zephyr.protocol import Protocol, MessageFrameParser
+from zephyr.testing import TimedVirtualSerial, iterate_test_recordings
+
+
+def create_packet(timestamp, samples, samplerate=10.0):
+    return SignalPacket("ecg", timestamp, samplerate, numpy.array(samples, numpy.int16), 0)
+
+
+class EventStreamTest(unittest.TestCase):
+    def test_read_since_returns_new_events(self):
+        event_stream = EventStream()
+        for event_i in range(6):
+            event_stream.append((100.0 + event_i, event_i * 10))
+        
+        cursor, timestamps, values = event_stream.read_since(0, 102.5)
+        self.assertEqual((cursor, timestamps.tolist(), values), (3, [100.0, 101.0, 102.0], [0, 10, 20]))
+        
+        cursor, timestamps, values = event_stream.read_since(cursor, 102.5)
+        self.assertEqual((cursor, len(timestamps), values), (3, 0, []))
+        
+        # events that were cleaned up before they were read are skipped
+        event_stream.clean_up_events_before(104.0)
+        cursor, timestamps, values = event_stream.read_since(cursor, 110.0)
+        self.assertEqual((cursor, timestamps.tolist(), values), (6, [104.0, 105.0], [40, 50]))
+        self.assertEqual(list(event_stream.iterate_samples(5, 110.0)), [50])
+    
+    def test_cleanup_and_queries_across_storage_growth(self):
+        event_stream = EventStream(initial_capacity=4)
+        cursor = 0
+        
+        for event_i in range(100):
+            event_stream.append((event_i * 0.5, event_i))
+            if event_i % 10 == 9:
+                cursor, timestamps, values = event_stream.read_since(cursor, event_i * 0.5)
+                self.assertEqual(values, range(event_i - 9, event_i + 1))
+                event_stream.clean_up_events_before(event_i * 0.5 - 2.0)
+        
+        self.assertEqual((len(event_stream), event_stream.events_cleaned_up), (100, 95))
+        self.assertTrue(len(event_stream._timestamps) <= 32)
+        self.assertEqual(event_stream[97], (48.5, 97))
+        self.assertEqual(list(event_stream), [(event_i * 0.5, event_i) for event_i in range(95, 100)])
+        
+        timestamps, values = event_stream.query(48.0, 49.0)
+        self.assertEqual((timestamps.tolist(), values.tolist()), ([48.0, 48.5, 49.0], [96, 97, 98]))
+        timestamps, values = event_stream.query(0.0, 10.0)
+        self.assertEqual((len(timestamps), len(values)), (0, 0))
+    
+    def test_compact_releases_cleaned_up_events(self):
+        event_stream = EventStream(initial_capacity=4)
+        for event_i in range(1000):
+            event_stream.append((float(event_i), event_i * 0.5))
+        full_nbytes = event_stream.nbytes
+        
+        event_stream.clean_up_events_before(990.0)
+        self.assertEqual(event_stream.nbytes, full_nbytes)
+        
+        event_stream.compact()
+        self.assertTrue(event_stream.nbytes < full_nbytes / 10)
+        self.assertEqual((len(event_stream), event_stream.events_cleaned_up), (1000, 990))
+        self.assertEqual(event_stream.read_since(995, 2000.0)[2], [497.5, 498.0, 498.5, 499.0, 499.5])
+
+
+class SignalStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.signal_stream = SignalStream(create_packet(0.0, []), 8)
+    
+    def append_samples(self, first_sample, sample_count):
+        samples = range(first_sample, first_sample + sample_count)
+        return self.signal_stream.append_signal_packet(create_packet(first_sample / 10.0, samples))
+    
+    def test_buffer_wraps_around(self):
+        self.assertEqual(self.append_samples(0, 6), 0)
+        self.assertEqual(self.append_samples(6, 5), 3)
+        
+        self.assertEqual(len(self.signal_stream), 8)
+        self.assertEqual(self.signal_stream.samples.tolist(), range(3, 11))
+        self.assertAlmostEqual(self.signal_stream.start_timestamp, 0.3)
+        self.assertAlmostEqual(self.signal_stream.end_timestamp, 1.1)
+        
+        latest_views = self.signal_stream.get_latest_samples(5)
+        self.assertEqual([sample_view.tolist() for sample_view in latest_views], [[6, 7], [8, 9, 10]])
+        self.assertTrue(all(numpy.may_share_memory(sample_view, self.signal_stream._buffer)
+                            for sample_view in latest_views))
+        self.assertEqual([sample_view.tolist() for sample_view in self.signal_stream.get_latest_samples(2)], [[9, 10]])
+        
+        self.assertEqual(self.append_samples(11, 20), 20)
+        self.assertEqual(self.signal_stream.samples.tolist(), range(23, 31))
+    
+    def test_remove_samples_before(self):
+        self.append_samples(0, 6)
+        self.append_samples(6, 4)
+        
+        self.assertEqual(self.signal_stream.remove_samples_before(0.5), 3)
+        self.assertEqual(self.signal_stream.samples.tolist(), range(5, 10))
+        self.assertEqual([timestamp for timestamp, sample in self.signal_stream.iterate_timed_samples()], #@UnusedVariable
+                         [0.5, 0.6, 0.7, 0.8, 0.9])
+        self.assertEqual(self.signal_stream.remove_samples_before(5.0), 5)
+        self.assertEqual(len(self.signal_stream), 0)
+    
+    def test_resize_keeps_latest_samples(self):
+        self.append_samples(0, 6)
+        self.append_samples(6, 5)
+        
+        self.assertEqual(self.signal_stream.resize(5), 3)
+        self.assertEqual((self.signal_stream.capacity, self.signal_stream.nbytes), (5, 10))
+        self.assertEqual(self.signal_stream.samples.tolist(), range(6, 11))
+        self.assertAlmostEqual(self.signal_stream.start_timestamp, 0.6)
+        
+        self.assertEqual(self.append_samples(11, 3), 3)
+        self.assertEqual(self.signal_stream.samples.tolist(), range(9, 14))
+        
+        self.assertEqual(self.signal_stream.resize(20), 0)
+        self.assertEqual(self.append_samples(14, 3), 0)
+        self.assertEqual(self.signal_stream.samples.tolist(), range(9, 17))
+
+
+class SignalStreamHistoryTest(unittest.TestCase):
+    def test_overwritten_samples_are_cleaned_up(self):
+        signal_stream_history = SignalStreamHistory(history_length_seconds=1.0)
+        
+        for packet_i in range(5):
+            samples = range(packet_i * 4, packet_i * 4 + 4)
+            signal_stream_history.append_signal_packet(create_packet(packet_i * 0.4, samples), packet_i == 0)
+        
+        self.assertEqual(signal_stream_history.samples_cleaned_up, 10)
+        self.assertEqual(list(signal_stream_history.iterate_samples(12, 10.0)), range(12, 20))
+        self.assertEqual(list(signal_stream_history.iterate_samples(0, 1.5)), range(10, 16))
+    
+    def test_multi_channel_samples(self):
+        signal_stream_history = SignalStreamHistory(history_length_seconds=1.0)
+        samples = numpy.arange(24, dtype=numpy.float32).reshape(8, 3)
+        signal_stream_history.append_signal_packet(SignalPacket("acceleration", 0.0, 5.0, samples, 0), True)
+        
+        signal_stream, = signal_stream_history.get_signal_streams()
+        self.assertEqual(signal_stream.samples.dtype, numpy.float32)
+        self.assertEqual(signal_stream.samples.tolist(), samples[3:].tolist())
+    
+    def test_read_since_returns_new_samples(self):
+        signal_stream_history = SignalStreamHistory(history_length_seconds=1.0)
+        signal_stream_history.append_signal_packet(create_packet(0.0, range(0, 6)), True)
+        
+        cursor, chunks = signal_stream_history.read_since(0, 0.25)
+        self.assertEqual(cursor, 3)
+        self.assertEqual([(start_timestamp, samples.tolist()) for start_timestamp, samples in chunks], [(0.0, [0, 1, 2])])
+        
+        signal_stream_history.append_signal_packet(create_packet(0.6, range(6, 10)), False)
+        signal_stream_history.append_signal_packet(create_packet(5.0, range(100, 104)), True)
+        
+        cursor, chunks = signal_stream_history.read_since(cursor, 5.1)
+        self.assertEqual(cursor, 12)
+        self.assertEqual([(round(start_timestamp, 6), samples.tolist()) for start_timestamp, samples in chunks],
+                         [(0.3, range(3, 10)), (5.0, [100, 101])])
+        self.assertEqual(signal_stream_history.read_since(cursor, 5.1), (12, []))
+        
+        # samples that were cleaned up before they were read are skipped
+        signal_stream_history.clean_up_samples_before(5.25)
+        cursor, chunks = signal_stream_history.read_since(11, 10.0)
+        self.assertEqual((cursor, chunks[0][1].tolist()), (14, [102, 103]))
+    
+    def test_query_time_range(self):
+        collector = MeasurementCollector(history_length_seconds=60.0)
+        now = zephyr.time()
+        collector.handle_signal(create_packet(now, range(0, 10)), True)
+        collector.handle_signal(create_packet(now + 5.0, range(100, 110)), True)
+        collector.handle_event("heart_rate", (now + 0.5, 60))
+        
+        timestamps, samples = collector.query("ecg", now + 0.75, now + 5.25)
+        self.assertEqual(samples.tolist(), [8, 9, 100, 101, 102])
+        numpy.testing.assert_allclose(timestamps - now, [0.8, 0.9, 5.0, 5.1, 5.2], atol=1e-6)
+        
+        self.assertEqual(collector.query("heart_rate", now, now + 1.0)[1].tolist(), [60])
+        self.assertEqual(len(collector.query("breathing", now, now + 1.0)[0]), 0)
+
+
+class MeasurementCollectorTest(unittest.TestCase):
+    def fill_collector(self, collector, now, seconds, samplerate=10.0):
+        for packet_i in range(int(seconds)):
+            collector.handle_signal(create_packet(now - seconds + packet_i, range(int(samplerate)), samplerate),
+                                    packet_i == 0)
+            collector.handle_event("heart_rate", (now - seconds + packet_i, 60))
+    
+    def test_retention_by_stream(self):
+        collector = MeasurementCollector(history_length_seconds=10.0, retention_seconds={"heart_rate": 100.0})
+        now = 1000.0
+        self.fill_collector(collector, now, 50)
+        
+        signal_stream, = collector.get_signal_stream_history("ecg").get_signal_streams()
+        self.assertEqual(signal_stream.capacity, 100)
+        
+        collector.clean_up(now)
+        self.assertEqual(len(collector.query("ecg", 0.0, now)[1]), 100)
+        self.assertEqual(len(collector.query("heart_rate", 0.0, now)[1]), 50)
+        
+        collector.clean_up(now + 70.0)
+        self.assertEqual(len(collector.query("ecg", 0.0, now)[1]), 0)
+        self.assertEqual(collector.query("heart_rate", 0.0, now)[0].tolist(), range(970, 1000))
+    
+    def test_memory_budget_lowers_retention_of_largest_stream(self):
+        collector = MeasurementCollector(history_length_seconds=100.0, retention_seconds={"heart_rate": 1000.0})
+        now = 1000.0
+        self.fill_collector(collector, now, 100, samplerate=100.0)
+        
+        memory_usage = collector.get_memory_usage()
+        self.assertEqual(memory_usage["stream_bytes"]["ecg"], 20000)
+        self.assertEqual(memory_usage["total_bytes"], sum(memory_usage["stream_bytes"].values()))
+        
+        collector.memory_budget_bytes = memory_usage["total_bytes"] - 10000
+        collector.clean_up(now)
+        
+        memory_usage = collector.get_memory_usage()
+        self.assertTrue(memory_usage["total_bytes"] <= collector.memory_budget_bytes)
+        self.assertEqual(memory_usage["retention_seconds"], {"ecg": 50.0, "heart_rate": 1000.0})
+        self.assertEqual(memory_usage["budget_eviction_count"], 1)
+        self.assertEqual(collector.query("ecg", 0.0, now)[1].tolist(), range(100) * 50)
+        self.assertEqual(len(collector.query("heart_rate", 0.0, now)[1]), 100)
+    
+    def test_retention_is_restored_below_low_water_mark(self):
+        collector = MeasurementCollector(history_length_seconds=100.0, retention_seconds={"heart_rate": 1000.0},
+                                         memory_low_water_fraction=0.5)
+        now = 1000.0
+        self.fill_collector(collector, now, 100, samplerate=100.0)
+        
+        collector.memory_budget_bytes = collector.get_memory_usage()["total_bytes"] - 10000
+        collector.clean_up(now)
+        self.assertEqual(collector.get_retention_seconds("ecg"), 50.0)
+        
+        # between the low-water mark and the budget nothing changes
+        total_bytes = collector.get_memory_usage()["total_bytes"]
+        collector.memory_budget_bytes = total_bytes + 1000
+        collector.clean_up(now)
+        self.assertEqual(collector.get_retention_seconds("ecg"), 50.0)
+        
+        # the ecg stream holds 200 bytes per second
+        collector.memory_budget_bytes = 2 * (total_bytes + 5000)
+        collector.clean_up(now)
+        self.assertEqual(collector.get_retention_seconds("ecg"), 75.0)
+        signal_stream, = collector.get_signal_stream_history("ecg").get_signal_streams()
+        self.assertEqual(signal_stream.capacity, 7500)
+        
+        collector.memory_budget_bytes = 10 ** 6
+        collector.clean_up(now)
+        self.assertEqual(collector.get_memory_usage()["retention_seconds"], {"ecg": 100.0, "heart_rate": 1000.0})
+        self.assertEqual(signal_stream.capacity, 10000)
+        # the samples that the lower retention removed stay removed
+        self.assertEqual(collector.get_memory_usage()["stream_bytes"]["ecg"], 10000)
+    
+    def test_memory_budget_counts_held_samples_of_gappy_streams(self):
+        collector = MeasurementCollector(history_length_seconds=600.0, memory_budget_bytes=20000)
+        now = 1000.0
+        for stream_i in range(10):
+            for packet_i in range(5):
+                packet_timestamp = now - 100.0 + stream_i * 10.0 + packet_i
+                collector.handle_signal(create_packet(packet_timestamp, range(10)), packet_i == 0)
+        
+        collector.clean_up(now)
+        memory_usage = collector.get_memory_usage()
+        self.assertEqual(memory_usage["stream_bytes"]["ecg"], 10 * 50 * 2)
+        self.assertEqual(memory_usage["retention_seconds"]["ecg"], 600.0)
+        self.assertEqual(memory_usage["budget_eviction_count"], 0)
+        self.assertEqual(len(collector.query("ecg", 0.0, now)[1]), 500)
+        
+        signal_streams = collector.get_signal_stream_history("ecg").get_signal_streams()
+        self.assertEqual([signal_stream.capacity for signal_stream in signal_streams], [50] * 9 + [6000])
+        
+        # a lower retention only shrinks the ended streams
+        collector.get_signal_stream_history("ecg").set_history_length(300.0)
+        self.assertEqual([signal_stream.capacity for signal_stream in signal_streams], [50] * 9 + [3000])
+    
+    def test_cleanup_thread(self):
+        collector = MeasurementCollector(history_length_seconds=1.0)
+        collector.handle_event("heart_rate", (zephyr.time() - 2.0, 60))
+        
+        cleanup_thread = CollectorCleanupThread([collector], interval=0.01)
+        cleanup_thread.start()
+        deadline = time.time() + 1.0
+        while collector.last_cleanup_time is None and time.time() < deadline:
+            time.sleep(0.01)
+        cleanup_thread.terminate()
+        cleanup_thread.join()
+        
+        self.assertEqual(collector.get_event_stream("heart_rate").events_cleaned_up, 1)
+
+
+class LimitedTimedVirtualSerial(TimedVirtualSerial):
+    """Ends the replay after replay_seconds."""
+    def __init__(self, stream_data_path, timing_data_path, replay_seconds):
+        TimedVirtualSerial.__init__(self, stream_data_path, timing_data_path)
+        self.end_time = zephyr.time() + replay_seconds
+    
+    def read(self, byte_count):
+        if zephyr.time() > self.end_time:
+            raise EOFError("End of the replay")
+        return TimedVirtualSerial.read(self, byte_count)
+
+
+class SignalStreamHistoryConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self.original_time, self.original_sleep = zephyr.time, zephyr.sleep
+        zephyr.util.set_time_speed(10.0)
+    
+    def tearDown(self):
+        zephyr.time, zephyr.sleep = self.original_time, self.original_sleep
+    
+    def test_readers_during_replay_and_cleanup(self):
+        collector = MeasurementCollector(history_length_seconds=10.0, retention_seconds={"ecg": 0.5})
+        appended_samples = collections.defaultdict(list)
+        
+        def record_signal(signal_packet, starts_new_stream):
+            appended_samples[signal_packet.type].extend(numpy.asarray(signal_packet.samples).tolist())
+        
+        # the samples are recorded before the collector stores them, so every
+        # sample that a reader gets was recorded first
+        packet_handler = BioHarnessPacketHandler([record_signal, collector.handle_signal], [collector.handle_event])
+        payload_parser = MessagePayloadParser()
+        packet_handler.subscribe(payload_parser)
+        frame_parser = MessageFrameParser([payload_parser.handle_message])
+        
+        data_path, timing_path = list(iterate_test_recordings())[1]
+        connection = LimitedTimedVirtualSerial(data_path, timing_path, replay_seconds=30.0)
+        connection.paused = False
+        protocol = Protocol(connection, [frame_parser.parse_data])
+        
+        def replay():
+            try:
+                protocol.run()
+            except EOFError:
+                pass
+        
+        reads = collections.defaultdict(list)
+        errors = []
+        replay_done = threading.Event()
+        
+        def read_history(reader_i):
+            cursors = collections.defaultdict(int)
+            try:
+                while True:
+                    done = replay_done.is_set()
+                    for signal_type, signal_stream_history in collector.iterate_signal_stream_histories():
+                        cursor = cursors[signal_type]
+                        next_cursor, chunks = signal_stream_history.read_since(cursor, zephyr.time())
+                        start_timestamps = [start_timestamp for start_timestamp, samples in chunks] #@UnusedVariable
+                        self.assertEqual(start_timestamps, sorted(start_timestamps))
+                        reads[reader_i, signal_type].append((cursor, next_cursor,
+                                                             [samples.tolist() for start_timestamp, samples in chunks])) #@UnusedVariable
+                        cursors[signal_type] = next_cursor
+                        
+                        timestamps, samples = signal_stream_history.query(zephyr.time() - 2.0, zephyr.time())
+                        self.assertEqual(len(timestamps), len(samples))
+                    if done:
+                        break
+                    time.sleep(0.001)
+            except Exception as e:
+                errors.append(e)
+        
+        cleanup_thread = CollectorCleanupThread([collector], interval=0.01)
+        replay_thread = threading.Thread(target=replay)
+        reader_threads = [threading.Thread(target=read_history, args=(reader_i,)) for reader_i in range(4)]
+        for thread in [cleanup_thread, replay_thread] + reader_threads:
+            thread.start()
+        
+        replay_thread.join()
+        replay_done.set()
+        for reader_thread in reader_threads:
+            reader_thread.join()
+        cleanup_thread.terminate()
+        cleanup_thread.join()
+        
+        self.assertEqual(errors, [])
+        self.assertTrue(collector.get_signal_stream_history("ecg").samples_cleaned_up > 0)
+        
+        for (reader_i, signal_type), signal_reads in reads.items(): #@UnusedVariable
+            expected_samples = appended_samples[signal_type]
+            self.assertEqual(signal_reads[-1][1], len(expected_samples))
+            
+            for cursor, next_cursor, sample_chunks in signal_reads:
+                read_samples = sum(sample_chunks, [])
+                if next_cursor - cursor == len(read_samples):
+                    self.assertEqual(read_samples, expected_samples[cursor:next_cursor])
+                else:
+                    # samples were cleaned up before this reader got them
+                    last_chunk = sample_chunks[-1] if sample_chunks else []
+                    self.assertEqual(last_chunk, expected_samples[next_cursor - len(last_chunk):next_cursor])
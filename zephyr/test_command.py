@@ -0,0 +1,145 @@
+import os
+import time
+import unittest
+
+from zephyr.command import CommandPipeline
+from zephyr.protocol import BioHarnessProtocol, MessageFrame, MessageFrameParser, create_message_frame
+from zephyr.testing import PtySerial
+
+
+def create_response_frame(message_id, eom_byte="\x06"):
+    return create_message_frame(message_id, [])[:-1] + eom_byte
+
+
+class CommandPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.writes = []
+        self.connection_available = True
+        self.pipeline = CommandPipeline(self.send_data, response_timeout=0.05, max_attempts=2)
+    
+    def send_data(self, data_string):
+        if not self.connection_available:
+            return False
+        self.writes.append(data_string)
+        return True
+    
+    def test_burst_is_sent_in_one_write(self):
+        self.pipeline.submit_many([(0x15, [1]), (0x19, [1])])
+        self.pipeline.submit(0x16, [1])
+        
+        self.assertEqual(self.pipeline.flush(), 3)
+        self.assertEqual(self.writes, [create_message_frame(0x15, [1]) + create_message_frame(0x19, [1]) +
+                                       create_message_frame(0x16, [1])])
+        self.assertEqual(self.pipeline.flush(), 0)
+    
+    def test_responses_resolve_commands_in_order(self):
+        first_command = self.pipeline.submit(0x16, [1])
+        second_command = self.pipeline.submit(0x16, [0])
+        other_command = self.pipeline.submit(0x19, [1])
+        resolved_commands = []
+        other_command.add_done_callback(resolved_commands.append)
+        self.pipeline.flush()
+        
+        self.pipeline.handle_message(MessageFrame(0x16, [], "ETX"))
+        self.assertFalse(first_command.done())
+        
+        self.pipeline.handle_message(MessageFrame(0x19, [], "NAK"))
+        self.pipeline.handle_message(MessageFrame(0x16, [], "ACK"))
+        
+        self.assertEqual(resolved_commands, [other_command])
+        self.assertEqual(other_command.wait(0), "NAK")
+        self.assertEqual(first_command.wait(0), "ACK")
+        self.assertFalse(second_command.done())
+        self.assertTrue(first_command.round_trip_seconds >= 0.0)
+        self.assertEqual(self.pipeline.get_round_trip_statistics()["count"], 2)
+    
+    def test_commands_are_retried_until_timeout(self):
+        command = self.pipeline.submit(0x16, [1])
+        self.pipeline.flush()
+        
+        time.sleep(0.06)
+        self.assertEqual(self.pipeline.check_timeouts(), 1)
+        self.pipeline.flush()
+        self.assertEqual(len(self.writes), 2)
+        
+        time.sleep(0.06)
+        self.assertEqual(self.pipeline.check_timeouts(), 0)
+        self.assertEqual(command.wait(0), "TIMEOUT")
+        self.assertEqual(command.attempt_count, 2)
+        self.assertEqual(self.pipeline.outcome_counts["TIMEOUT"], 1)
+    
+    def test_commands_wait_for_the_connection(self):
+        self.connection_available = False
+        command = self.pipeline.submit(0x16, [1])
+        
+        self.assertEqual(self.pipeline.flush(), 0)
+        self.assertEqual(command.attempt_count, 0)
+        
+        self.connection_available = True
+        self.assertEqual(self.pipeline.flush(), 1)
+        self.assertEqual(self.writes, [command.message_frame])
+    
+    
+    def test_commands_can_be_submitted_during_a_write(self):
+        submitted_commands = []
+        
+        def send_data(data_string):
+            # a callback of the failing connection, which runs in the write
+            if not submitted_commands:
+                submitted_commands.append(self.pipeline.submit(0x19, [1]))
+                self.assertEqual(self.pipeline.flush(), 0)
+            return False
+        
+        self.pipeline.send_data = send_data
+        command = self.pipeline.submit(0x16, [1])
+        self.assertEqual(self.pipeline.flush(), 0)
+        self.assertEqual(list(self.pipeline.queued_commands), [command] + submitted_commands)
+        
+        self.pipeline.send_data = self.send_data
+        self.assertEqual(self.pipeline.flush(), 2)
+        self.assertEqual(self.writes[0][:len(command.message_frame)], command.message_frame)
+
+
+@unittest.skipIf(os.name != "posix", "pseudo terminals are not available")
+class ProtocolCommandTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = PtySerial()
+        
+        frame_parser = MessageFrameParser([])
+        self.protocol = BioHarnessProtocol(self.connection, [frame_parser.parse_data])
+        frame_parser.callbacks.append(self.protocol.commands.handle_message)
+        self.protocol.start()
+    
+    def tearDown(self):
+        self.protocol.terminate()
+        self.protocol.join()
+        self.connection.close()
+    
+    def test_commands_are_acknowledged(self):
+        commands = self.protocol.send_commands([(0x15, [1]), (0x19, [1])])
+        
+        expected_bytes = create_message_frame(0x15, [1]) + create_message_frame(0x19, [1])
+        received_bytes = ""
+        while len(received_bytes) < len(expected_bytes):
+            received_bytes += self.connection.device_read(4096)
+        self.assertEqual(received_bytes, expected_bytes)
+        
+        self.connection.device_write(create_response_frame(0x15) + create_response_frame(0x19, "\x15"))
+        
+        self.assertEqual([command.wait(1.0) for command in commands], ["ACK", "NAK"])
+        self.assertTrue(all(command.round_trip_seconds < 0.5 for command in commands))
+
+
+@unittest.skipIf(os.name != "posix", "pseudo terminals are not available")
+class ProtocolWakeupTest(unittest.TestCase):
+    def test_wakeups_do_not_block_when_the_pipe_is_full(self):
+        connection = PtySerial()
+        protocol = BioHarnessProtocol(connection, [])
+        protocol.open_wakeup_pipe()
+        try:
+            # more than the pipe holds, while no loop reads it
+            for wakeup_i in range(100000): #@UnusedVariable
+                protocol.wakeup()
+        finally:
+            protocol.close_wakeup_pipe()
+            connection.close()
@@ -0,0 +1,84 @@
+import random
+import unittest
+
+import numpy
+
+import zephyr
+from zephyr.collector import MeasurementCollector
+from zephyr.decimation import DecimationPyramid, compute_envelope
+from zephyr.message import SignalPacket
+
+
+class DecimationPyramidTest(unittest.TestCase):
+    def setUp(self):
+        random_generator = numpy.random.RandomState(0)
+        self.samples = random_generator.randint(-512, 512, 5000).astype(numpy.int16)
+        
+        self.pyramid = DecimationPyramid(len(self.samples), dtype=numpy.int16)
+        packet_random_generator = random.Random(0)
+        sample_index = 0
+        while sample_index < len(self.samples):
+            packet_length = packet_random_generator.randint(1, 100)
+            self.pyramid.append_samples(self.samples[sample_index:sample_index + packet_length])
+            sample_index += packet_length
+    
+    def test_envelope_matches_samples(self):
+        for from_index, to_index, max_points in [(0, 5000, 100), (123, 4567, 300), (4990, 5000, 5), (10, 20, 50)]:
+            envelope = self.pyramid.get_envelope(from_index, to_index, max_points)
+            if to_index - from_index <= max_points:
+                self.assertEqual(envelope, None)
+                continue
+            
+            sample_indices, minimums, maximums, means = envelope
+            bucket_length = sample_indices[1] - sample_indices[0]
+            self.assertTrue(len(sample_indices) <= max_points)
+            self.assertTrue(sample_indices[0] <= from_index < sample_indices[0] + bucket_length)
+            self.assertTrue(sample_indices[-1] < to_index <= sample_indices[-1] + bucket_length)
+            
+            for sample_index, minimum, maximum, mean in zip(sample_indices, minimums, maximums, means):
+                bucket_samples = self.samples[sample_index:sample_index + bucket_length]
+                self.assertEqual((minimum, maximum), (bucket_samples.min(), bucket_samples.max()))
+                self.assertAlmostEqual(mean, bucket_samples.mean())
+    
+    def test_envelope_of_fewer_points_than_top_buckets(self):
+        for from_index, max_points in [(0, 5), (0, 20), (1234, 7), (4000, 3)]:
+            sample_indices, minimums, maximums, means = self.pyramid.get_envelope(from_index, 5000, max_points)
+            self.assertTrue(len(sample_indices) <= max_points)
+            
+            bucket_ends = list(sample_indices[1:]) + [5000]
+            self.assertTrue(sample_indices[0] <= from_index < bucket_ends[0])
+            for sample_index, bucket_end, minimum, maximum, mean in zip(sample_indices, bucket_ends,
+                                                                        minimums, maximums, means):
+                bucket_samples = self.samples[sample_index:bucket_end]
+                self.assertEqual((minimum, maximum), (bucket_samples.min(), bucket_samples.max()))
+                self.assertAlmostEqual(mean, bucket_samples.mean())
+    
+    def test_compute_envelope(self):
+        sample_indices, minimums, maximums, means = compute_envelope(self.samples[:1000], 100)
+        self.assertEqual(len(sample_indices), 63)
+        self.assertEqual((minimums[1], maximums[1]), (self.samples[16:32].min(), self.samples[16:32].max()))
+        self.assertAlmostEqual(means[-1], self.samples[992:1000].mean())
+
+
+class CollectorEnvelopeTest(unittest.TestCase):
+    def test_decimated_and_raw_envelopes_agree(self):
+        collectors = [MeasurementCollector(60.0, decimated_signal_types=["ecg"]), MeasurementCollector(60.0)]
+        now = zephyr.time()
+        
+        random_generator = numpy.random.RandomState(0)
+        for packet_i in range(200):
+            samples = random_generator.randint(-512, 512, 63).astype(numpy.int16)
+            signal_packet = SignalPacket("ecg", now + packet_i * 0.252, 250.0, samples, packet_i % 256)
+            for collector in collectors:
+                collector.handle_signal(signal_packet, packet_i == 0)
+        
+        decimated_envelope, raw_envelope = [collector.query_envelope("ecg", now + 10.0, now + 40.0, 500)
+                                            for collector in collectors]
+        self.assertTrue(len(decimated_envelope[0]) <= 500)
+        for decimated_values, raw_values in zip(decimated_envelope[1:3], raw_envelope[1:3]):
+            self.assertEqual((decimated_values.min(), decimated_values.max()), (raw_values.min(), raw_values.max()))
+        
+        timestamps, minimums, maximums, means = collectors[0].query_envelope("ecg", now + 10.0, now + 10.5, 500)
+        self.assertTrue(125 <= len(timestamps) <= 126)
+        self.assertTrue(numpy.array_equal(minimums, maximums))
+        self.assertEqual(len(collectors[0].query_envelope("breathing", now, now + 10.0, 500)[0]), 0)
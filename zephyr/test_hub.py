@@ -0,0 +1,89 @@
+import os
+import time
+import collections
+import unittest
+
+from zephyr.async_protocol import SerialPortConnector
+from zephyr.hub import DeviceHub
+from zephyr.protocol import MessageFrameParser
+from zephyr.testing import PtySerial, PtyRecordingReplayer, iterate_test_recordings
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def parse_message_counts(data_path):
+    frames = []
+    with open(data_path, "rb") as data_file:
+        MessageFrameParser([frames.append]).parse_data(data_file.read())
+    return dict(collections.Counter(frame.message_id for frame in frames))
+
+
+@unittest.skipIf(os.name != "posix", "pseudo terminals are not available")
+class DeviceHubTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = DeviceHub()
+        self.devices = [PtySerial() for device_i in range(20)] #@UnusedVariable
+        
+        recordings = list(iterate_test_recordings())
+        self.device_recordings = [recordings[device_i % len(recordings)] for device_i in range(len(self.devices))]
+    
+    def tearDown(self):
+        self.hub.terminate()
+        self.hub.join()
+        for device in self.devices:
+            device.close()
+    
+    def add_devices(self):
+        for device_i, device in enumerate(self.devices):
+            self.hub.add_device("subject-%02d" % device_i, SerialPortConnector(os.ttyname(device.slave_fd)))
+        self.hub.start()
+        
+        self.assertTrue(wait_until(lambda: all(hub_device.connected for hub_device in self.hub.get_devices())))
+    
+    def test_simultaneous_recordings_are_routed_per_device(self):
+        self.add_devices()
+        
+        replayer = PtyRecordingReplayer(zip(self.devices, self.device_recordings), speed=1000.0)
+        replayer.start()
+        replayer.join()
+        
+        expected_message_counts = [parse_message_counts(data_path) for data_path, timing_path in self.device_recordings] #@UnusedVariable
+        
+        def all_frames_received():
+            return [statistics["message_counts"] for statistics in self.hub.get_statistics().values()] == expected_message_counts
+        
+        self.assertTrue(wait_until(all_frames_received))
+        
+        for hub_device, (data_path, timing_path) in zip(self.hub.get_devices(), self.device_recordings): #@UnusedVariable
+            statistics = hub_device.get_statistics()
+            self.assertEqual(statistics["byte_count"], os.path.getsize(data_path))
+            self.assertTrue(statistics["connected"])
+            self.assertEqual(statistics["error_counts"], {})
+            
+            signal_types = set(signal_type for signal_type, history in hub_device.collector.iterate_signal_stream_histories()) #@UnusedVariable
+            self.assertTrue(signal_types)
+        
+        self.assertEqual(len(self.hub.event_loop.socket_map), len(self.devices) + 1)
+    
+    def test_periodic_packets_are_enabled_on_connect(self):
+        self.add_devices()
+        
+        for device in self.devices:
+            initialization_bytes = ""
+            while len(initialization_bytes) < 10:
+                initialization_bytes += device.device_read(4096)
+            self.assertEqual(initialization_bytes[:2], "\x02\x15")
+    
+    def test_removed_device_is_disconnected(self):
+        self.add_devices()
+        
+        removed_device = self.hub.remove_device("subject-00")
+        
+        self.assertTrue(wait_until(lambda: not removed_device.connected))
+        self.assertEqual(len(self.hub.get_devices()), len(self.devices) - 1)
+        self.assertRaises(ValueError, self.hub.add_device, "subject-01", SerialPortConnector("/dev/null"))
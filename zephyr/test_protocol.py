@@ -0,0 +1,469 @@
+import os
+import time
+import shutil
+import random
+import tempfile
+import unittest
+import threading
+
+import zephyr
+import zephyr.util
+from zephyr.protocol import Protocol, MessageFrameParser, BytewiseMessageFrameParser, MessageDataLogger, \
+    ReconnectBackoff, create_message_frame
+from zephyr.recording import message_frame_to_bytes
+from zephyr.testing import TimedVirtualSerial, PtySerial, UnpluggablePty, TtySerial, iterate_test_recordings
+
+
+def replay_frames(data_path, timing_path, max_read_size):
+    original_time, original_sleep = zephyr.time, zephyr.sleep
+    zephyr.util.set_time_speed(1e6)
+    
+    try:
+        connection = TimedVirtualSerial(data_path, timing_path)
+        connection.paused = False
+        
+        frames = []
+        chunks = []
+        frame_parser = MessageFrameParser([frames.append])
+        protocol = Protocol(connection, [frame_parser.parse_data, chunks.append], max_read_size)
+        
+        try:
+            protocol.run()
+        except EOFError:
+            pass
+    finally:
+        zephyr.time, zephyr.sleep = original_time, original_sleep
+    
+    frame_contents = [(frame.message_id, frame.payload, frame.eom) for frame in frames]
+    return frame_contents, chunks
+
+
+class ScriptedSerial:
+    def __init__(self, reads):
+        self.reads = list(reads)
+        self.timeout = 1.0
+        self.open_count = 0
+        self.close_count = 0
+    
+    def read(self, byte_count):
+        return self.reads.pop(0)[:byte_count]
+    
+    def inWaiting(self):
+        return len(self.reads[0]) if self.reads else 0
+    
+    def open(self):
+        self.open_count += 1
+    
+    def close(self):
+        self.close_count += 1
+
+
+class ProtocolBulkReadTest(unittest.TestCase):
+    def test_bulk_reads_produce_identical_frames(self):
+        for data_path, timing_path in iterate_test_recordings():
+            byte_frames, byte_chunks = replay_frames(data_path, timing_path, 1)
+            bulk_frames, bulk_chunks = replay_frames(data_path, timing_path, 4096)
+            
+            self.assertTrue(len(byte_frames) > 100)
+            self.assertEqual(byte_frames, bulk_frames)
+            self.assertEqual("".join(byte_chunks), "".join(bulk_chunks))
+            self.assertTrue(len(bulk_chunks) < len(byte_chunks) / 10)
+    
+    def test_read_size_is_capped(self):
+        connection = ScriptedSerial(["\x00" * 100])
+        chunks = []
+        protocol = Protocol(connection, [chunks.append], max_read_size=30)
+        
+        protocol.read_and_handle_bytes(min(connection.inWaiting(), protocol.max_read_size))
+        
+        self.assertEqual(chunks, ["\x00" * 30])
+    
+    def test_timeout_closes_connection(self):
+        connection = ScriptedSerial(["", "\x02"])
+        chunks = []
+        events = []
+        protocol = Protocol(connection, [chunks.append], connection_callbacks=[events.append])
+        
+        protocol.read_and_handle_bytes(16)
+        self.assertEqual(connection.close_count, 1)
+        self.assertFalse(protocol.connected)
+        
+        self.assertTrue(protocol.reopen_connection())
+        protocol.read_and_handle_bytes(16)
+        
+        self.assertEqual(connection.open_count, 1)
+        self.assertEqual(chunks, ["\x02"])
+        self.assertEqual(events, ["disconnected", "connected"])
+
+
+def parse_in_chunks(parser_class, stream_bytes, chunk_sizes):
+    frames = []
+    parser = parser_class([frames.append])
+    
+    position = 0
+    for chunk_size in chunk_sizes:
+        parser.parse_data(stream_bytes[position:position + chunk_size])
+        position += chunk_size
+    parser.parse_data(stream_bytes[position:])
+    
+    return [(frame.message_id, list(frame.payload), frame.eom) for frame in frames]
+
+
+def corrupt(stream_bytes, corruption_count, random_generator):
+    stream_bytes = bytearray(stream_bytes)
+    for corruption_i in range(corruption_count): #@UnusedVariable
+        stream_bytes[random_generator.randrange(len(stream_bytes))] = random_generator.randrange(256)
+    return str(stream_bytes)
+
+
+def corrupt_frames(frames, corruption_probability, random_generator):
+    """Serializes the frames with some of them damaged and with garbage that
+    starts with a false STX in between. Returns the stream and the frames
+    that were left intact."""
+    stream_parts = []
+    intact_frames = []
+    
+    for frame in frames:
+        if random_generator.random() < corruption_probability:
+            garbage_length = random_generator.randint(0, 20)
+            stream_parts.append("\x02" + "".join(chr(random_generator.randrange(256)) for byte_i in range(garbage_length))) #@UnusedVariable
+        
+        frame_bytes = bytearray(message_frame_to_bytes(frame))
+        if random_generator.random() < corruption_probability:
+            byte_i = random_generator.randrange(len(frame_bytes))
+            frame_bytes[byte_i] = (frame_bytes[byte_i] + random_generator.randint(1, 255)) % 256
+        else:
+            intact_frames.append(get_frame_contents(frame))
+        stream_parts.append(str(frame_bytes))
+    
+    return "".join(stream_parts), intact_frames
+
+
+def get_frame_contents(frame):
+    return (frame.message_id, list(frame.payload), frame.eom)
+
+
+def is_subsequence(items, sequence):
+    sequence_iterator = iter(sequence)
+    return all(item in sequence_iterator for item in items)
+
+
+class MessageFrameParserTest(unittest.TestCase):
+    def setUp(self):
+        self.random_generator = random.Random(0)
+        self.streams = []
+        for data_path, timing_path in iterate_test_recordings(): #@UnusedVariable
+            with open(data_path, "rb") as data_file:
+                self.streams.append(data_file.read())
+    
+    def assert_parsers_agree(self, stream_bytes, chunk_sizes):
+        expected_frames = parse_in_chunks(BytewiseMessageFrameParser, stream_bytes, [])
+        frames = parse_in_chunks(MessageFrameParser, stream_bytes, chunk_sizes)
+        self.assertEqual(frames, expected_frames)
+        return frames
+    
+    def test_whole_stream(self):
+        for stream_bytes in self.streams:
+            frames = self.assert_parsers_agree(stream_bytes, [])
+            self.assertTrue(len(frames) > 200)
+    
+    def test_random_chunks(self):
+        for stream_bytes in self.streams:
+            chunk_sizes = [self.random_generator.randint(1, 100) for chunk_i in range(len(stream_bytes) / 10)] #@UnusedVariable
+            self.assert_parsers_agree(stream_bytes, chunk_sizes)
+    
+    def test_single_byte_chunks(self):
+        stream_bytes = self.streams[0][:2000]
+        self.assert_parsers_agree(stream_bytes, [1] * len(stream_bytes))
+    
+    def test_payloads_are_bytearrays(self):
+        frames = []
+        MessageFrameParser([frames.append]).parse_data(self.streams[0][:2000])
+        bytewise_frames = []
+        BytewiseMessageFrameParser([bytewise_frames.append]).parse_data(self.streams[0][:2000])
+        
+        frame, bytewise_frame = frames[0], bytewise_frames[0]
+        self.assertEqual(type(frame.payload), bytearray)
+        self.assertEqual(type(bytewise_frame.payload), list)
+        self.assertEqual(list(frame.payload), bytewise_frame.payload)
+        self.assertEqual(frame.payload[0], bytewise_frame.payload[0])
+        self.assertNotEqual(frame.payload, bytewise_frame.payload)
+    
+    def test_corrupted_stream(self):
+        for stream_bytes in self.streams:
+            corrupted_bytes = corrupt(stream_bytes, len(stream_bytes) / 200, self.random_generator)
+            chunk_sizes = [self.random_generator.randint(1, 300) for chunk_i in range(len(stream_bytes) / 50)] #@UnusedVariable
+            
+            dropping_frames = parse_in_chunks(BytewiseMessageFrameParser, corrupted_bytes, [])
+            frames = parse_in_chunks(MessageFrameParser, corrupted_bytes, chunk_sizes)
+            self.assertTrue(is_subsequence(dropping_frames, frames))
+    
+    def test_intact_frames_are_recovered_from_corrupted_stream(self):
+        for stream_bytes in self.streams:
+            original_frames = []
+            MessageFrameParser([original_frames.append]).parse_data(stream_bytes)
+            corrupted_bytes, intact_frames = corrupt_frames(original_frames, 0.1, self.random_generator)
+            # completes a false frame at the end that would still wait for its payload
+            corrupted_bytes += "\x00" * 133
+            
+            frames = []
+            parser = MessageFrameParser([frames.append])
+            for chunk_i in range(0, len(corrupted_bytes), 50):
+                parser.parse_data(corrupted_bytes[chunk_i:chunk_i + 50])
+            
+            frame_contents = map(get_frame_contents, frames)
+            self.assertTrue(len(intact_frames) > 100)
+            self.assertTrue(is_subsequence(intact_frames, frame_contents))
+            
+            self.assertTrue(parser.error_counts["CRC does not match"] > 0)
+            frame_byte_count = sum(len(frame.payload) + 5 for frame in frames)
+            discarded_byte_count = sum(parser.discarded_byte_counts.values())
+            self.assertEqual(frame_byte_count + discarded_byte_count + len(parser.buffer), len(corrupted_bytes))
+    
+    def test_frame_inside_rejected_frame_is_recovered(self):
+        valid_frame = create_message_frame(0x23, [])
+        # the false frame claims 5 payload bytes, which swallows the valid frame
+        stream_bytes = "\x02\x23\x05" + valid_frame + "\x00\x03"
+        
+        frames = []
+        parser = MessageFrameParser([frames.append])
+        parser.parse_data(stream_bytes)
+        
+        self.assertEqual(map(get_frame_contents, frames), [(0x23, [], "ETX")])
+        self.assertEqual(dict(parser.discarded_byte_counts), {"CRC does not match": 5})
+
+
+def get_cpu_time():
+    return sum(os.times()[:2])
+
+
+@unittest.skipIf(os.name != "posix", "pseudo terminals are not available")
+class ProtocolEventDrivenReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = PtySerial()
+        self.received = []
+        self.data_event = threading.Event()
+        self.protocol = Protocol(self.connection, [self.handle_data])
+        self.protocol.start()
+    
+    def tearDown(self):
+        self.protocol.terminate()
+        self.protocol.join()
+        self.connection.close()
+    
+    def handle_data(self, data_string):
+        self.received.append(data_string)
+        self.data_event.set()
+    
+    def test_idle_reader_uses_almost_no_cpu(self):
+        time.sleep(0.05)
+        
+        cpu_time_before = get_cpu_time()
+        time.sleep(0.5)
+        idle_cpu_time = get_cpu_time() - cpu_time_before
+        
+        self.assertTrue(idle_cpu_time < 0.05, "idle CPU time %.3f s" % idle_cpu_time)
+    
+    def test_reader_wakes_up_on_data(self):
+        time.sleep(0.05)
+        
+        write_time = time.time()
+        self.connection.device_write("\x02\x23\x00")
+        self.assertTrue(self.data_event.wait(1.0))
+        wakeup_latency = time.time() - write_time
+        
+        self.assertEqual("".join(self.received), "\x02\x23\x00")
+        self.assertTrue(wakeup_latency < 0.05, "wake-up latency %.3f s" % wakeup_latency)
+    
+    def test_terminate_wakes_up_reader(self):
+        time.sleep(0.05)
+        
+        terminate_time = time.time()
+        self.protocol.terminate()
+        self.protocol.join(1.0)
+        terminate_latency = time.time() - terminate_time
+        
+        self.assertFalse(self.protocol.is_alive())
+        self.assertTrue(terminate_latency < 0.05, "terminate latency %.3f s" % terminate_latency)
+
+
+@unittest.skipIf(os.name != "posix", "pseudo terminals are not available")
+class ProtocolReconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.port_directory = tempfile.mkdtemp()
+        self.device = UnpluggablePty(os.path.join(self.port_directory, "rfcomm0"))
+        self.connection = TtySerial(self.device.link_path)
+        self.connection.open()
+        
+        self.chunks = []
+        self.events = []
+    
+    def tearDown(self):
+        self.protocol.terminate()
+        self.protocol.join()
+        self.connection.close()
+        if self.device.master_fd is not None:
+            self.device.unplug()
+        shutil.rmtree(self.port_directory)
+    
+    def start_protocol(self, initial_delay, max_delay):
+        reconnect_backoff = ReconnectBackoff(initial_delay, max_delay, random_generator=random.Random(0))
+        self.protocol = Protocol(self.connection, [self.chunks.append], connection_callbacks=[self.events.append],
+                                 reconnect_backoff=reconnect_backoff)
+        self.protocol.start()
+    
+    def wait_until(self, condition, timeout=2.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.005)
+        return condition()
+    
+    def test_port_that_comes_back_is_reopened(self):
+        self.start_protocol(0.01, 0.04)
+        self.device.device_write("a")
+        self.assertTrue(self.wait_until(lambda: self.chunks == ["a"]))
+        
+        self.device.unplug()
+        self.assertTrue(self.wait_until(lambda: self.events == ["disconnected"]))
+        time.sleep(0.2)
+        self.device.plug()
+        self.assertTrue(self.wait_until(lambda: self.events == ["disconnected", "connected"]))
+        
+        self.device.device_write("b")
+        self.assertTrue(self.wait_until(lambda: self.chunks == ["a", "b"]))
+        
+        statistics = self.protocol.reconnect_backoff.get_statistics()
+        self.assertEqual(statistics["reconnect_count"], 1)
+        self.assertTrue(statistics["failed_attempt_count"] >= 4)
+        self.assertTrue(0.2 <= statistics["last_reconnect_seconds"] < 0.5)
+    
+    def test_failed_command_write_is_retried_after_reconnect(self):
+        original_write = self.connection.write
+        
+        def unplug_and_write(data):
+            # the device goes out of range in the middle of the flush
+            self.connection.write = original_write
+            self.device.unplug()
+            original_write(data)
+        
+        self.connection.write = unplug_and_write
+        self.start_protocol(0.01, 0.04)
+        command = self.protocol.send_command(0x16, [1])
+        self.assertTrue(self.wait_until(lambda: self.events == ["disconnected"]))
+        self.assertTrue(self.protocol.is_alive())
+        self.assertEqual(command.attempt_count, 0)
+        
+        self.device.plug()
+        self.assertTrue(self.wait_until(lambda: self.events == ["disconnected", "connected"]))
+        
+        received_bytes = ""
+        while len(received_bytes) < len(command.message_frame):
+            received_bytes += self.device.device_read(4096)
+        self.assertEqual(received_bytes, command.message_frame)
+        # the attempt is counted after the write returns
+        self.assertTrue(self.wait_until(lambda: command.attempt_count == 1))
+    
+    def test_terminate_cancels_reconnect(self):
+        self.start_protocol(10.0, 10.0)
+        self.device.unplug()
+        self.assertTrue(self.wait_until(lambda: self.events == ["disconnected"]))
+        
+        terminate_time = time.time()
+        self.protocol.terminate()
+        self.protocol.join(1.0)
+        terminate_latency = time.time() - terminate_time
+        
+        self.assertFalse(self.protocol.is_alive())
+        self.assertTrue(terminate_latency < 0.05, "terminate latency %.3f s" % terminate_latency)
+
+
+class ReconnectBackoffTest(unittest.TestCase):
+    def test_delays_grow_exponentially_with_jitter(self):
+        backoff = ReconnectBackoff(initial_delay=0.1, max_delay=1.0, jitter=0.2, random_generator=random.Random(0))
+        
+        backoff.connection_lost(100.0)
+        delays = [backoff.next_attempt_time - 100.0]
+        for attempt_i in range(6): #@UnusedVariable
+            backoff.attempt_failed(100.0)
+            delays.append(backoff.next_attempt_time - 100.0)
+        
+        for delay, nominal_delay in zip(delays, [0.1, 0.2, 0.4, 0.8, 1.0, 1.0, 1.0]):
+            self.assertTrue(0.8 * nominal_delay <= delay <= 1.2 * nominal_delay, (delay, nominal_delay))
+        self.assertNotEqual(delays[-1], delays[-2])
+        
+        backoff.connection_made(103.0)
+        self.assertEqual(backoff.get_statistics()["last_reconnect_seconds"], 3.0)
+
+
+class MessageDataLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.log_file_basepath = os.path.join(self.output_directory, "recording")
+        self.now = 1000.0
+        self.original_time, self.original_sleep = zephyr.time, zephyr.sleep
+        zephyr.time = lambda: self.now
+        zephyr.sleep = self.sleep
+    
+    def tearDown(self):
+        zephyr.time, zephyr.sleep = self.original_time, self.original_sleep
+        shutil.rmtree(self.output_directory)
+    
+    def sleep(self, seconds):
+        self.now += seconds
+    
+    def read_recording(self, file_basepath):
+        with open(file_basepath + ".dat", "rb") as data_file:
+            stream_bytes = data_file.read()
+        with open(file_basepath + "-timing.csv") as timing_file:
+            timing_rows = [line.strip().split(",") for line in timing_file]
+        return stream_bytes, [(float(timestamp), int(position)) for timestamp, position in timing_rows]
+    
+    def replay_recording(self, file_basepath):
+        connection = TimedVirtualSerial(file_basepath + ".dat", file_basepath + "-timing.csv")
+        chunks = []
+        try:
+            while True:
+                chunks.append(connection.read(4096))
+        except EOFError:
+            return "".join(chunks)
+    
+    def log_chunks(self, data_logger, chunk_count):
+        for chunk_i in range(chunk_count):
+            data_logger("%04d" % chunk_i)
+            self.now += 0.5
+    
+    def test_files_are_written_on_flush_and_close(self):
+        data_logger = MessageDataLogger(self.log_file_basepath, flush_interval=10.0)
+        self.log_chunks(data_logger, 4)
+        
+        self.assertEqual(self.read_recording(self.log_file_basepath), ("", []))
+        
+        data_logger.close()
+        stream_bytes, timing_rows = self.read_recording(self.log_file_basepath)
+        self.assertEqual(stream_bytes, "0000000100020003")
+        self.assertEqual(timing_rows, [(1000.0, 4), (1000.5, 8), (1001.0, 12), (1001.5, 16)])
+    
+    def test_rotation_by_size(self):
+        data_logger = MessageDataLogger(self.log_file_basepath, max_file_bytes=8)
+        self.log_chunks(data_logger, 5)
+        data_logger.close()
+        
+        self.assertEqual(self.read_recording(self.log_file_basepath),
+                         ("00000001", [(1000.0, 4), (1000.5, 8)]))
+        self.assertEqual(self.read_recording(self.log_file_basepath + "-001"),
+                         ("00020003", [(1001.0, 4), (1001.5, 8)]))
+        self.assertEqual(self.read_recording(self.log_file_basepath + "-002"),
+                         ("0004", [(1002.0, 4)]))
+        
+        for file_basepath, stream_bytes in [(self.log_file_basepath, "00000001"),
+                                            (self.log_file_basepath + "-001", "00020003"),
+                                            (self.log_file_basepath + "-002", "0004")]:
+            self.assertEqual(self.replay_recording(file_basepath), stream_bytes)
+    
+    def test_rotation_by_duration(self):
+        data_logger = MessageDataLogger(self.log_file_basepath, max_file_seconds=1.0)
+        self.log_chunks(data_logger, 3)
+        data_logger.close()
+        
+        self.assertEqual(self.read_recording(self.log_file_basepath)[0], "00000001")
+        self.assertEqual(self.read_recording(self.log_file_basepath + "-001")[0], "0002")
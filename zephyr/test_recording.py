@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+import collections
+
+import zephyr
+import zephyr.util
+from zephyr.protocol import Protocol, MessageFrameParser
+from zephyr.recording import Recording, RecordingWriter, RecordingError, convert_legacy_recording
+from zephyr.testing import RecordingVirtualSerial, iterate_test_recordings
+
+
+def parse_frames(stream_bytes):
+    frames = []
+    MessageFrameParser([frames.append]).parse_data(stream_bytes)
+    return [(frame.message_id, list(frame.payload), frame.eom) for frame in frames]
+
+
+def get_frame_contents(message_frames):
+    return [(frame.message_id, list(frame.payload), frame.eom) for frame in message_frames]
+
+
+class RecordingTest(unittest.TestCase):
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.recordings = []
+        
+        for recording_i, (data_path, timing_path) in enumerate(iterate_test_recordings()):
+            recording_path = os.path.join(self.output_directory, "recording-%d.zrec" % recording_i)
+            convert_legacy_recording(data_path, timing_path, recording_path)
+            
+            with open(data_path, "rb") as data_file:
+                expected_frames = parse_frames(data_file.read())
+            self.recordings.append((recording_path, expected_frames))
+    
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+    
+    def test_converted_frames_match_parsed_stream(self):
+        for recording_path, expected_frames in self.recordings:
+            recording = Recording(recording_path)
+            
+            self.assertTrue(len(expected_frames) > 200)
+            self.assertEqual(recording.frame_count, len(expected_frames))
+            
+            message_frames = [message_frame for timestamp, message_frame in recording.iterate_message_frames()] #@UnusedVariable
+            self.assertEqual(get_frame_contents(message_frames), expected_frames)
+            
+            expected_counts = collections.Counter(message_id for message_id, payload, eom in expected_frames) #@UnusedVariable
+            self.assertEqual(recording.get_message_counts(), dict(expected_counts))
+            recording.close()
+    
+    def test_seek_to_timestamp(self):
+        recording_path = self.recordings[0][0]
+        recording = Recording(recording_path)
+        all_frames = list(recording.iterate_frames())
+        
+        for fraction in [0.0, 0.25, 0.5, 0.999]:
+            seek_timestamp = recording.start_timestamp + fraction * (recording.end_timestamp - recording.start_timestamp)
+            frames = list(recording.iterate_frames(seek_timestamp, seek_timestamp + 10.0))
+            
+            first_frame_i = len(all_frames) - len(list(recording.iterate_frames(seek_timestamp)))
+            self.assertEqual(frames[0], all_frames[first_frame_i])
+            self.assertTrue(frames[0][0] >= seek_timestamp)
+            if first_frame_i > 0:
+                self.assertTrue(all_frames[first_frame_i - 1][0] < seek_timestamp)
+            self.assertTrue(frames[-1][0] <= seek_timestamp + 10.0)
+        
+        self.assertEqual(list(recording.iterate_frames(recording.end_timestamp + 1.0)), [])
+        recording.close()
+    
+    def test_unclosed_recording_is_rejected(self):
+        recording_path = os.path.join(self.output_directory, "unclosed.zrec")
+        writer = RecordingWriter(recording_path)
+        writer.write_frame(1000.0, "\x02\x23\x00\x00\x03")
+        writer.output_file.close()
+        
+        self.assertRaises(RecordingError, Recording, recording_path)
+    
+    def test_replay_through_protocol(self):
+        recording_path, expected_frames = self.recordings[0]
+        
+        original_time, original_sleep = zephyr.time, zephyr.sleep
+        zephyr.util.set_time_speed(1e6)
+        
+        try:
+            connection = RecordingVirtualSerial(recording_path)
+            connection.paused = False
+            
+            frames = []
+            frame_parser = MessageFrameParser([frames.append])
+            protocol = Protocol(connection, [frame_parser.parse_data])
+            
+            try:
+                protocol.run()
+            except EOFError:
+                pass
+            connection.close()
+        finally:
+            zephyr.time, zephyr.sleep = original_time, original_sleep
+        
+        self.assertEqual(get_frame_contents(frames), expected_frames)
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from zephyr.collector import MeasurementCollector
+from zephyr.message import SignalPacket
+from zephyr.segments import SegmentStore
+
+
+class SegmentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+    
+    def test_queries_across_segments(self):
+        segment_store = SegmentStore(self.output_directory, "acceleration", segment_length=16)
+        self.assertEqual(segment_store.query(0.0, 10.0), None)
+        
+        samples = numpy.arange(150, dtype=numpy.float32).reshape(50, 3)
+        for first_row in range(0, 50, 7):
+            segment_store.append(numpy.arange(first_row, min(50, first_row + 7)) * 0.1, samples[first_row:first_row + 7])
+        segment_store.close()
+        
+        self.assertEqual(len(segment_store.segments), 4)
+        self.assertEqual(sorted(os.listdir(self.output_directory))[:2],
+                         ["acceleration-000000.samples.npy", "acceleration-000000.timestamps.npy"])
+        self.assertAlmostEqual(segment_store.end_timestamp, 4.9)
+        
+        timestamps, queried_samples = segment_store.query(1.45, 3.35)
+        numpy.testing.assert_allclose(timestamps, numpy.arange(15, 34) * 0.1)
+        self.assertEqual(queried_samples.dtype, numpy.float32)
+        self.assertEqual(queried_samples.tolist(), samples[15:34].tolist())
+        
+        timestamps, queried_samples = segment_store.query(0.0, 10.0, before_timestamp=0.3)
+        self.assertEqual(queried_samples.tolist(), samples[:3].tolist())
+        self.assertEqual(len(segment_store.query(20.0, 30.0)[0]), 0)
+        
+        self.assertEqual(numpy.load(os.path.join(self.output_directory, "acceleration-000001.samples.npy")).tolist(),
+                         samples[16:32].tolist())
+    
+    
+    def test_sealed_segments_are_unmapped(self):
+        def count_file_descriptors():
+            return len(os.listdir("/proc/self/fd"))
+        
+        open_file_descriptor_count = count_file_descriptors()
+        segment_store = SegmentStore(self.output_directory, "ecg", segment_length=10, mapped_segment_count=2)
+        samples = numpy.arange(1000, dtype=numpy.int16)
+        for first_row in range(0, 1000, 25):
+            segment_store.append(numpy.arange(first_row, first_row + 25) * 0.004, samples[first_row:first_row + 25])
+        
+        self.assertEqual([segment.mapped for segment in segment_store.segments], [False] * 99 + [True])
+        self.assertEqual(segment_store.query(0.0, 10.0)[1].tolist(), samples.tolist())
+        self.assertEqual(sum(segment.mapped for segment in segment_store.segments), 3)
+        self.assertEqual(segment_store.query(1.0, 1.01)[1].tolist(), samples[250:253].tolist())
+        if os.path.isdir("/proc/self/fd"):
+            self.assertTrue(count_file_descriptors() - open_file_descriptor_count <= 6)
+        
+        segment_store.close()
+        self.assertEqual(sum(segment.mapped for segment in segment_store.segments), 2)
+        self.assertRaises(IOError, SegmentStore(self.output_directory, "ecg").append, [0.0], [0])
+
+
+class CollectorSpillTest(unittest.TestCase):
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+    
+    def test_queries_span_memory_and_segments(self):
+        collector = MeasurementCollector(history_length_seconds=10.0, retention_seconds={"ecg": 2.0},
+                                         spill_directory=os.path.join(self.output_directory, "spill"),
+                                         segment_length=1000)
+        samples = numpy.arange(120 * 63, dtype=numpy.int16)
+        
+        for packet_i in range(120):
+            packet_timestamp = 1000.0 + packet_i * 0.252
+            collector.handle_signal(SignalPacket("ecg", packet_timestamp, 250.0,
+                                                 samples[packet_i * 63:(packet_i + 1) * 63], packet_i % 256),
+                                    packet_i == 60)
+            collector.handle_event("heart_rate", (packet_timestamp, packet_i))
+            if packet_i % 4 == 3:
+                collector.clean_up(packet_timestamp + 0.252)
+        
+        memory_usage = collector.get_memory_usage()
+        self.assertEqual(memory_usage["stream_bytes"]["ecg"], 1000)
+        self.assertTrue(memory_usage["spilled_bytes"]["ecg"] >= len(samples) * 10)
+        
+        timestamps, ecg_samples = collector.query("ecg", 0.0, 2000.0)
+        self.assertEqual(ecg_samples.tolist(), samples.tolist())
+        self.assertTrue(numpy.all(numpy.diff(timestamps) > 0))
+        self.assertAlmostEqual(timestamps[0], 1000.0)
+        
+        # a window that starts in the segments and ends in memory
+        timestamps, ecg_samples = collector.query("ecg", 1027.5, 1029.0)
+        self.assertEqual(ecg_samples.tolist(), samples[6875:7251].tolist())
+        self.assertEqual(collector.query("heart_rate", 1000.0, 1001.0)[1].tolist(), [0, 1, 2, 3])
+        self.assertEqual(collector.query("heart_rate", 0.0, 2000.0)[1].tolist(), range(120))
+    
+    def test_collectors_spill_to_directories_of_their_own(self):
+        spill_directory = os.path.join(self.output_directory, "spill")
+        collectors = [MeasurementCollector(history_length_seconds=20.0, spill_directory=spill_directory,
+                                           segment_length=100) for collector_i in range(2)] #@UnusedVariable
+        for collector_i, collector in enumerate(collectors):
+            for packet_i in range(10):
+                collector.handle_signal(SignalPacket("ecg", 1000.0 + packet_i, 10.0,
+                                                     numpy.array([collector_i] * 10, numpy.int16), packet_i), packet_i == 0)
+            collector.clean_up(1030.0)
+            collector.close()
+        
+        self.assertEqual(len(set(collector.segment_directory for collector in collectors)), 2)
+        for collector_i, collector in enumerate(collectors):
+            self.assertEqual(collector.query("ecg", 0.0, 2000.0)[1].tolist(), [collector_i] * 100)
+    
+    def test_memory_budget_keeps_samples_until_they_are_spilled(self):
+        collector = MeasurementCollector(history_length_seconds=100.0, minimum_retention_seconds=5.0,
+                                         spill_directory=os.path.join(self.output_directory, "spill"))
+        now = 1000.0
+        samples = numpy.arange(10000, dtype=numpy.int16)
+        for packet_i in range(100):
+            collector.handle_signal(SignalPacket("ecg", now - 100.0 + packet_i, 100.0,
+                                                 samples[packet_i * 100:(packet_i + 1) * 100], packet_i % 256),
+                                    packet_i == 0)
+        collector.clean_up(now - 10.0)
+        
+        collector.memory_budget_bytes = 1
+        collector.clean_up(now)
+        self.assertEqual(collector.get_retention_seconds("ecg"), 20.0)
+        self.assertEqual(collector.query("ecg", 0.0, now)[1].tolist(), samples.tolist())
@@ -0,0 +1,71 @@
+import unittest
+import collections
+
+from zephyr.bioharness import BioHarnessPacketHandler
+from zephyr.collector import MeasurementCollector
+from zephyr.message import MessagePayloadParser
+from zephyr.protocol import MessageFrameParser
+from zephyr.testing import iterate_test_recordings
+from zephyr.tracing import LatencyTracer, LatencyTrace, monotonic_time
+
+
+class LatencyTracerTest(unittest.TestCase):
+    def setUp(self):
+        self.output_traces = []
+        self.tracer = LatencyTracer(sample_interval=10, trace_callbacks=[self.output_traces.append])
+        
+        collector = MeasurementCollector()
+        packet_handler = BioHarnessPacketHandler([collector.handle_signal, self.tracer.handle_signal],
+                                                 [collector.handle_event, self.tracer.handle_event])
+        payload_parser = MessagePayloadParser([self.tracer.handle_message, packet_handler.handle_packet])
+        
+        self.frames = []
+        self.frame_parser = MessageFrameParser([self.tracer.handle_frame, self.frames.append,
+                                                payload_parser.handle_message])
+    
+    def replay_recording(self):
+        data_path, timing_path = next(iterate_test_recordings()) #@UnusedVariable
+        with open(data_path, "rb") as data_file:
+            stream_bytes = data_file.read()
+        
+        for chunk_start in range(0, len(stream_bytes), 256):
+            chunk = stream_bytes[chunk_start:chunk_start + 256]
+            self.tracer.handle_data(chunk)
+            self.frame_parser.parse_data(chunk)
+    
+    def test_sampled_frames_are_traced_through_stages(self):
+        self.replay_recording()
+        
+        statistics = self.tracer.get_statistics()
+        frame_counts = collections.Counter(frame.message_id for frame in self.frames)
+        
+        self.assertEqual(sorted(statistics.keys()), sorted(frame_counts.keys()))
+        for message_id, message_statistics in statistics.items():
+            self.assertEqual(message_statistics["frame"]["stage"]["count"], (frame_counts[message_id] + 9) // 10)
+        
+        breathing_statistics = statistics[0x21]
+        self.assertEqual(breathing_statistics.keys(), ["frame", "payload", "collector"])
+        for stage_statistics in breathing_statistics.values():
+            self.assertTrue(0.0 <= stage_statistics["stage"]["p50"] <= stage_statistics["stage"]["max"])
+            self.assertTrue(stage_statistics["stage"]["max"] <= stage_statistics["cumulative"]["max"])
+        
+        for stream_name in ["breathing", "heart_rate", "activity"]:
+            self.tracer.handle_stream_output(stream_name, float("inf"), 1.0)
+        
+        self.assertEqual(len(self.output_traces), statistics[0x21]["collector"]["stage"]["count"] +
+                         statistics[0x2B]["collector"]["stage"]["count"])
+        for trace in self.output_traces:
+            self.assertTrue(self.tracer.stamp(trace, "gui"))
+            self.assertFalse(self.tracer.stamp(trace, "gui"))
+        
+        self.assertEqual(self.tracer.get_statistics()[0x2B].keys(),
+                         ["frame", "payload", "collector", "delayed_stream", "gui"])
+    
+    def test_scheduled_delay_is_not_latency(self):
+        trace = LatencyTrace(0x21, monotonic_time() - 2.5)
+        self.tracer.stamp(trace, "collector", trace.stage_times["read"] + 0.5)
+        self.tracer.stamp(trace, "delayed_stream", trace.stage_times["read"] + 2.5, scheduled_delay=1.5)
+        
+        statistics = self.tracer.get_statistics()[0x21]["delayed_stream"]
+        self.assertAlmostEqual(statistics["stage"]["max"], 0.5)
+        self.assertAlmostEqual(statistics["cumulative"]["max"], 1.0)
@@ -0,0 +1,304 @@
+import time
+import pickle
+import random
+import datetime
+import unittest
+
+import numpy
+
+import zephyr.util
+import zephyr.message
+from zephyr.protocol import MessageFrame, create_message_frame
+
+
+class Crc8Test(unittest.TestCase):
+    def setUp(self):
+        self.random_generator = random.Random(0)
+    
+    def random_payload(self, length):
+        return [self.random_generator.randrange(256) for byte_i in range(length)] #@UnusedVariable
+    
+    def test_table_matches_bitwise_digest(self):
+        for length in range(129):
+            for repetition in range(5): #@UnusedVariable
+                payload = self.random_payload(length)
+                self.assertEqual(zephyr.util.crc_8_digest(payload),
+                                 zephyr.util.crc_8_digest_bitwise(payload))
+    
+    def test_digest_of_bytearray(self):
+        payload = self.random_payload(128)
+        self.assertEqual(zephyr.util.crc_8_digest(bytearray(payload)),
+                         zephyr.util.crc_8_digest_bitwise(payload))
+    
+    def test_batch_verification(self):
+        frames = [create_message_frame(0x22, self.random_payload(self.random_generator.randint(0, 128)))
+                  for frame_i in range(500)] #@UnusedVariable
+        
+        frame_offsets = []
+        position = 0
+        for frame in frames:
+            frame_offsets.append(position)
+            position += len(frame)
+        
+        data_bytes = bytearray("".join(frames))
+        payload_lengths = [len(frame) - 5 for frame in frames]
+        payload_offsets = [offset + 3 for offset in frame_offsets]
+        crc_offsets = [offset + length for offset, length in zip(payload_offsets, payload_lengths)]
+        
+        corrupted_frames = set(self.random_generator.sample(range(len(frames)), 50))
+        for frame_i in corrupted_frames:
+            data_bytes[crc_offsets[frame_i]] ^= 0xFF
+        
+        crcs = zephyr.util.crc_8_digests(data_bytes, payload_offsets, payload_lengths)
+        valid = zephyr.util.verify_crc_8_digests(data_bytes, payload_offsets, payload_lengths, crc_offsets)
+        
+        for frame_i, (offset, length) in enumerate(zip(payload_offsets, payload_lengths)):
+            self.assertEqual(crcs[frame_i], zephyr.util.crc_8_digest(data_bytes[offset:offset + length]))
+            self.assertEqual(valid[frame_i], frame_i not in corrupted_frames)
+    
+    def test_empty_batch(self):
+        self.assertEqual(len(zephyr.util.verify_crc_8_digests("", [], [], [])), 0)
+
+
+class BitUnpackingTest(unittest.TestCase):
+    def setUp(self):
+        random_generator = random.Random(0)
+        self.payloads = [bytearray(random_generator.randrange(256) for byte_i in range(79)) #@UnusedVariable
+                         for payload_i in range(20)] #@UnusedVariable
+    
+    def test_array_matches_values(self):
+        for payload in self.payloads:
+            for byte_count in [79, 80, 41, 10, 2]:
+                for value_nbits, twos_complement in [(10, False), (10, True), (16, False), (16, True)]:
+                    expected_values = zephyr.util.unpack_bit_packed_values(payload[:byte_count], value_nbits, twos_complement)
+                    values = zephyr.util.unpack_bit_packed_array(payload[:byte_count], value_nbits, twos_complement)
+                    self.assertEqual(values.tolist(), expected_values)
+    
+    def test_decoded_samples_match_values(self):
+        for payload in self.payloads:
+            for byte_count in [79, 80, 41, 10, 2]:
+                for twos_complement, offset in [(False, 0), (False, -512), (True, 0), (True, 100)]:
+                    expected_values = zephyr.util.unpack_bit_packed_values(payload[:byte_count], 10, twos_complement)
+                    samples = zephyr.util.decode_bit_packed_samples(payload[:byte_count], 10, twos_complement,
+                                                                    offset=offset, dtype=numpy.int16)
+                    self.assertEqual(samples.dtype, numpy.int16)
+                    self.assertEqual(samples.tolist(), [value + offset for value in expected_values])
+    
+    def test_sample_parsers(self):
+        for payload in self.payloads:
+            ecg_samples = zephyr.message.parse_10_bit_samples(payload)
+            self.assertEqual(ecg_samples.dtype, numpy.int16)
+            self.assertEqual(ecg_samples.tolist(), [value - 512 for value in
+                                                    zephyr.util.unpack_bit_packed_values(payload, 10, False)])
+            
+            rr_samples = zephyr.message.parse_16_bit_samples(payload[:-1])
+            self.assertEqual(rr_samples.tolist(), [value * 0.001 for value in
+                                                   zephyr.util.unpack_bit_packed_values(payload[:-1], 16, True)])
+    
+    def test_accelerometer_samples(self):
+        for payload in self.payloads:
+            for byte_count in [79, 75, 41, 10, 2]:
+                interleaved_values = zephyr.message.parse_10_bit_samples(payload[:byte_count]).tolist()
+                expected_samples = zip(interleaved_values[0::3], interleaved_values[1::3], interleaved_values[2::3])
+                
+                samples = zephyr.message.parse_accelerometer_samples(payload[:byte_count])
+                self.assertEqual((samples.dtype, samples.shape), (numpy.float32, (len(expected_samples), 3)))
+                self.assertTrue(samples.flags.c_contiguous)
+                numpy.testing.assert_allclose(samples.reshape(-1), numpy.divide(sum(expected_samples, ()), 20.75),
+                                              rtol=1e-6)
+    
+    def test_batch_matches_single_packets(self):
+        payloads = [bytearray(9) + payload for payload in self.payloads]
+        
+        for sample_parser in [zephyr.message.parse_10_bit_samples, zephyr.message.parse_16_bit_samples]:
+            sample_batch = zephyr.message.parse_signal_packet_sample_batch(payloads, sample_parser)
+            
+            self.assertEqual(sample_batch.shape[0], len(payloads))
+            for samples, payload in zip(sample_batch, payloads):
+                self.assertEqual(samples.tolist(), sample_parser(payload[9:]).tolist())
+
+
+class PayloadDecoderTest(unittest.TestCase):
+    def setUp(self):
+        random_generator = random.Random(0)
+        self.payloads = []
+        for payload_i in range(50): #@UnusedVariable
+            payload = bytearray(random_generator.randrange(256) for byte_i in range(71)) #@UnusedVariable
+            payload[1:5] = bytearray([0xDF, 0x07, random_generator.randint(1, 12), random_generator.randint(1, 28)])
+            self.payloads.append(payload)
+    
+    def get_expected_timestamp(self, timestamp_bytes):
+        year = zephyr.util.uint16_from_two_bytes(timestamp_bytes[0:2])
+        date = datetime.date(year=year, month=timestamp_bytes[2], day=timestamp_bytes[3])
+        day_milliseconds = sum(byte << (8 * byte_i) for byte_i, byte in enumerate(timestamp_bytes[4:8]))
+        return time.mktime(date.timetuple()) + day_milliseconds / 1000.0
+    
+    def test_timestamp(self):
+        for payload in self.payloads:
+            expected_timestamp = self.get_expected_timestamp(payload[1:9])
+            self.assertEqual(zephyr.util.parse_timestamp(payload[1:9]), expected_timestamp)
+            self.assertEqual(zephyr.util.parse_timestamp(payload, 1), expected_timestamp)
+            self.assertEqual(zephyr.util.parse_timestamp(list(payload[1:9])), expected_timestamp)
+    
+    def test_summary_packet(self):
+        for payload in self.payloads:
+            message = zephyr.message.parse_summary_packet(payload)
+            uint16_values = zephyr.util.parse_uint16_values_from_byte_sequence([10, 12, 14, 16, 18, 20, 25], payload)
+            
+            self.assertEqual(message.sequence_number, payload[0])
+            self.assertEqual(message.timestamp, self.get_expected_timestamp(payload[1:9]))
+            self.assertEqual((message.heart_rate, message.posture, message.breathing_wave_amplitude),
+                             (uint16_values[0], uint16_values[3], uint16_values[6]))
+            self.assertEqual((message.respiration_rate, message.skin_temperature, message.activity,
+                              message.peak_acceleration),
+                             (uint16_values[1] * 0.1, uint16_values[2] * 0.1, uint16_values[4] * 0.01,
+                              uint16_values[5] * 0.01))
+            self.assertEqual((message.breathing_confidence, message.heart_rate_confidence), (payload[29], payload[34]))
+            self.assertEqual(zephyr.message.parse_summary_packet(list(payload)), message)
+    
+    def test_hxm_message(self):
+        for payload in self.payloads:
+            message = zephyr.message.parse_hxm_message(payload[:60])
+            
+            self.assertEqual((message.heart_rate, message.heartbeat_number), tuple(payload[9:11]))
+            self.assertEqual(message.heartbeat_milliseconds,
+                             list(zephyr.util.parse_uint16_values_from_bytes(payload[11:41])))
+            distance, speed, strides = zephyr.util.parse_uint16_values_from_bytes(payload[47:53])
+            self.assertEqual((message.distance, message.speed, message.strides),
+                             (distance / 16.0, speed / 256.0, strides))
+    
+    def test_signal_packet_header_and_battery_status(self):
+        parse_signal_packet = zephyr.message.MESSAGE_TYPES[0x21]
+        
+        for payload in self.payloads:
+            signal_packet = parse_signal_packet(payload[:32])
+            self.assertEqual(signal_packet.sequence_number, payload[0])
+            self.assertEqual(signal_packet.timestamp, self.get_expected_timestamp(payload[1:9]))
+            self.assertEqual(signal_packet.samples.tolist(), zephyr.message.parse_10_bit_samples(payload[9:32]).tolist())
+            
+            battery_status = zephyr.message.parse_battery_status(payload[:3])
+            self.assertEqual(battery_status, (zephyr.util.uint16_from_two_bytes(payload[0:2]), payload[2]))
+
+
+class LazySignalPacketTest(unittest.TestCase):
+    def setUp(self):
+        random_generator = random.Random(0)
+        self.decoded_payloads = []
+        
+        def parse_samples(signal_bytes):
+            self.decoded_payloads.append(signal_bytes)
+            return zephyr.message.parse_10_bit_samples(signal_bytes)
+        
+        self.parse_signal_packet = zephyr.message.signal_packet_payload_parser_factory(
+            parse_samples, "ecg", 250.0, zephyr.message.count_10_bit_samples)
+        self.eager_parse_signal_packet = zephyr.message.signal_packet_payload_parser_factory(
+            zephyr.message.parse_10_bit_samples, "ecg", 250.0)
+        
+        self.payload = bytearray(random_generator.randrange(256) for byte_i in range(88)) #@UnusedVariable
+        self.payload[1:5] = bytearray([0xDF, 0x07, 3, 14])
+    
+    def test_samples_are_decoded_once_on_access(self):
+        signal_packet = self.parse_signal_packet(self.payload)
+        
+        self.assertTrue(isinstance(signal_packet, zephyr.message.SignalPacket))
+        self.assertEqual(zephyr.message.get_sample_count(signal_packet), 63)
+        corrected_packet = signal_packet._replace(timestamp=signal_packet.timestamp + 1.0)
+        self.assertEqual(self.decoded_payloads, [])
+        
+        samples = corrected_packet.samples
+        self.assertEqual(len(self.decoded_payloads), 1)
+        self.assertTrue(corrected_packet.samples is samples)
+        self.assertEqual(len(self.decoded_payloads), 1)
+        # the samples are decoded from a view of the payload
+        self.assertTrue(numpy.may_share_memory(self.decoded_payloads[0], numpy.frombuffer(self.payload, numpy.uint8)))
+    
+    def test_namedtuple_interface(self):
+        signal_packet = self.parse_signal_packet(self.payload)
+        eager_signal_packet = self.eager_parse_signal_packet(self.payload)
+        
+        signal_type, timestamp, samplerate, samples, sequence_number = signal_packet
+        self.assertEqual((signal_type, timestamp, samplerate, sequence_number),
+                         (eager_signal_packet.type, eager_signal_packet.timestamp, 250.0,
+                          eager_signal_packet.sequence_number))
+        self.assertEqual(samples.tolist(), eager_signal_packet.samples.tolist())
+        self.assertTrue(signal_packet[3] is samples)
+        self.assertEqual(signal_packet[:3], (signal_type, timestamp, samplerate))
+        self.assertEqual(signal_packet._asdict()["sequence_number"], sequence_number)
+        
+        unpickled_packet = pickle.loads(pickle.dumps(signal_packet))
+        self.assertEqual(type(unpickled_packet), zephyr.message.SignalPacket)
+        self.assertEqual(unpickled_packet.samples.tolist(), samples.tolist())
+        
+        replaced_packet = signal_packet._replace(samples=[1, 2])
+        self.assertEqual(replaced_packet, ("ecg", timestamp, samplerate, [1, 2], sequence_number))
+    
+    def test_plain_packet_representations(self):
+        signal_packet = self.parse_signal_packet(self.payload)
+        eager_signal_packet = self.eager_parse_signal_packet(self.payload)
+        
+        self.assertEqual(repr(signal_packet), repr(eager_signal_packet))
+        self.assertEqual(signal_packet._asdict()["samples"].tolist(), eager_signal_packet.samples.tolist())
+        
+        decoded_packet = signal_packet.decode()
+        self.assertEqual(type(decoded_packet), zephyr.message.SignalPacket)
+        self.assertTrue(decoded_packet.samples is signal_packet.samples)
+        self.assertTrue((lambda *fields: fields[3])(*decoded_packet) is signal_packet.samples)
+        self.assertEqual("%s %s %s %s %s" % decoded_packet, "%s %s %s %s %s" % eager_signal_packet)
+    
+    def test_sample_counts(self):
+        for message_id in [0x21, 0x22, 0x24, 0x25]:
+            parse_signal_packet = zephyr.message.MESSAGE_TYPES[message_id]
+            for payload_length in range(9, 89):
+                signal_packet = parse_signal_packet(self.payload[:payload_length])
+                self.assertEqual(signal_packet.sample_count, len(signal_packet.samples))
+
+
+class MessagePayloadParserTest(unittest.TestCase):
+    def setUp(self):
+        random_generator = random.Random(0)
+        self.payload = bytearray(random_generator.randrange(256) for byte_i in range(71)) #@UnusedVariable
+        self.payload[1:5] = bytearray([0xDF, 0x07, 3, 14])
+        
+        self.payload_parser = zephyr.message.MessagePayloadParser()
+        self.summary_messages = []
+        self.signal_packets = []
+        self.payload_parser.subscribe([0x2B], self.summary_messages.append)
+        self.payload_parser.subscribe([0x21, 0x2B], self.signal_packets.append)
+    
+    def test_messages_are_delivered_to_subscribers_of_their_id(self):
+        for message_id in [0x2B, 0x21, 0x22]:
+            self.payload_parser.handle_message(MessageFrame(message_id, self.payload, "ETX"))
+        
+        self.assertEqual([type(message) for message in self.summary_messages], [zephyr.message.SummaryMessage])
+        self.assertEqual([getattr(message, "type", None) for message in self.signal_packets], [None, "breathing"])
+        
+        self.payload_parser.unsubscribe([0x2B], self.signal_packets.append)
+        self.payload_parser.handle_message(MessageFrame(0x2B, self.payload, "ETX"))
+        self.assertEqual((len(self.summary_messages), len(self.signal_packets)), (2, 2))
+    
+    def test_only_header_only_subscribers_get_lazy_packets(self):
+        header_packets = []
+        self.payload_parser.subscribe([0x21, 0x22], header_packets.append, header_only=True)
+        for message_id in [0x21, 0x22]:
+            self.payload_parser.handle_message(MessageFrame(message_id, self.payload, "ETX"))
+        
+        signal_packet, = self.signal_packets
+        self.assertTrue(header_packets[0] is signal_packet)
+        self.assertEqual(type(signal_packet), zephyr.message.SignalPacket)
+        self.assertTrue((lambda *fields: fields[3])(*signal_packet) is signal_packet.samples)
+        self.assertTrue(str(signal_packet.samples) in "%s %s %s %s %s" % signal_packet)
+        self.assertEqual(type(header_packets[1]), zephyr.message.LazySignalPacket)
+        
+        self.payload_parser.unsubscribe([0x22], header_packets.append)
+        self.assertEqual(self.payload_parser.header_only_subscriptions, {0x21: [header_packets.append]})
+    
+    def test_unsubscribed_payloads_are_not_parsed(self):
+        # the empty payload is too short for a signal packet header
+        self.payload_parser.handle_message(MessageFrame(0x22, bytearray(), "ETX"))
+        self.assertRaises(ValueError, self.payload_parser.subscribe, [0x99], self.summary_messages.append)
+        
+        broadcast_messages = []
+        self.payload_parser.callbacks.append(broadcast_messages.append)
+        self.payload_parser.handle_message(MessageFrame(0x22, self.payload, "ETX"))
+        self.assertEqual([message.type for message in broadcast_messages], ["ecg"])
+        self.assertEqual(self.signal_packets, [])
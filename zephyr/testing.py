@@ -1,18 +1,35 @@
 
 import os
 import csv
+import glob
+import heapq
+import threading
 import collections
 
+if os.name == "posix":
+    import pty
+    import tty
+    import fcntl
+    import struct
+    import termios
+
 import zephyr
-from zephyr.collector import MeasurementCollector
-from zephyr.bioharness import BioHarnessSignalAnalysis, BioHarnessPacketHandler
+from zephyr.collector import MeasurementCollector, CollectorCleanupThread
+from zephyr.bioharness import AccelerometerActivityAnalysis, BioHarnessSignalAnalysis, BioHarnessPacketHandler
 from zephyr.delayed_stream import DelayedRealTimeStream
 from zephyr.message import MessagePayloadParser
 from zephyr.protocol import BioHarnessProtocol, MessageFrameParser
+from zephyr.recording import Recording, iterate_legacy_recording_chunks
 from zephyr.hxm import HxMPacketAnalysis
 
 
-test_data_dir = os.path.join(os.path.split(os.path.split(os.path.split(__file__)[0])[0])[0], "test_data")
+test_data_dir = os.path.join(os.path.split(os.path.split(os.path.abspath(__file__))[0])[0], "testdata")
+
+
+def iterate_test_recordings():
+    for data_path in sorted(glob.glob(os.path.join(test_data_dir, "*.dat"))):
+        timing_path = data_path[:-len(".dat")] + "-timing.csv"
+        yield data_path, timing_path
 
 
 class VirtualSerial:
@@ -47,43 +64,241 @@ class TimedVirtualSerial:
     
     def open(self):
         return None
-
+    
     def close(self):
         pass
     
     def read(self, byte_count):
-        assert byte_count == 1
-        return self.read_byte()
-    
-    def write(self, data):
-        pass
-    
-    def read_byte(self):
         if len(self.timings) == 0:
             raise EOFError("End of file reached")
         
-        chunk_timestamp_string, chunk_cumulative_byte_count_string = self.timings[0]
-        chunk_timestamp = float(chunk_timestamp_string) + self.timestamp_correction
-        chunk_cumulative_byte_count = int(chunk_cumulative_byte_count_string)
+        chunk_timestamp, chunk_cumulative_byte_count = self.timings[0]
+        chunk_timestamp += self.timestamp_correction
         
         time_to_chunk_timestamp = chunk_timestamp - zephyr.time()
         
         if time_to_chunk_timestamp > 0:
             zephyr.sleep(time_to_chunk_timestamp)
         
-        output_byte = self.input_file.read(1)
+        # never read past the end of the current chunk so that the recorded
+        # arrival timing is preserved for bulk reads
+        chunk_remaining_byte_count = chunk_cumulative_byte_count - self.input_file.tell()
+        output_bytes = self.input_file.read(max(1, min(byte_count, chunk_remaining_byte_count)))
         position = self.input_file.tell()
         
         if position >= chunk_cumulative_byte_count:
             self.timings.popleft()
         
-        return output_byte
+        return output_bytes
+    
+    def write(self, data):
+        pass
+    
+    def read_byte(self):
+        return self.read(1)
+    
+    def inWaiting(self):
+        if self.paused is True:
+            return 0
+        elif len(self.timings) == 0:
+            return 1
+        else:
+            chunk_cumulative_byte_count = self.timings[0][1]
+            return max(1, chunk_cumulative_byte_count - self.input_file.tell())
 
+
+class RecordingVirtualSerial:
+    """Replays the frames of a zephyr.recording file from start_timestamp
+    on, with the receive timing of the recording."""
+    def __init__(self, recording_path, start_timestamp=None):
+        self.recording = Recording(recording_path)
+        self.frame_iterator = self.recording.iterate_frames(start_timestamp)
+        self.pending_frame = next(self.frame_iterator, None)
+        self.pending_bytes = ""
+        
+        if self.pending_frame is not None:
+            self.timestamp_correction = zephyr.time() - self.pending_frame[0]
+        self.paused = True
+    
+    def open(self):
+        return None
+    
+    def close(self):
+        self.recording.close()
+    
+    def read(self, byte_count):
+        if not self.pending_bytes:
+            if self.pending_frame is None:
+                raise EOFError("End of recording reached")
+            
+            chunk_timestamp = self.pending_frame[0]
+            time_to_chunk_timestamp = chunk_timestamp + self.timestamp_correction - zephyr.time()
+            if time_to_chunk_timestamp > 0:
+                zephyr.sleep(time_to_chunk_timestamp)
+            
+            # frames received together are also replayed together
+            chunk_frames = []
+            while self.pending_frame is not None and self.pending_frame[0] == chunk_timestamp:
+                chunk_frames.append(self.pending_frame[1])
+                self.pending_frame = next(self.frame_iterator, None)
+            self.pending_bytes = "".join(chunk_frames)
+        
+        output_bytes = self.pending_bytes[:byte_count]
+        self.pending_bytes = self.pending_bytes[byte_count:]
+        return output_bytes
+    
+    def write(self, data):
+        pass
+    
+    def read_byte(self):
+        return self.read(1)
+    
     def inWaiting(self):
         if self.paused is True:
-            return False
+            return 0
+        elif self.pending_bytes:
+            return len(self.pending_bytes)
         else:
-            return True
+            return 1
+
+
+class PtySerial:
+    """Serial port stand-in on the slave side of a pseudo terminal. Bytes
+    written with device_write() on the master side arrive on the port."""
+    def __init__(self):
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+    
+    def open(self):
+        return None
+    
+    def close(self):
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+    
+    def fileno(self):
+        if self.slave_fd is None:
+            raise ValueError("Port is closed")
+        return self.slave_fd
+    
+    def inWaiting(self):
+        waiting_bytes = fcntl.ioctl(self.slave_fd, termios.FIONREAD, struct.pack("I", 0))
+        return struct.unpack("I", waiting_bytes)[0]
+    
+    def read(self, byte_count):
+        return os.read(self.slave_fd, byte_count)
+    
+    def write(self, data):
+        os.write(self.slave_fd, data)
+    
+    def device_write(self, data):
+        os.write(self.master_fd, data)
+    
+    def device_read(self, byte_count):
+        return os.read(self.master_fd, byte_count)
+
+
+class UnpluggablePty:
+    """Device side of a pseudo terminal that is reachable at link_path. The
+    port disappears on unplug() and comes back at the same path on plug(),
+    like a Bluetooth serial port of a device that goes out of range."""
+    def __init__(self, link_path):
+        self.link_path = link_path
+        self.master_fd = None
+        self.plug()
+    
+    def plug(self):
+        self.master_fd, slave_fd = pty.openpty()
+        tty.setraw(self.master_fd)
+        os.symlink(os.ttyname(slave_fd), self.link_path)
+        # the slave side stays usable once the port has opened it
+        os.close(slave_fd)
+    
+    def unplug(self):
+        os.remove(self.link_path)
+        os.close(self.master_fd)
+        self.master_fd = None
+    
+    def device_write(self, data):
+        os.write(self.master_fd, data)
+    
+    def device_read(self, byte_count):
+        return os.read(self.master_fd, byte_count)
+
+
+class TtySerial:
+    """Serial port stand-in that opens a terminal device by its path. Like
+    serial.Serial it has a timeout, so an empty read means the port hung up."""
+    def __init__(self, port_path):
+        self.port_path = port_path
+        self.timeout = 0
+        self.fd = None
+    
+    def open(self):
+        self.fd = os.open(self.port_path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    
+    def fileno(self):
+        if self.fd is None:
+            raise ValueError("Port is closed")
+        return self.fd
+    
+    def inWaiting(self):
+        waiting_bytes = fcntl.ioctl(self.fd, termios.FIONREAD, struct.pack("I", 0))
+        return struct.unpack("I", waiting_bytes)[0]
+    
+    def read(self, byte_count):
+        return os.read(self.fd, byte_count)
+    
+    def write(self, data):
+        if self.fd is None:
+            raise ValueError("Port is closed")
+        os.write(self.fd, data)
+
+
+class PtyRecordingReplayer(threading.Thread):
+    """Writes .dat/-timing.csv recordings into the device side of PtySerial
+    ports, all of them at the same time and speed times faster than they
+    were recorded."""
+    def __init__(self, devices_and_recordings, speed=1.0):
+        threading.Thread.__init__(self)
+        self.devices_and_recordings = devices_and_recordings
+        self.speed = speed
+        self.terminated = False
+    
+    def terminate(self):
+        self.terminated = True
+    
+    def iterate_device_chunks(self, device, data_path, timing_path):
+        chunks = iterate_legacy_recording_chunks(data_path, timing_path)
+        first_timestamp, first_chunk = next(chunks)
+        yield 0.0, first_chunk, device
+        
+        for chunk_timestamp, chunk_bytes in chunks:
+            yield chunk_timestamp - first_timestamp, chunk_bytes, device
+    
+    def run(self):
+        device_chunks = [self.iterate_device_chunks(device, data_path, timing_path)
+                         for device, (data_path, timing_path) in self.devices_and_recordings]
+        
+        start_time = zephyr.time()
+        for chunk_offset, chunk_bytes, device in heapq.merge(*device_chunks):
+            if self.terminated:
+                break
+            
+            time_to_chunk = start_time + chunk_offset / self.speed - zephyr.time()
+            if time_to_chunk > 0:
+                zephyr.sleep(time_to_chunk)
+            
+            device.device_write(chunk_bytes)
 
 
 def visualize_measurements(signal_collector):
@@ -136,24 +351,27 @@ def simulation_workflow(callbacks, ser):
     collector = MeasurementCollector()
     
     rr_signal_analysis = BioHarnessSignalAnalysis([], [collector.handle_event])
-
-    signal_packet_handler_bh = BioHarnessPacketHandler([collector.handle_signal, rr_signal_analysis.handle_signal],
+    activity_analysis = AccelerometerActivityAnalysis([collector.handle_signal])
+    
+    signal_packet_handler_bh = BioHarnessPacketHandler([collector.handle_signal, rr_signal_analysis.handle_signal,
+                                                        activity_analysis.handle_signal],
                                                        [collector.handle_event])
     #signal_packet_handler_hxm = HxMPacketAnalysis([collector.handle_event])
     
-    #payload_parser = MessagePayloadParser([signal_packet_handler_bh.handle_packet,
-                                        #signal_packet_handler_hxm.handle_packet])
-                                           
-    payload_parser = MessagePayloadParser([signal_packet_handler_bh.handle_packet])
+    payload_parser = MessagePayloadParser()
+    signal_packet_handler_bh.subscribe(payload_parser)
+    #signal_packet_handler_hxm.subscribe(payload_parser)
     
     message_parser = MessageFrameParser(payload_parser.handle_message)
     
     delayed_stream_thread = DelayedRealTimeStream(collector, callbacks, 1.2)
+    cleanup_thread = CollectorCleanupThread([collector])
     
     protocol = BioHarnessProtocol(ser, [message_parser.parse_data])
     protocol.enable_periodic_packets()
     
     delayed_stream_thread.start()
+    cleanup_thread.start()
     
     try:
         protocol.run()
@@ -162,3 +380,5 @@ def simulation_workflow(callbacks, ser):
     
     delayed_stream_thread.terminate()
     delayed_stream_thread.join()
+    cleanup_thread.terminate()
+    cleanup_thread.join()
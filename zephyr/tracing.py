@@ -0,0 +1,264 @@
+"""Latency tracing of frames through the receive pipeline.
+
+A LatencyTracer follows every sample_interval-th frame of each message type
+and stamps a monotonic time when the frame passes a stage:
+
+    read            the chunk that completed the frame was read from the port
+    frame           MessageFrameParser verified the frame
+    payload         MessagePayloadParser decoded the payload
+    collector       MeasurementCollector stored the signal packet or event
+    delayed_stream  DelayedRealTimeStream passed it to its callbacks
+    gui             the GUI thread handled it
+
+The tracer methods are callbacks that are added to the callback lists of
+the pipeline, so the pipeline has no tracing overhead without a tracer.
+For every message type and stage the tracer keeps the latency since the
+previous stage and since the read, and reports their percentiles."""
+
+import os
+import csv
+import sys
+import time
+import ctypes
+import ctypes.util
+import logging
+import threading
+import collections
+
+import numpy
+
+import zephyr
+
+
+STAGES = ("read", "frame", "payload", "collector", "delayed_stream", "gui")
+STAGE_ORDERS = dict((stage, stage_order) for stage_order, stage in enumerate(STAGES))
+
+
+def get_monotonic_clock():
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    
+    if sys.platform.startswith("linux"):
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+        
+        try:
+            librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1", use_errno=True)
+            clock_gettime = librt.clock_gettime
+        except (OSError, AttributeError):
+            return time.time
+        
+        CLOCK_MONOTONIC = 1
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        
+        def monotonic_time():
+            now = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now))
+            return now.tv_sec + now.tv_nsec * 1e-9
+        
+        return monotonic_time
+    
+    if os.name == "nt":
+        return time.clock
+    
+    return time.time
+
+
+monotonic_time = get_monotonic_clock()
+
+
+def get_stage_order(stage):
+    return STAGE_ORDERS.get(stage, len(STAGES))
+
+
+def get_latency_statistics(latencies):
+    latencies = numpy.array(latencies)
+    if not len(latencies):
+        return {"count": 0}
+    
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+    return {"count": len(latencies),
+            "mean": latencies.mean(),
+            "p50": p50,
+            "p95": p95,
+            "p99": p99,
+            "max": latencies.max()}
+
+
+class LatencyTrace:
+    def __init__(self, message_id, read_time):
+        self.message_id = message_id
+        self.stage_times = {"read": read_time}
+        # time that a stage deliberately held the trace back, which is not lag
+        self.scheduled_delays = {}
+
+
+class LatencyTracer:
+    """Add handle_data() before the frame parser to the Protocol callbacks,
+    handle_frame() as the first MessageFrameParser callback, subscribe
+    handle_message() to the MessagePayloadParser before the other
+    subscribers, add handle_signal() and handle_event() after the collector
+    to the BioHarnessPacketHandler callbacks, and pass the tracer to
+    DelayedRealTimeStream. The trace_callbacks receive the traces that
+    DelayedRealTimeStream passed on, so that the GUI thread can stamp() them
+    when it handles them."""
+    def __init__(self, sample_interval=10, history_length=1000, trace_callbacks=()):
+        self.sample_interval = sample_interval
+        self.trace_callbacks = list(trace_callbacks)
+        
+        self.frame_counts = collections.Counter()
+        self.chunk_read_wall_time = None
+        # the sampled frame that the protocol thread is passing through
+        # the pipeline, or None
+        self.current_trace = None
+        
+        self.pending_traces = collections.defaultdict(lambda: collections.deque(maxlen=history_length))
+        self.pending_lock = threading.Lock()
+        
+        self.stage_latencies = collections.defaultdict(lambda: collections.deque(maxlen=history_length))
+        self.cumulative_latencies = collections.defaultdict(lambda: collections.deque(maxlen=history_length))
+        self.latencies_lock = threading.Lock()
+    
+    def handle_data(self, data_string):
+        # the chunks are small and frequent, and the monotonic clock of
+        # Python 2 costs more than the wall clock, so the monotonic read time
+        # is only derived for the chunks that complete a sampled frame
+        self.chunk_read_wall_time = time.time()
+    
+    def handle_frame(self, message_frame):
+        frame_count = self.frame_counts[message_frame.message_id]
+        self.frame_counts[message_frame.message_id] = frame_count + 1
+        
+        if frame_count % self.sample_interval:
+            self.current_trace = None
+            return
+        
+        now = monotonic_time()
+        if self.chunk_read_wall_time is not None:
+            read_time = now - max(0.0, time.time() - self.chunk_read_wall_time)
+        else:
+            read_time = now
+        self.current_trace = LatencyTrace(message_frame.message_id, read_time)
+        self.stamp(self.current_trace, "frame", now)
+    
+    def handle_message(self, message):
+        if self.current_trace is not None:
+            self.stamp(self.current_trace, "payload")
+    
+    def handle_signal(self, signal_packet, starts_new_stream):
+        if self.current_trace is not None:
+            end_timestamp = signal_packet.timestamp + (len(signal_packet.samples) - 1) / float(signal_packet.samplerate)
+            self.handle_stored_value(signal_packet.type, end_timestamp)
+    
+    def handle_event(self, stream_name, value):
+        if self.current_trace is not None:
+            event_timestamp = value[0]
+            self.handle_stored_value(stream_name, event_timestamp)
+    
+    def handle_stored_value(self, stream_name, timestamp):
+        trace = self.current_trace
+        self.stamp(trace, "collector")
+        
+        with self.pending_lock:
+            self.pending_traces[stream_name].append((timestamp, zephyr.time(), trace))
+    
+    def handle_stream_output(self, stream_name, delayed_current_time, delay):
+        """DelayedRealTimeStream calls this after it passed the samples of a
+        stream up to delayed_current_time to its callbacks."""
+        pending_traces = self.pending_traces.get(stream_name)
+        if not pending_traces:
+            return
+        
+        output_traces = []
+        with self.pending_lock:
+            while pending_traces and pending_traces[0][0] <= delayed_current_time:
+                output_traces.append(pending_traces.popleft())
+        
+        now = monotonic_time()
+        for timestamp, store_time, trace in output_traces:
+            # the stream holds every sample back until it is delay seconds old
+            scheduled_delay = max(0.0, timestamp + delay - store_time)
+            if self.stamp(trace, "delayed_stream", now, scheduled_delay):
+                for callback in self.trace_callbacks:
+                    callback(trace)
+    
+    def stamp(self, trace, stage, now=None, scheduled_delay=0.0):
+        """Record that the trace reached the stage. Returns False if it had
+        reached it already, like a summary message that is stored in several
+        event streams."""
+        if now is None:
+            now = monotonic_time()
+        stage_order = get_stage_order(stage)
+        
+        with self.latencies_lock:
+            if stage in trace.stage_times:
+                return False
+            
+            # the latest of the earlier stages, the GUI can handle a waveform
+            # before the delayed stream passes it on
+            previous_time = 0.0
+            for previous_stage, stage_time in trace.stage_times.iteritems():
+                if stage_time > previous_time and get_stage_order(previous_stage) < stage_order:
+                    previous_time = stage_time
+            
+            total_scheduled_delay = scheduled_delay
+            for previous_stage, delay in trace.scheduled_delays.iteritems():
+                if delay and get_stage_order(previous_stage) < stage_order:
+                    total_scheduled_delay += delay
+            
+            trace.stage_times[stage] = now
+            if scheduled_delay:
+                trace.scheduled_delays[stage] = scheduled_delay
+            
+            key = (trace.message_id, stage)
+            self.stage_latencies[key].append(now - previous_time - scheduled_delay)
+            self.cumulative_latencies[key].append(now - trace.stage_times["read"] - total_scheduled_delay)
+        
+        return True
+    
+    def get_statistics(self):
+        """Latency percentiles in seconds by message id and stage. "stage" is
+        the latency since the previous stage and "cumulative" since the read."""
+        with self.latencies_lock:
+            latencies = [(key, list(self.stage_latencies[key]), list(self.cumulative_latencies[key]))
+                         for key in self.stage_latencies]
+        
+        latencies.sort(key=lambda latency: (latency[0][0], get_stage_order(latency[0][1])))
+        
+        statistics = collections.OrderedDict()
+        for (message_id, stage), stage_latencies, cumulative_latencies in latencies:
+            message_statistics = statistics.setdefault(message_id, collections.OrderedDict())
+            message_statistics[stage] = {"stage": get_latency_statistics(stage_latencies),
+                                         "cumulative": get_latency_statistics(cumulative_latencies)}
+        
+        return statistics
+    
+    def format_statistics(self):
+        lines = ["message stage             count   p50 ms   p95 ms   p99 ms   max ms   total p95 ms"]
+        
+        for message_id, message_statistics in self.get_statistics().items():
+            for stage, stage_statistics in message_statistics.items():
+                latencies, cumulative_latencies = stage_statistics["stage"], stage_statistics["cumulative"]
+                lines.append("0x%02X    %-15s %7d %8.3f %8.3f %8.3f %8.3f %14.3f" %
+                             (message_id, stage, latencies["count"],
+                              1000.0 * latencies["p50"], 1000.0 * latencies["p95"],
+                              1000.0 * latencies["p99"], 1000.0 * latencies["max"],
+                              1000.0 * cumulative_latencies["p95"]))
+        
+        return "\n".join(lines)
+    
+    def dump_statistics(self, output_path):
+        """Write the percentiles in milliseconds as CSV and log them."""
+        percentiles = ["p50", "p95", "p99", "max"]
+        
+        with open(output_path, "wb") as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(["message_id", "stage", "count"] + percentiles + ["cumulative_" + p for p in percentiles])
+            
+            for message_id, message_statistics in self.get_statistics().items():
+                for stage, stage_statistics in message_statistics.items():
+                    writer.writerow(["0x%02X" % message_id, stage, stage_statistics["stage"]["count"]] +
+                                    ["%.3f" % (1000.0 * stage_statistics["stage"][p]) for p in percentiles] +
+                                    ["%.3f" % (1000.0 * stage_statistics["cumulative"][p]) for p in percentiles])
+        
+        logging.info("Pipeline latencies written to %s\n%s", output_path, self.format_statistics())
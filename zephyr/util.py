@@ -1,8 +1,11 @@
 
 import time
+import struct
 import datetime
 import collections
 
+import numpy
+
 import zephyr
 
 
@@ -30,7 +33,7 @@ def set_time_speed(simulation_speed):
     zephyr.sleep = FastSleep(simulation_speed)
 
 
-def crc_8_digest(values):
+def crc_8_digest_bitwise(values):
     crc = 0
     
     for byte in values:
@@ -44,6 +47,72 @@ def crc_8_digest(values):
     return crc
 
 
+CRC_8_TABLE = tuple(crc_8_digest_bitwise([byte]) for byte in range(256))
+CRC_8_TABLE_ARRAY = numpy.array(CRC_8_TABLE, dtype=numpy.uint8)
+
+
+def crc_8_digest(values):
+    crc = 0
+    table = CRC_8_TABLE
+    
+    for byte in values:
+        crc = table[crc ^ byte]
+    
+    return crc
+
+
+def create_crc_8_position_table(row_count):
+    """Row k of the table maps a byte to the CRC of the byte followed by k
+    zero bytes. As the CRC is linear, the CRC of a payload is the XOR of
+    the rows of its bytes by their distance from the end of the payload."""
+    rows = [CRC_8_TABLE_ARRAY]
+    while len(rows) < row_count:
+        rows.append(CRC_8_TABLE_ARRAY[rows[-1]])
+    return numpy.array(rows)
+
+
+CRC_8_POSITION_TABLE = create_crc_8_position_table(128)
+
+
+def crc_8_digests(data_bytes, payload_offsets, payload_lengths):
+    """Calculate the CRC of many payloads in data_bytes at once. Payload i
+    starts at payload_offsets[i] and is payload_lengths[i] bytes long."""
+    data_array = numpy.frombuffer(data_bytes, dtype=numpy.uint8)
+    payload_offsets = numpy.asarray(payload_offsets, dtype=numpy.intp)
+    payload_lengths = numpy.asarray(payload_lengths, dtype=numpy.intp)
+    
+    crcs = numpy.zeros(len(payload_offsets), dtype=numpy.uint8)
+    nonempty = payload_lengths > 0
+    payload_offsets, payload_lengths = payload_offsets[nonempty], payload_lengths[nonempty]
+    if not len(payload_lengths):
+        return crcs
+    
+    # the bytes of all payloads one after another, and for each byte the
+    # number of bytes that follow it in its payload
+    payload_ends = numpy.cumsum(payload_lengths)
+    payload_starts = payload_ends - payload_lengths
+    byte_indices = numpy.arange(payload_ends[-1])
+    distances_to_end = numpy.repeat(payload_ends - 1, payload_lengths) - byte_indices
+    byte_indices += numpy.repeat(payload_offsets - payload_starts, payload_lengths)
+    
+    position_table = CRC_8_POSITION_TABLE
+    if payload_lengths.max() > len(position_table):
+        position_table = create_crc_8_position_table(payload_lengths.max())
+    byte_crcs = position_table.ravel()[distances_to_end * 256 + data_array[byte_indices]]
+    
+    crcs[nonempty] = numpy.bitwise_xor.reduceat(byte_crcs, payload_starts)
+    return crcs
+
+
+def verify_crc_8_digests(data_bytes, payload_offsets, payload_lengths, crc_offsets):
+    """Return a boolean mask of the payloads whose CRC matches the byte at
+    the corresponding crc_offsets position."""
+    data_array = numpy.frombuffer(data_bytes, dtype=numpy.uint8)
+    expected_crcs = data_array[numpy.asarray(crc_offsets, dtype=numpy.intp)]
+    
+    return crc_8_digests(data_bytes, payload_offsets, payload_lengths) == expected_crcs
+
+
 def parse_uint16_values_from_bytes(byte_values):
     assert not len(byte_values) % 2
     
@@ -65,19 +134,42 @@ def parse_uint16_values_from_byte_sequence(ls_byte_indices, byte_sequence):
     return values
 
 
-def parse_timestamp(timestamp_bytes):
-    year = timestamp_bytes[0] + (timestamp_bytes[1] << 8)
-    month = timestamp_bytes[2]
-    day = timestamp_bytes[3]
-    day_milliseconds = (timestamp_bytes[4] +
-                        (timestamp_bytes[5] << 8) +
-                        (timestamp_bytes[6] << 16) +
-                        (timestamp_bytes[7] << 24))
+def unpack_payload(payload_struct, payload, offset=0):
+    """payload_struct.unpack_from() straight from a bytearray or string
+    payload. Payloads that are lists of byte values, like those built by
+    BytewiseMessageFrameParser, are copied into a bytearray first."""
+    try:
+        return payload_struct.unpack_from(payload, offset)
+    except TypeError:
+        return payload_struct.unpack_from(bytearray(payload), offset)
+
+
+# year, month, day and milliseconds since midnight
+TIMESTAMP_STRUCT = struct.Struct("<HBBI")
+
+_midnight_epochs = {}
+
+def get_midnight_epoch(year, month, day):
+    """Local midnight of the date in seconds since the epoch. The date of
+    the packets changes once a day, so mktime() runs once a day too."""
+    key = (year, month, day)
     
-    date = datetime.date(year=year, month=month, day=day)
+    if key not in _midnight_epochs:
+        if len(_midnight_epochs) >= 64:
+            _midnight_epochs.clear()
+        
+        date = datetime.date(year=year, month=month, day=day)
+        _midnight_epochs[key] = time.mktime(date.timetuple())
     
-    timestamp = time.mktime(date.timetuple()) + day_milliseconds / 1000.0
-    return timestamp
+    return _midnight_epochs[key]
+
+
+def get_timestamp(year, month, day, day_milliseconds):
+    return get_midnight_epoch(year, month, day) + day_milliseconds / 1000.0
+
+
+def parse_timestamp(timestamp_bytes, offset=0):
+    return get_timestamp(*unpack_payload(TIMESTAMP_STRUCT, timestamp_bytes, offset))
 
 
 def unpack_bit_packed_values(data_bytes, value_nbits, twos_complement):
@@ -107,6 +199,129 @@ def unpack_bit_packed_values(data_bytes, value_nbits, twos_complement):
     return unpacked_values
 
 
+def as_byte_array(data_bytes):
+    if type(data_bytes) in (bytearray, str):
+        return numpy.frombuffer(data_bytes, dtype=numpy.uint8)
+    elif isinstance(data_bytes, numpy.ndarray):
+        return data_bytes.astype(numpy.uint8, copy=False)
+    else:
+        return numpy.asarray(bytearray(data_bytes), dtype=numpy.uint8)
+
+
+def stack_payloads(payloads):
+    """Stack equally long payloads into a 2-D byte array, one row each."""
+    payload_length = len(payloads[0]) if len(payloads) else 0
+    stacked_bytes = numpy.frombuffer("".join(str(payload) for payload in payloads), dtype=numpy.uint8)
+    return stacked_bytes.reshape(len(payloads), payload_length)
+
+
+UINT16_LE = numpy.dtype("<u2")
+INT16_LE = numpy.dtype("<i2")
+
+_bit_unpacking_indices = {}
+
+def get_bit_unpacking_indices(byte_count, value_nbits):
+    """Indices of the two bytes holding each value, the bit offset of the
+    value in them, the value bit mask, whether the data needs a padding
+    byte at the end and the offsets of the bit offsets in the window
+    decoding tables.
+    Like unpack_bit_packed_values, this assumes that a value never spans
+    more than two bytes."""
+    key = (byte_count, value_nbits)
+    
+    if key not in _bit_unpacking_indices:
+        value_start_bits = numpy.arange(byte_count * 8 // value_nbits) * value_nbits
+        value_start_bytes = value_start_bits // 8
+        byte_pair_indices = (value_start_bytes[:, None] + numpy.arange(2)).ravel()
+        bit_offsets = (value_start_bits % 8).astype(numpy.uint16)
+        # a mask array is much faster to apply than a scalar mask
+        value_bit_mask = numpy.full(len(bit_offsets), 2**value_nbits - 1, dtype=numpy.uint16)
+        needs_padding = bool(len(byte_pair_indices)) and byte_pair_indices[-1] >= byte_count
+        window_table_offsets = bit_offsets.astype(numpy.intp) << 16
+        _bit_unpacking_indices[key] = (byte_pair_indices, bit_offsets, value_bit_mask, needs_padding,
+                                       window_table_offsets)
+    
+    return _bit_unpacking_indices[key]
+
+
+def unpack_bit_packed_array(data_bytes, value_nbits, twos_complement, dtype=numpy.int32):
+    """Vectorized unpack_bit_packed_values returning an array of the given
+    dtype. data_bytes may also be a 2-D byte array, in which case every row
+    is unpacked separately."""
+    data_array = as_byte_array(data_bytes)
+    
+    if value_nbits == 16:
+        value_count = data_array.shape[-1] // 2
+        data_array = numpy.ascontiguousarray(data_array[..., :2 * value_count])
+        return data_array.view(INT16_LE if twos_complement else UINT16_LE).astype(dtype)
+    
+    byte_pair_indices, bit_offsets, value_bit_mask, needs_padding = \
+        get_bit_unpacking_indices(data_array.shape[-1], value_nbits)[:4]
+    
+    if needs_padding:
+        padding = numpy.zeros(data_array.shape[:-1] + (1,), dtype=numpy.uint8)
+        data_array = numpy.concatenate([data_array, padding], axis=-1)
+    
+    unpacked_values = data_array.take(byte_pair_indices, axis=-1).view(UINT16_LE) >> bit_offsets
+    unpacked_values &= value_bit_mask
+    unpacked_values = unpacked_values.astype(dtype)
+    
+    if twos_complement:
+        represented_value_count = 2**value_nbits
+        unpacked_values[unpacked_values >= represented_value_count // 2] -= represented_value_count
+    
+    return unpacked_values
+
+
+_window_decoding_tables = {}
+
+def get_window_decoding_table(value_nbits, twos_complement, offset, dtype):
+    """The decoded value plus offset of every two-byte window at each of the
+    eight bit offsets, with the window at bit offset k at k * 65536."""
+    key = (value_nbits, twos_complement, offset, dtype)
+    
+    if key not in _window_decoding_tables:
+        windows = numpy.arange(65536, dtype=numpy.int32)
+        values = (windows[None, :] >> numpy.arange(8)[:, None]) & (2**value_nbits - 1)
+        if twos_complement:
+            values[values >= 2**(value_nbits - 1)] -= 2**value_nbits
+        _window_decoding_tables[key] = (values + offset).astype(dtype).ravel()
+    
+    return _window_decoding_tables[key]
+
+
+def decode_bit_packed_samples(data_bytes, value_nbits, twos_complement, offset=0, scale=None, dtype=numpy.int32):
+    """Unpack the samples of a payload (or of a 2-D stack of payloads) and
+    apply (value + offset) * scale to the unpacked array. Without a scale
+    the result has the given integer dtype, otherwise it is float64.
+    
+    Samples of less than 16 bits without a scale are looked up by their
+    two-byte window and bit offset in a table that already has the offset
+    added, which takes two NumPy operations instead of five."""
+    if value_nbits < 16 and scale is None:
+        data_array = as_byte_array(data_bytes)
+        byte_pair_indices, bit_offsets, value_bit_mask, needs_padding, window_table_offsets = \
+            get_bit_unpacking_indices(data_array.shape[-1], value_nbits) #@UnusedVariable
+        
+        if needs_padding:
+            padding = numpy.zeros(data_array.shape[:-1] + (1,), dtype=numpy.uint8)
+            data_array = numpy.concatenate([data_array, padding], axis=-1)
+        
+        windows = data_array.take(byte_pair_indices, axis=-1).view(UINT16_LE)
+        window_indices = window_table_offsets + windows
+        return get_window_decoding_table(value_nbits, twos_complement, offset, dtype).take(window_indices)
+    
+    samples = unpack_bit_packed_array(data_bytes, value_nbits, twos_complement, dtype)
+    
+    if offset:
+        samples += offset
+    
+    if scale is not None:
+        samples = samples * scale
+    
+    return samples
+
+
 DISABLE_CLOCK_DIFFERENCE_ESTIMATION = False
 
 class ClockDifferenceEstimator: